@@ -0,0 +1,38 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from lrs.models import Statement, StatementAgent, StatementActivity
+from lrs.utils.statement_index import index_stored_statements
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the statement index tables from the statements already stored, for statements ' \
+           'saved before the index existed. Safe to run again, each statement\'s rows are replaced'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size',
+            dest='batch_size',
+            default=1000,
+            type='int',
+            help='Number of statements indexed per transaction'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        last_id = 0
+        total = 0
+        while True:
+            stmts = list(Statement.objects.select_related('object_substatement')
+                         .filter(id__gt=last_id).order_by('id')[:options['batch_size']])
+            if not stmts:
+                break
+            with transaction.atomic():
+                ids = [st.id for st in stmts]
+                StatementAgent.objects.filter(statement_id__in=ids).delete()
+                StatementActivity.objects.filter(statement_id__in=ids).delete()
+                index_stored_statements(stmts)
+            last_id = stmts[-1].id
+            total += len(stmts)
+            self.stdout.write("Indexed %d statements" % total)
@@ -0,0 +1,96 @@
+import copy
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from lrs.managers.StatementManager import build_full_statement
+from lrs.utils.req_process import prepare_statement
+
+
+def new_objects(obj, existing, seen=None):
+    # Bytes taken by the objects reachable from obj that aren't in existing
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = 0 if id(obj) in existing else sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += new_objects(k, existing, seen) + new_objects(v, existing, seen)
+    elif isinstance(obj, list):
+        for v in obj:
+            size += new_objects(v, existing, seen)
+    return size
+
+
+def object_ids(obj, ids):
+    ids.add(id(obj))
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            object_ids(k, ids)
+            object_ids(v, ids)
+    elif isinstance(obj, list):
+        for v in obj:
+            object_ids(v, ids)
+    return ids
+
+
+class Command(BaseCommand):
+    help = 'Compares the memory and time taken to build the saved full statement with a deep copy ' \
+           'against the current shallow copy, per statement'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--statements',
+            dest='statements',
+            default=1000,
+            type='int',
+            help='Number of statements to build'
+        ),
+        make_option(
+            '--extensions',
+            dest='extensions',
+            default=50,
+            type='int',
+            help='Number of result and context extensions per statement, each a small nested object'
+        ),
+    )
+
+    def statement(self, i, extensions):
+        ext = {"http://example.com/ext/%s" % n: {"values": [n, str(n), {"n": n}], "index": i}
+               for n in range(extensions)}
+        return {"actor": {"objectType": "Agent", "mbox": "mailto:bench%s@example.com" % i},
+                "verb": {"id": "http://example.com/verbs/benchmarked", "display": {"en-US": "benchmarked"}},
+                "object": {"id": "act:bench", "definition": {"name": {"en-US": "bench"}, "extensions": ext}},
+                "result": {"score": {"raw": i}, "extensions": ext},
+                "context": {"contextActivities": {"parent": {"id": "act:bench_parent"}},
+                            "extensions": ext}}
+
+    def measure(self, stmts, copy_statement):
+        start = time.time()
+        copies = [copy_statement(st) for st in stmts]
+        elapsed = time.time() - start
+        size = sum(new_objects(full_statement, object_ids(st, set()))
+                   for st, full_statement in zip(stmts, copies))
+        return size / len(stmts), elapsed * 1000000 / len(stmts)
+
+    def handle(self, *args, **options):
+        stmts = [self.statement(i, options['extensions'])
+                 for i in range(options['statements'])]
+        for st in stmts:
+            prepare_statement(st)
+        authority = {"objectType": "Agent", "mbox": "mailto:authority@example.com"}
+
+        deep_bytes, deep_us = self.measure(
+            stmts, lambda st: dict(copy.deepcopy(st), authority=authority))
+        shallow_bytes, shallow_us = self.measure(
+            stmts, lambda st: build_full_statement(st, authority))
+
+        self.stdout.write("%d statements, %d extensions each" % (
+            len(stmts), options['extensions']))
+        self.stdout.write("deepcopy:     %8d bytes %10.1f us per statement" % (
+            deep_bytes, deep_us))
+        self.stdout.write("shallow copy: %8d bytes %10.1f us per statement" % (
+            shallow_bytes, shallow_us))
@@ -0,0 +1,166 @@
+import re
+import time
+import uuid
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from lrs.utils import validation_cache
+from lrs.utils.StatementValidator import StatementValidator, iriparse
+
+
+class LegacyStatementValidator(StatementValidator):
+    # The helpers as they were before the rules were compiled at import -
+    # regexes compiled on every call, list membership for allowed fields,
+    # field names formatted whether or not there is an error and every IRI
+    # and language tag parsed again
+
+    def validate_email(self, email):
+        if isinstance(email, basestring):
+            if email.startswith("mailto:"):
+                email_re = re.compile("[^@]+@[^@]+\.[^@]+")
+                if not email_re.match(email[7:]):
+                    self.return_error(
+                        "mbox value %s is not a valid email" % email)
+            else:
+                self.return_error(
+                    "mbox value %s did not start with mailto:" % email)
+        else:
+            self.return_error("mbox value must be a string type")
+
+    def validate_language(self, lang, field):
+        if not isinstance(lang, basestring):
+            self.return_error(
+                "language %s is not valid in %s" % (lang, field))
+        for part in lang.split('-'):
+            if part and re.match("^[A-Za-z0-9]*$", part):
+                if len(part) > 8:
+                    self.return_error(
+                        "language %s is not valid in %s" % (lang, field))
+            else:
+                self.return_error(
+                    "language %s is not valid in %s" % (lang, field))
+
+    def validate_iri(self, iri_value, field):
+        if isinstance(iri_value, basestring):
+            try:
+                iriparse(iri_value, rule='IRI')
+            except Exception:
+                self.return_error(
+                    "%s with value %s was not a valid IRI" % (field, iri_value))
+        else:
+            self.return_error("%s must be a string type" % field)
+
+    def validate_email_sha1sum(self, sha1sum):
+        if isinstance(sha1sum, basestring):
+            sha1sum_re = re.compile('([a-fA-F\d]{40}$)')
+            if not sha1sum_re.match(sha1sum):
+                self.return_error(
+                    "mbox_sha1sum value [%s] is not a valid sha1sum" % sha1sum)
+        else:
+            self.return_error("mbox_sha1sum value must be a string type")
+
+    def check_if_dict(self, obj, field, *args):
+        field = field % args if args else field
+        if not isinstance(obj, dict):
+            self.return_error(
+                "%s is not a properly formatted dictionary" % field)
+
+    def check_allowed_fields(self, allowed, obj, obj_name, *args):
+        obj_name = obj_name % args if args else obj_name
+        allowed = list(allowed)
+        failed_list = [x for x in obj.keys() if x not in allowed]
+        if failed_list:
+            self.return_error("Invalid field(s) found in %s - %s" %
+                              (obj_name, ', '.join(failed_list)))
+
+
+class Command(BaseCommand):
+    help = 'Compares the statements per second validated by the StatementValidator against ' \
+           'its helpers as they were before its rules were compiled at import'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--statements',
+            dest='statements',
+            default=2000,
+            type='int',
+            help='Number of statements in the corpus'
+        ),
+        make_option(
+            '--rounds',
+            dest='rounds',
+            default=3,
+            type='int',
+            help='Number of times the corpus is validated, the best round is reported'
+        ),
+    )
+
+    def actor(self, i):
+        kind = i % 4
+        if kind == 0:
+            return {"objectType": "Agent", "name": "Learner %s" % i,
+                    "mbox": "mailto:learner%s@example.com" % i}
+        elif kind == 1:
+            return {"mbox_sha1sum": "%040x" % i}
+        elif kind == 2:
+            return {"account": {"homePage": "http://example.com/accounts", "name": "learner%s" % i}}
+        return {"objectType": "Group", "name": "Team %s" % i,
+                "member": [{"mbox": "mailto:member%s@example.com" % n} for n in range(3)]}
+
+    def activity(self, i):
+        definition = {"name": {"en-US": "Question %s" % i, "fr-FR": "Question %s" % i},
+                      "description": {"en-US": "A question"},
+                      "type": "http://adlnet.gov/expapi/activities/cmi.interaction",
+                      "interactionType": "choice",
+                      "correctResponsesPattern": ["golf[,]tetris"],
+                      "choices": [{"id": choice, "description": {"en-US": choice}}
+                                  for choice in ("golf", "tetris", "facebook", "scrabble")],
+                      "extensions": {"http://example.com/ext/difficulty": i % 5}}
+        return {"objectType": "Activity", "id": "http://example.com/activities/%s" % (i % 100),
+                "definition": definition}
+
+    def statement(self, i):
+        return {"id": str(uuid.uuid4()),
+                "actor": self.actor(i),
+                "verb": {"id": "http://adlnet.gov/expapi/verbs/answered",
+                         "display": {"en-US": "answered", "en-GB": "answered"}},
+                "object": self.activity(i),
+                "result": {"score": {"scaled": 0.5, "raw": 50, "min": 0, "max": 100},
+                           "success": True, "completion": True, "response": "golf[,]tetris",
+                           "duration": "PT1M%sS" % (i % 60)},
+                "context": {"registration": str(uuid.uuid4()),
+                            "instructor": {"mbox": "mailto:instructor@example.com"},
+                            "language": "en-US",
+                            "contextActivities": {
+                                "parent": [{"id": "http://example.com/courses/%s" % (i % 10)}],
+                                "grouping": [{"id": "http://example.com/programs/1"}]},
+                            "extensions": {"http://example.com/ext/session": i}},
+                "timestamp": "2016-06-01T12:%02d:00.000Z" % (i % 60)}
+
+    def measure(self, validator, stmts, rounds):
+        best = None
+        for _ in range(rounds):
+            start = time.time()
+            for st in stmts:
+                validator.validate_statement(st)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return len(stmts) / best
+
+    def handle(self, *args, **options):
+        stmts = [self.statement(i) for i in range(options['statements'])]
+
+        before = self.measure(LegacyStatementValidator(), stmts, options['rounds'])
+        validation_cache.clear()
+        after = self.measure(StatementValidator(), stmts, options['rounds'])
+        stats = validation_cache.stats()
+
+        self.stdout.write("%d statements, best of %d rounds" % (
+            len(stmts), options['rounds']))
+        self.stdout.write("before: %10.1f statements per second" % before)
+        self.stdout.write("after:  %10.1f statements per second (%.2fx)" % (
+            after, after / before))
+        for name in ('iri', 'language'):
+            self.stdout.write("%s cache: %d hits, %d misses (%.1f%%), %d of %d entries" % (
+                name, stats[name]['hits'], stats[name]['misses'], stats[name]['hit_rate'] * 100,
+                stats[name]['size'], stats[name]['max_size']))
@@ -0,0 +1,71 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count, Q
+
+from lrs.models import Statement, StatementActivity
+from lrs.utils.statement_index import activity_statements
+
+
+def legacy_activity_q(activity_id, related):
+    # The activity filter as it was before the statement activity index
+    activityQ = Q(object_activity__activity_id=activity_id)
+    if related:
+        activityQ = activityQ | Q(context_ca_parent__activity_id=activity_id) \
+            | Q(context_ca_grouping__activity_id=activity_id) \
+            | Q(context_ca_category__activity_id=activity_id) \
+            | Q(context_ca_other__activity_id=activity_id) \
+            | Q(object_substatement__object_activity__activity_id=activity_id) \
+            | Q(object_substatement__context_ca_parent__activity_id=activity_id) \
+            | Q(object_substatement__context_ca_grouping__activity_id=activity_id) \
+            | Q(object_substatement__context_ca_category__activity_id=activity_id) \
+            | Q(object_substatement__context_ca_other__activity_id=activity_id)
+    return activityQ
+
+
+class Command(BaseCommand):
+    help = 'Shows the EXPLAIN ANALYZE plans of the statement activity filter with the joins it used ' \
+           'to make and with the statement activity index'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--activity',
+            dest='activity',
+            default=None,
+            help='Activity IRI to filter on, the most referenced activity by default'
+        ),
+        make_option(
+            '--unrelated',
+            dest='related',
+            default=True,
+            action='store_false',
+            help='Filter without related_activities'
+        ),
+    )
+
+    def explain(self, title, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN ANALYZE " + sql, params)
+            plan = [row[0] for row in cursor.fetchall()]
+        self.stdout.write("%s:" % title)
+        for line in plan:
+            self.stdout.write("    %s" % line)
+        self.stdout.write("")
+
+    def handle(self, *args, **options):
+        activity_id = options['activity']
+        if activity_id is None:
+            top = StatementActivity.objects.values('activity__activity_id') \
+                .annotate(count=Count('id')).order_by('-count').first()
+            if top is None:
+                raise CommandError(
+                    "The statement activity index is empty, run backfill_statement_index first")
+            activity_id = top['activity__activity_id']
+        related = options['related']
+
+        self.stdout.write("Activity %s, related_activities=%s\n" % (activity_id, related))
+        self.explain("Joins", Statement.objects.filter(legacy_activity_q(activity_id, related))
+                     .order_by('-stored').distinct().values_list('statement_id'))
+        self.explain("Statement activity index", Statement.objects.filter(
+            id__in=activity_statements(activity_id, related)).order_by('-stored').values_list('statement_id'))
@@ -156,22 +156,75 @@ CELERY_IGNORE_RESULT = True
 
 # Limit on number of statements the server will return
 SERVER_STMT_LIMIT = config.getint('preferences', 'SERVER_STMT_LIMIT')
+# POSTs with at least this many statements are saved with bulk inserts
+BULK_INGEST_THRESHOLD = 10
+# Largest statement POST body accepted (bytes), JSON bodies are read from the
+# request this many statements at a time
+STATEMENT_BODY_MAX_SIZE = 100 * 1024 * 1024
+STATEMENT_STREAM_CHUNK = 100
+# Batches (or streamed chunks) of at least this many statements are validated
+# in a pool of STATEMENT_VALIDATE_PROCESSES processes (None for one per CPU),
+# STATEMENT_VALIDATE_CHUNK statements at a time. None validates every batch on
+# the request thread. Raise STATEMENT_STREAM_CHUNK along with it for streamed
+# JSON bodies to reach the threshold
+STATEMENT_VALIDATE_PARALLEL_THRESHOLD = None
+STATEMENT_VALIDATE_PROCESSES = None
+STATEMENT_VALIDATE_CHUNK = 500
+# Agents kept in each process's IFI cache and how long (seconds) an entry lives
+AGENT_CACHE_SIZE = 10000
+AGENT_CACHE_TIMEOUT = 300
+# Name of a cache in CACHES (e.g. memcached) shared by all processes as a second
+# agent cache tier, None to only use the in-process one
+AGENT_CACHE_SHARED = None
+# Attachment payloads are kept here by sha2 until their statement is saved.
+# Must be on the same filesystem as MEDIA_ROOT so they're renamed into place.
+# Payloads older than the TTL (seconds) are swept and requests are refused
+# once the spool holds more than the quota (bytes)
+ATTACHMENT_SPOOL_DIR = path.join(MEDIA_ROOT, 'attachment_spool')
+ATTACHMENT_SPOOL_TTL = 86400
+ATTACHMENT_SPOOL_QUOTA = 10 * 1024 * 1024 * 1024
+# Signed statements with x.509 certificates are verified in a pool of this many
+# processes (None for one per CPU) once a request has at least the threshold
+# number of them. Each process keeps up to JWS_KEY_CACHE_SIZE parsed keys
+JWS_VERIFY_PROCESSES = None
+JWS_VERIFY_PARALLEL_THRESHOLD = 8
+JWS_KEY_CACHE_SIZE = 1000
+# Valid IRIs and language tags remembered by each process so they're only
+# parsed once, 0 to disable
+IRI_CACHE_SIZE = 10000
+LANGUAGE_CACHE_SIZE = 1000
+# How the more URL of a statement query continues it - 'cache' stores the ids
+# of every matching statement in the cache for 24 hours, 'cursor' puts the
+# filters and the position of the last statement returned in the URL itself
+# and 'signed' does the same with a token signed with SECRET_KEY, which any
+# node accepts for STATEMENT_MORE_TOKEN_MAX_AGE seconds
+STATEMENT_MORE_MODE = 'cache'
+STATEMENT_MORE_TOKEN_MAX_AGE = 86400
+# Statement query pages are written a statement at a time, loading
+# STATEMENT_PAGE_CHUNK statements per query. Pages of at least
+# STATEMENT_STREAM_THRESHOLD statements are streamed without a Content-Length,
+# smaller ones are sent whole (None to never stream)
+STATEMENT_PAGE_CHUNK = 500
+STATEMENT_STREAM_THRESHOLD = 1000
+# Name of a cache in CACHES (e.g. memcached) to keep statements rendered in
+# the canonical and ids formats in, None to render them for every request
+STATEMENT_RENDER_CACHE = None
+# Statement queries sent with a Prefer: count=exact or count=estimated header
+# get the total number of matching statements in X-Total-Count. Estimated
+# totals are the query planner's guess, unless it's below
+# STATEMENT_COUNT_ESTIMATE_THRESHOLD where the statements are counted
+STATEMENT_COUNT_ESTIMATE_THRESHOLD = 100000
 # Fifteen second timeout to all celery tasks
 CELERYD_TASK_SOFT_TIME_LIMIT = 15
 # ActivityID resolve timeout (seconds)
 ACTIVITY_ID_RESOLVE_TIMEOUT = .2
-# Caches for /more endpoint and attachments
+# Cache for /more endpoint
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
         'LOCATION': 'cache_statement_list',
         'TIMEOUT': 86400,
     },
-    'attachment_cache': {
-        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
-        'LOCATION': 'attachment_cache',
-        'TIMEOUT': 86400,
-    },
 }
 
 # List of finder classes that know how to find static files in
@@ -16,6 +16,7 @@ def setup_lrs():
     activity_profile = 'activity_profile'
     activity_state = 'activity_state'
     statement_attachments = 'attachment_payloads'
+    attachment_spool = 'attachment_spool'
 
     # Add env packages and project to the path
     cwd = os.path.dirname(os.path.abspath(__file__))
@@ -65,6 +66,9 @@ def setup_lrs():
     if not os.path.exists(os.path.join(adldir, statement_attachments)):
         os.makedirs(os.path.join(adldir, statement_attachments))
 
+    if not os.path.exists(os.path.join(adldir, attachment_spool)):
+        os.makedirs(os.path.join(adldir, attachment_spool))
+
     # Create cache tables and sync the db
     local('./manage.py createcachetable')
     local('./manage.py migrate')
@@ -1,75 +1,135 @@
+import copy
+
 from django.db import IntegrityError
 
-from ..models import Activity
+from ..models import Activity, Agent
+from ..utils.render_cache import render_cache
+from ..utils.upsert import upsert
+
+INTERACTION_COMPONENTS = ('scale', 'choices', 'steps', 'source', 'target')
+
+# Same rules as can_define and update_language_maps for an existing activity,
+# done by the upsert. Inserted rows only carry a definition and authority when
+# the user has define permission
+CAN_DEFINE = """stored.authority_id IS NULL OR stored.authority_id = excluded.authority_id OR
+    EXISTS (SELECT 1 FROM %(member_table)s m JOIN %(agent_table)s g ON g.id = m.from_agent_id
+            WHERE m.from_agent_id = stored.authority_id AND m.to_agent_id = excluded.authority_id
+            AND (g."objectType" = 'Group' OR %(auth_is_group)s))"""
+
+CANONICAL_DATA_MERGE = """stored.canonical_data || jsonb_build_object('id', excluded.activity_id, 'objectType', 'Activity') ||
+    CASE WHEN excluded.canonical_data ? 'definition' AND (%(can_define)s)
+        THEN CASE WHEN stored.canonical_data ? 'definition'
+            THEN jsonb_build_object('definition', (stored.canonical_data -> 'definition') || jsonb_build_object(
+                'name', COALESCE(stored.canonical_data -> 'definition' -> 'name', '{}') ||
+                        COALESCE(excluded.canonical_data -> 'definition' -> 'name', '{}'),
+                'description', COALESCE(stored.canonical_data -> 'definition' -> 'description', '{}') ||
+                               COALESCE(excluded.canonical_data -> 'definition' -> 'description', '{}')))
+            ELSE jsonb_build_object('definition', excluded.canonical_data -> 'definition') END
+        ELSE '{}' END"""
+
+# An activity with no authority is taken by the first user with define
+# permission to send its definition
+AUTHORITY_MERGE = """COALESCE(stored.authority_id,
+    CASE WHEN excluded.canonical_data ? 'definition' THEN excluded.authority_id END)"""
+
+# Incoming definitions for existing activities, by whether they changed the
+# stored definition or were skipped as no-ops
+definition_updates = {'applied': 0, 'skipped': 0}
+
+
+def count_definition_update(changed):
+    definition_updates['applied' if changed else 'skipped'] += 1
+
+
+def merge_lang_map(existing, incoming):
+    # Returns the merged map, or None if incoming adds nothing to existing
+    if existing is not None and \
+            all(existing.get(lang, None) == value for lang, value in incoming.iteritems()):
+        return None
+    merged = dict(existing or {})
+    merged.update(incoming)
+    return merged
 
 
 class ActivityManager():
 
-    def __init__(self, data, auth=None, define=True):
+    def __init__(self, data, auth=None, define=True, activity=None, created=False):
         self.auth = auth
         self.define_permission = define
-        self.activity = None
-        self.populate(data)
+        self.activity = activity
+        self.authority_set = False
+        # An activity that was already looked up (bulk ingest) only gets its
+        # definition merged in memory - the caller is responsible for saving it
+        if activity is None:
+            self.populate(data)
+        else:
+            can_define = self.define_permission if created else self.can_define()
+            self.update(data, created, can_define)
 
     def update_language_maps(self, incoming_act_def):
+        # Returns whether the stored definition changed - nothing is touched
+        # if the incoming definition adds nothing to it
+        if not incoming_act_def:
+            return False
+        canonical_data = self.activity.canonical_data
         # If there was no definition in the canonical data, and there is an
         # incoming one, set it to incoming data
-        if 'definition' not in self.activity.canonical_data and incoming_act_def:
-            self.activity.canonical_data['definition'] = incoming_act_def
+        if 'definition' not in canonical_data:
+            canonical_data['definition'] = copy.deepcopy(incoming_act_def)
+            return True
         # Else there was existing canonical data, and there in an incoming one,
         # only update lang maps (name, desc, interaction activities)
-        elif 'definition' in self.activity.canonical_data and incoming_act_def:
-            if 'name' not in incoming_act_def:
-                incoming_act_def['name'] = {}
-            if 'name' not in self.activity.canonical_data['definition']:
-                self.activity.canonical_data['definition']['name'] = {}
-            if 'description' not in incoming_act_def:
-                incoming_act_def['description'] = {}
-            if 'description' not in self.activity.canonical_data['definition']:
-                self.activity.canonical_data['definition']['description'] = {}
-
-            self.activity.canonical_data['definition']['name'] = dict(self.activity.canonical_data['definition']['name'].items() +
-                                                                      incoming_act_def['name'].items())
-            self.activity.canonical_data['definition']['description'] = dict(self.activity.canonical_data['definition']['description'].items() +
-                                                                             incoming_act_def['description'].items())
-            if 'scale' in incoming_act_def and 'scale' in self.activity.canonical_data['definition']:
-                trans = {x['id']: x['description']
-                         for x in incoming_act_def['scale']}
-                for s in self.activity.canonical_data['definition']['scale']:
-                    if s['id'] in trans:
-                        s['description'] = dict(
-                            s['description'].items() + trans[s['id']].items())
-            if 'choices' in incoming_act_def and 'choices' in self.activity.canonical_data['definition']:
+        definition = canonical_data['definition']
+        changed = False
+        for lang_map in ('name', 'description'):
+            merged = merge_lang_map(definition.get(lang_map, None),
+                                    incoming_act_def.get(lang_map, {}))
+            if merged is not None:
+                definition[lang_map] = merged
+                changed = True
+        for component in INTERACTION_COMPONENTS:
+            if component in incoming_act_def and component in definition:
                 trans = {x['id']: x['description']
-                         for x in incoming_act_def['choices']}
-                for c in self.activity.canonical_data['definition']['choices']:
+                         for x in incoming_act_def[component]}
+                for c in definition[component]:
                     if c['id'] in trans:
-                        c['description'] = dict(
-                            c['description'].items() + trans[c['id']].items())
-            if 'steps' in incoming_act_def and 'steps' in self.activity.canonical_data['definition']:
-                trans = {x['id']: x['description']
-                         for x in incoming_act_def['steps']}
-                for s in self.activity.canonical_data['definition']['steps']:
-                    if s['id'] in trans:
-                        s['description'] = dict(
-                            s['description'].items() + trans[s['id']].items())
-            if 'source' in incoming_act_def and 'source' in self.activity.canonical_data['definition']:
-                trans = {x['id']: x['description']
-                         for x in incoming_act_def['source']}
-                for s in self.activity.canonical_data['definition']['source']:
-                    if s['id'] in trans:
-                        s['description'] = dict(
-                            s['description'].items() + trans[s['id']].items())
-            if 'target' in incoming_act_def and 'target' in self.activity.canonical_data['definition']:
-                trans = {x['id']: x['description']
-                         for x in incoming_act_def['target']}
-                for s in self.activity.canonical_data['definition']['target']:
-                    if s['id'] in trans:
-                        s['description'] = dict(
-                            s['description'].items() + trans[s['id']].items())
+                        merged = merge_lang_map(
+                            c['description'], trans[c['id']])
+                        if merged is not None:
+                            c['description'] = merged
+                            changed = True
+        return changed
 
     def populate(self, data):
-        activity_id = data['id']
+        incoming_act_def = data.get('definition', None)
+        # Interaction component descriptions are merged by id, which is left
+        # to update_language_maps
+        if incoming_act_def and any(c in incoming_act_def for c in INTERACTION_COMPONENTS):
+            act_created, can_define = self.retrieve(data['id'])
+            if self.update(data, act_created, can_define) or self.authority_set:
+                self.activity.save()
+        else:
+            self.upsert(data)
+
+    def upsert(self, data):
+        canonical_data = {'id': data['id'], 'objectType': 'Activity'}
+        if self.define_permission and data.get('definition', None):
+            canonical_data['definition'] = data['definition']
+        auth_is_group = self.auth is not None and self.auth.objectType == 'Group'
+        can_define = CAN_DEFINE % {'member_table': Agent.member.through._meta.db_table,
+                                   'agent_table': Agent._meta.db_table,
+                                   'auth_is_group': 'true' if auth_is_group else 'false'}
+        self.activity, created, updated = upsert(
+            Activity(activity_id=data['id'], canonical_data=canonical_data,
+                     authority=self.auth if self.define_permission else None),
+            ['activity_id'], {'canonical_data': CANONICAL_DATA_MERGE % {'can_define': can_define},
+                              'authority': AUTHORITY_MERGE})
+        if 'definition' in canonical_data and not created:
+            count_definition_update(updated)
+        if updated:
+            render_cache.invalidate_definitions()
+
+    def retrieve(self, activity_id):
         can_define = False
         # Try to get activity
         try:
@@ -98,38 +158,50 @@ class ActivityManager():
                     self.activity = Activity.objects.get(
                         activity_id=activity_id)
                     act_created = False
-            # If you retrieved an activity that has no auth but user has define
-            # permissions, user becomes authority over activity
-            if not act_created and can_define and not self.activity.authority:
-                self.activity.authority = self.auth
         # Activity already exists
         else:
-            # If activity already exists and have define
-            if self.define_permission:
-                # Act exists but it was created by someone who didn't have define permissions so it's up for grabs
-                # for first user with define permission or...
-                # Act exists - if it has same auth set it, else do nothing
-                if (not self.activity.authority) or \
-                   (self.activity.authority == self.auth) or \
-                   (self.activity.authority.objectType == 'Group' and self.auth in self.activity.authority.member.all()) or \
-                   (self.auth.objectType == 'Group' and self.activity.authority in self.auth.member.all()):
-                    can_define = True
-                else:
-                    can_define = False
-            # activity already exists but do not have define
-            else:
-                can_define = False
+            can_define = self.can_define()
+        # If you retrieved an activity that has no auth but user has define
+        # permissions, user becomes authority over activity
+        if not act_created and can_define and not self.activity.authority:
+            self.activity.authority = self.auth
+            self.authority_set = True
+        return act_created, can_define
+
+    def can_define(self):
+        # activity already exists but do not have define
+        if not self.define_permission:
+            return False
+        # Act exists but it was created by someone who didn't have define permissions so it's up for grabs
+        # for first user with define permission or...
+        # Act exists - if it has same auth set it, else do nothing
+        return (not self.activity.authority) or \
+            (self.activity.authority == self.auth) or \
+            (self.activity.authority.objectType == 'Group' and self.auth in self.activity.authority.member.all()) or \
+            (self.auth.objectType == 'Group' and self.activity.authority in self.auth.member.all())
+
+    def update(self, data, act_created, can_define):
+        # Returns whether canonical_data changed
+        canonical_data = self.activity.canonical_data
+        changed = canonical_data.get('id', None) != data['id'] or \
+            canonical_data.get('objectType', None) != 'Activity'
         # Set id and objectType regardless
-        self.activity.canonical_data['id'] = activity_id
-        self.activity.canonical_data['objectType'] = 'Activity'
+        canonical_data['id'] = data['id']
+        canonical_data['objectType'] = 'Activity'
         incoming_act_def = data.get('definition', None)
         # If activity existed, and the user has define privileges - update
         # activity
         if can_define and not act_created:
-            self.update_language_maps(incoming_act_def)
+            if incoming_act_def:
+                definition_changed = self.update_language_maps(incoming_act_def)
+                count_definition_update(definition_changed)
+                changed = changed or definition_changed
         # If activity was created and the user has define privileges
         elif can_define and act_created:
             # If there is an incoming definition
             if incoming_act_def:
-                self.activity.canonical_data['definition'] = incoming_act_def
-        self.activity.save()
+                # Copied since the merges above modify stored definitions in
+                # place and incoming_act_def is part of the saved statement
+                canonical_data['definition'] = copy.deepcopy(incoming_act_def)
+                changed = True
+        return changed
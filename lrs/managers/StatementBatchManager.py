@@ -0,0 +1,290 @@
+import copy
+from collections import OrderedDict
+
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Q
+
+from .ActivityManager import ActivityManager
+from .StatementManager import StatementManager
+from ..models import Verb, Agent, Activity, Statement, SubStatement, StatementAttachment
+from ..utils import get_agent_ifp
+from ..utils.agent_cache import agent_cache, agent_keys, ifi_key
+from ..utils.statement_index import save_index_rows
+from ..utils.verb_registry import verb_registry, needs_update, merge_canonical_data
+
+
+class StatementBatchManager():
+    # Ingests a whole batch of statements at once. Verbs, agents and activities
+    # are resolved with a few set-based queries up front, then every statement
+    # goes through the normal StatementManager which hands its rows back here
+    # so they can be written with bulk_create
+
+    def __init__(self, stmts, auth_info, payloads):
+        # Bulk ingest needs the request authority - statements without one
+        # set their own authority and go through StatementManager one by one
+        self.auth_info = auth_info
+        self.authority_data = auth_info['agent'].to_dict()
+        self.verbs = {}
+        self.agents = {}
+        self.activities = {}
+        self.statements = []
+        self.substatements = []
+        self.attachments = []
+        self.context_activities = OrderedDict()
+        self.statement_agents = []
+        self.statement_activities = []
+
+        self.collect(stmts)
+        self.resolve_verbs()
+        self.resolve_agents()
+        self.resolve_activities()
+
+        self.statement_ids = iter(self.reserve_ids(Statement, len(stmts)))
+        self.substatement_ids = iter(self.reserve_ids(
+            SubStatement, self.substatement_count))
+        self.attachment_ids = iter(self.reserve_ids(
+            StatementAttachment, self.attachment_count))
+
+        self.model_objects = [StatementManager(st, auth_info, payloads, self).model_object
+                              for st in stmts]
+        self.save()
+
+    def collect(self, stmts):
+        self.verb_data = OrderedDict()
+        self.agent_data = OrderedDict()
+        self.activity_data = OrderedDict()
+        self.substatement_count = 0
+        self.attachment_count = 0
+        for st in stmts:
+            self.collect_statement(st)
+            self.attachment_count += len(st.get('attachments', []))
+
+    def collect_statement(self, stmt):
+        verb = stmt['verb']
+        displays = self.verb_data.setdefault(verb['id'], [])
+        if 'display' in verb:
+            displays.append(verb['display'])
+
+        self.collect_agent(stmt['actor'])
+        stmt_object = stmt['object']
+        object_type = stmt_object.get('objectType', 'Activity')
+        if object_type == 'Activity':
+            self.collect_activity(stmt_object)
+        elif object_type == 'Agent' or object_type == 'Group':
+            self.collect_agent(stmt_object)
+        elif object_type == 'SubStatement':
+            self.substatement_count += 1
+            self.collect_statement(stmt_object)
+
+        context = stmt.get('context', {})
+        if 'instructor' in context:
+            self.collect_agent(context['instructor'])
+        if 'team' in context:
+            self.collect_agent(context['team'])
+        for con_acts in context.get('contextActivities', {}).values():
+            if isinstance(con_acts, dict):
+                con_acts = [con_acts]
+            for con_act in con_acts:
+                self.collect_activity(con_act)
+
+    def collect_agent(self, agent_data):
+        key = self.agent_key(agent_data)
+        # Anonymous groups are created for every occurrence
+        if key and key not in self.agent_data:
+            self.agent_data[key] = agent_data
+
+    def collect_activity(self, act_data):
+        self.activity_data.setdefault(act_data['id'], []).append(act_data)
+
+    def agent_key(self, agent_data):
+        try:
+            return ifi_key(get_agent_ifp(agent_data))
+        except IndexError:
+            return None
+
+    def bulk_create(self, model, objs):
+        # Savepoint so a concurrent insert of the same entity only fails this
+        # step instead of the whole request transaction
+        if not objs:
+            return True
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create(objs)
+        except IntegrityError:
+            return False
+        return True
+
+    def reserve_ids(self, model, count):
+        # bulk_create does not return primary keys, so take them from the
+        # table's sequence beforehand and set them explicitly
+        if not count:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                           [model._meta.db_table, count])
+            return [row[0] for row in cursor.fetchall()]
+
+    def resolve_verbs(self):
+        # Verbs already known to this process with nothing new in their
+        # display need no query at all
+        pending = OrderedDict()
+        for verb_id, displays in self.verb_data.items():
+            verb_object = verb_registry.cached(verb_id, displays)
+            if verb_object:
+                self.verbs[verb_id] = verb_object
+            else:
+                pending[verb_id] = displays
+        if not pending:
+            return
+
+        existing = {v.verb_id: v for v in Verb.objects.filter(
+            verb_id__in=pending.keys())}
+        new_verbs = []
+        for verb_id, displays in pending.items():
+            verb_object = existing.get(verb_id, None)
+            if verb_object is None:
+                new_verbs.append(Verb(verb_id=verb_id, canonical_data=merge_canonical_data(
+                    {}, verb_id, displays)))
+                continue
+            changed = needs_update(verb_object.canonical_data, verb_id, displays)
+            if changed:
+                verb_object.canonical_data = merge_canonical_data(
+                    verb_object.canonical_data, verb_id, displays)
+                verb_object.save()
+            verb_registry.register(verb_object, changed)
+            self.verbs[verb_id] = verb_object
+
+        if new_verbs:
+            if self.bulk_create(Verb, new_verbs):
+                for verb_object in Verb.objects.filter(verb_id__in=[v.verb_id for v in new_verbs]):
+                    verb_registry.register(verb_object)
+                    self.verbs[verb_object.verb_id] = verb_object
+            else:
+                for new_verb in new_verbs:
+                    self.verbs[new_verb.verb_id] = verb_registry.get(
+                        new_verb.canonical_data)
+
+    def lookup_agents(self, keys):
+        ifiQ = Q()
+        for key in keys:
+            ifiQ = ifiQ | Q(**dict(key))
+        for agent in Agent.objects.filter(ifiQ):
+            for key in agent_keys(agent):
+                self.agents[key] = agent
+            agent_cache.add(agent)
+
+    def resolve_agents(self):
+        pending = []
+        for key in self.agent_data:
+            agent = agent_cache.get(Agent, dict(key))
+            if agent is None:
+                pending.append(key)
+            else:
+                self.agents[key] = agent
+        if not pending:
+            return
+        self.lookup_agents(pending)
+        missing = [k for k in pending if k not in self.agents]
+        new_agents = []
+        for key in missing:
+            agent_data = self.agent_data[key]
+            # Identified groups also need their members created
+            if 'member' in agent_data:
+                self.agents[key] = Agent.objects.retrieve_or_create(
+                    **agent_data)[0]
+                continue
+            kwargs = dict(agent_data)
+            if 'account' in kwargs:
+                kwargs['account_homePage'] = kwargs['account']['homePage']
+                kwargs['account_name'] = kwargs['account']['name']
+                del kwargs['account']
+            new_agents.append((key, Agent(**kwargs)))
+
+        if new_agents:
+            if self.bulk_create(Agent, [a for k, a in new_agents]):
+                self.lookup_agents([k for k, a in new_agents])
+            else:
+                for key, agent in new_agents:
+                    self.agents[key] = Agent.objects.retrieve_or_create(
+                        **self.agent_data[key])[0]
+
+    def get_agent(self, agent_data):
+        key = self.agent_key(agent_data)
+        if key is None:
+            return Agent.objects.retrieve_or_create(**agent_data)[0]
+        return self.agents[key]
+
+    def resolve_activities(self):
+        if not self.activity_data:
+            return
+        auth = self.auth_info['agent']
+        define = self.auth_info['define']
+        existing = {a.activity_id: a for a in Activity.objects.select_related('authority')
+                    .filter(activity_id__in=self.activity_data.keys())}
+        new_activities = []
+        for activity_id, occurrences in self.activity_data.items():
+            activity = existing.get(activity_id, None)
+            created = activity is None
+            if created:
+                activity = Activity(
+                    activity_id=activity_id, authority=auth if define else None)
+            original = activity.canonical_data
+            activity.canonical_data = copy.deepcopy(original)
+            # Merge every occurrence in statement order, only the first one
+            # for a new activity counts as the creating one
+            for act_data in occurrences:
+                ActivityManager(act_data, auth=auth, define=define,
+                                activity=activity, created=created)
+                created = False
+            if activity.pk is None:
+                new_activities.append(activity)
+            elif activity.canonical_data != original:
+                activity.save()
+            self.activities[activity_id] = activity
+
+        if new_activities:
+            if self.bulk_create(Activity, new_activities):
+                ids = dict(Activity.objects.filter(activity_id__in=[a.activity_id for a in new_activities])
+                           .values_list('activity_id', 'id'))
+                for activity in new_activities:
+                    activity.pk = ids[activity.activity_id]
+            else:
+                for activity in new_activities:
+                    for act_data in self.activity_data[activity.activity_id]:
+                        self.activities[activity.activity_id] = ActivityManager(
+                            act_data, auth=auth, define=define).activity
+
+    def add_substatement(self, stmt_data):
+        sub = SubStatement(id=next(self.substatement_ids), **stmt_data)
+        self.substatements.append(sub)
+        return sub
+
+    def add_statement(self, stmt_data):
+        stmt = Statement(id=next(self.statement_ids), **stmt_data)
+        self.statements.append(stmt)
+        return stmt
+
+    def add_context_activity(self, stmt, con_act_type, activity):
+        through = getattr(stmt.__class__, 'context_ca_%s' % con_act_type).through
+        rows = self.context_activities.setdefault(through, OrderedDict())
+        # Same as m2m add(), an activity is only linked once per type
+        key = (stmt.pk, activity.pk)
+        if key not in rows:
+            rows[key] = through(**{'%s_id' % stmt._meta.model_name: stmt.pk,
+                                   'activity_id': activity.pk})
+
+    def add_index_rows(self, agents, activities):
+        self.statement_agents.extend(agents)
+        self.statement_activities.extend(activities)
+
+    def add_attachment(self, attachment):
+        attachment.id = next(self.attachment_ids)
+        self.attachments.append(attachment)
+
+    def save(self):
+        SubStatement.objects.bulk_create(self.substatements)
+        Statement.objects.bulk_create(self.statements)
+        save_index_rows(self.statement_agents, self.statement_activities)
+        for through, rows in self.context_activities.items():
+            through.objects.bulk_create(rows.values())
+        StatementAttachment.objects.bulk_create(self.attachments)
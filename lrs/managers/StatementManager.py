@@ -1,63 +1,88 @@
-from django.core.files.base import ContentFile
 import uuid
 
-from django.core.cache import caches
-
 from .ActivityManager import ActivityManager
-from ..models import Verb, Statement, StatementAttachment, SubStatement, Agent
+from ..models import Statement, StatementAttachment, SubStatement, Agent
 from ..utils import convert_to_datetime_object
+from ..utils.statement_index import agent_rows, activity_rows, save_index_rows, SUBSTATEMENT_PREFIX
+from ..utils.verb_registry import verb_registry
+
 
-att_cache = caches['attachment_cache']
+def build_full_statement(stmt_data, authority_data):
+    # Only the top level is copied - nested data is shared with stmt_data,
+    # which is never modified
+    if authority_data is None:
+        return stmt_data
+    full_statement = dict(stmt_data)
+    full_statement['authority'] = authority_data
+    return full_statement
 
 
 class StatementManager():
 
-    def __init__(self, stmt_data, auth_info, payload_sha2s):
+    def __init__(self, stmt_data, auth_info, payloads, batch=None):
         # auth_info contains define, endpoint, user, and request authority
+        # batch is the StatementBatchManager when the statement is part of a
+        # bulk ingest - entities come from it and rows are saved by it
+        # stmt_data is only read, the model fields are collected in fields
+        self.batch = batch
+        self.fields = {}
+        # (relation, activity id) pairs for the statement activity index
+        self.activity_relations = []
         if self.__class__.__name__ == 'StatementManager':
             # Full statement is for a statement only, same with authority
             self.set_authority(auth_info, stmt_data)
-        self.populate(auth_info, stmt_data, payload_sha2s)
+        self.populate(auth_info, stmt_data, payloads)
 
     def set_authority(self, auth_info, stmt_data):
         # Could still have no authority in stmt if HTTP_AUTH and OAUTH are disabled
-        # Have to set auth in kwarg dict for Agent auth object to be saved in statement
-        # Also have to save auth in full_statement kwargs for when returning exact statements
+        # Have to set auth in fields for Agent auth object to be saved in statement
+        # Also have to save auth in full_statement for when returning exact statements
         # Set object auth as well for when creating other objects in a
         # substatement
+        authority_data = None
         if auth_info['agent']:
-            stmt_data['authority'] = auth_info['agent']
-            stmt_data['full_statement'][
-                'authority'] = auth_info['agent'].to_dict()
+            self.fields['authority'] = auth_info['agent']
+            if self.batch:
+                authority_data = self.batch.authority_data
+            else:
+                authority_data = auth_info['agent'].to_dict()
         # If no auth in request, look in statement
         else:
             # If authority is given in statement
             if 'authority' in stmt_data:
-                auth_info['agent'] = stmt_data['authority'] = Agent.objects.retrieve_or_create(
-                    **stmt_data['full_statement']['authority'])[0]
+                auth_info['agent'] = self.fields['authority'] = Agent.objects.retrieve_or_create(
+                    **stmt_data['authority'])[0]
             # Empty auth in request or statement
             else:
                 auth_info['agent'] = None
+        self.fields['full_statement'] = build_full_statement(
+            stmt_data, authority_data)
+
+    def get_agent(self, agent_data):
+        if self.batch:
+            return self.batch.get_agent(agent_data)
+        return Agent.objects.retrieve_or_create(**agent_data)[0]
+
+    def get_activity(self, auth_info, act_data):
+        if self.batch:
+            return self.batch.activities[act_data['id']]
+        return ActivityManager(act_data, auth=auth_info['agent'],
+                               define=auth_info['define']).activity
 
     def build_context_activities(self, stmt, auth_info, con_act_data):
         for con_act_group in con_act_data.items():
             # Incoming contextActivities can either be a list or dict
             if isinstance(con_act_group[1], list):
-                for con_act in con_act_group[1]:
-                    act = ActivityManager(con_act, auth=auth_info[
-                                          'agent'], define=auth_info['define']).activity
-                    if con_act_group[0] == 'parent':
-                        stmt.context_ca_parent.add(act)
-                    elif con_act_group[0] == 'grouping':
-                        stmt.context_ca_grouping.add(act)
-                    elif con_act_group[0] == 'category':
-                        stmt.context_ca_category.add(act)
-                    else:
-                        stmt.context_ca_other.add(act)
+                con_acts = con_act_group[1]
             else:
-                act = ActivityManager(con_act_group[1], auth=auth_info[
-                                      'agent'], define=auth_info['define']).activity
-                if con_act_group[0] == 'parent':
+                con_acts = [con_act_group[1]]
+            for con_act in con_acts:
+                act = self.get_activity(auth_info, con_act)
+                self.activity_relations.append((con_act_group[0], act.pk))
+                if self.batch:
+                    self.batch.add_context_activity(
+                        stmt, con_act_group[0], act)
+                elif con_act_group[0] == 'parent':
                     stmt.context_ca_parent.add(act)
                 elif con_act_group[0] == 'grouping':
                     stmt.context_ca_grouping.add(act)
@@ -65,143 +90,144 @@ class StatementManager():
                     stmt.context_ca_category.add(act)
                 else:
                     stmt.context_ca_other.add(act)
-        stmt.save()
+        if not self.batch:
+            stmt.save()
 
     def build_substatement(self, auth_info, stmt_data):
-        # Pop off any context activities
-        con_act_data = stmt_data.pop('context_contextActivities', {})
-        # Delete objectType since it is not a field in the model
-        del stmt_data['objectType']
-        sub = SubStatement.objects.create(**stmt_data)
+        if self.batch:
+            sub = self.batch.add_substatement(self.fields)
+        else:
+            sub = SubStatement.objects.create(**self.fields)
+        con_act_data = stmt_data.get('context', {}).get('contextActivities', {})
         if con_act_data:
             self.build_context_activities(sub, auth_info, con_act_data)
         return sub
 
     def build_statement(self, auth_info, stmt_data):
-        stmt_data['stored'] = convert_to_datetime_object(stmt_data['stored'])
-        # Pop off any context activities
-        con_act_data = stmt_data.pop('context_contextActivities', {})
-        stmt_data['user'] = auth_info['user']
+        self.fields['stored'] = convert_to_datetime_object(stmt_data['stored'])
+        self.fields['user'] = auth_info['user']
         # Name of id field in models is statement_id
-        if 'id' in stmt_data:
-            stmt_data['statement_id'] = stmt_data['id']
-            del stmt_data['id']
+        self.fields['statement_id'] = stmt_data['id']
+        self.fields['version'] = stmt_data['version']
         # Try to create statement
-        stmt = Statement.objects.create(**stmt_data)
+        if self.batch:
+            stmt = self.batch.add_statement(self.fields)
+        else:
+            stmt = Statement.objects.create(**self.fields)
+        con_act_data = stmt_data.get('context', {}).get('contextActivities', {})
         if con_act_data:
             self.build_context_activities(stmt, auth_info, con_act_data)
+        self.build_index(stmt)
         return stmt
 
+    def build_index(self, stmt):
+        agents = agent_rows(stmt)
+        activities = activity_rows(stmt, self.activity_relations)
+        if self.batch:
+            self.batch.add_index_rows(agents, activities)
+        else:
+            save_index_rows(agents, activities)
+
     def build_result(self, stmt_data):
         if 'result' in stmt_data:
-            result = stmt_data['result']
-            for k, v in result.iteritems():
-                stmt_data['result_' + k] = v
-            if 'result_score' in stmt_data:
-                for k, v in stmt_data['result_score'].iteritems():
-                    stmt_data['result_score_' + k] = v
-                del stmt_data['result']['score']
-                del stmt_data['result_score']
-            del stmt_data['result']
-
-    def build_attachments(self, user_info, attachment_data, payload_sha2s):
+            for k, v in stmt_data['result'].iteritems():
+                if k == 'score':
+                    for score_k, score_v in v.iteritems():
+                        self.fields['result_score_' + score_k] = score_v
+                else:
+                    self.fields['result_' + k] = v
+
+    def build_attachments(self, user_info, attachment_data, payloads):
         # Iterate through each attachment
         for attach in attachment_data:
             sha2 = attach.get('sha2', None)
-            attachment = StatementAttachment.objects.create(
-                canonical_data=attach)
+            if self.batch:
+                attachment = StatementAttachment(canonical_data=attach)
+            else:
+                attachment = StatementAttachment.objects.create(
+                    canonical_data=attach)
             if sha2:
-                if payload_sha2s and sha2 in payload_sha2s:
-                    raw_payload = att_cache.get(sha2)
-                    try:
-                        payload = ContentFile(raw_payload)
-                    except Exception as e:
-                        raise e
-                    attachment.payload.save(sha2, payload)
+                if payloads and sha2 in payloads:
+                    # The spooled file is moved into storage, not read back
+                    # into memory. Storage keeps the first file saved under
+                    # a sha2 so a payload used twice is only moved once
+                    attachment.payload.save(
+                        sha2, payloads[sha2], save=not self.batch)
             attachment.statement = self.model_object
-            attachment.save()
+            if self.batch:
+                self.batch.add_attachment(attachment)
+            else:
+                attachment.save()
 
     def build_context(self, stmt_data):
         if 'context' in stmt_data:
-            context = stmt_data['context']
-            for k, v in context.iteritems():
-                stmt_data['context_' + k] = v
-            if 'context_instructor' in stmt_data:
-                stmt_data['context_instructor'] = Agent.objects.retrieve_or_create(
-                    **stmt_data['context_instructor'])[0]
-            if 'context_team' in stmt_data:
-                stmt_data['context_team'] = Agent.objects.retrieve_or_create(
-                    **stmt_data['context_team'])[0]
-            if 'context_statement' in stmt_data:
-                stmt_data['context_statement'] = stmt_data[
-                    'context_statement']['id']
-            del stmt_data['context']
+            for k, v in stmt_data['context'].iteritems():
+                # Context activities are added once the row exists
+                if k == 'contextActivities':
+                    continue
+                if k == 'instructor' or k == 'team':
+                    v = self.get_agent(v)
+                elif k == 'statement':
+                    v = v['id']
+                self.fields['context_' + k] = v
 
     def build_verb(self, stmt_data):
         incoming_verb = stmt_data['verb']
-        verb_id = incoming_verb['id']
-        # Get or create the verb
-        verb_object, created = Verb.objects.get_or_create(verb_id=verb_id)
-        # If existing, get existing keys
-        existing_lang_maps = {}
-        if not created:
-            if 'display' in verb_object.canonical_data:
-                existing_lang_maps = verb_object.canonical_data['display']
-
-        # Save verb displays
-        if 'display' in incoming_verb:
-            verb_object.canonical_data['display'] = dict(
-                existing_lang_maps.items() + incoming_verb['display'].items())
-
-        verb_object.canonical_data['id'] = verb_id
-        verb_object.save()
-        stmt_data['verb'] = verb_object
+        if self.batch:
+            self.fields['verb'] = self.batch.verbs[incoming_verb['id']]
+        else:
+            # Only writes when the incoming display adds something new
+            self.fields['verb'] = verb_registry.get(incoming_verb)
 
     def build_statement_object(self, auth_info, stmt_data):
         statement_object_data = stmt_data['object']
         valid_agent_objects = ['Agent', 'Group']
         # If not specified, the object is assumed to be an activity
-        if 'objectType' not in statement_object_data or statement_object_data['objectType'] == 'Activity':
-            statement_object_data['objectType'] = 'Activity'
-            stmt_data['object_activity'] = ActivityManager(statement_object_data, auth=auth_info['agent'],
-                                                           define=auth_info['define']).activity
-        elif statement_object_data['objectType'] in valid_agent_objects:
-            stmt_data['object_agent'] = Agent.objects.retrieve_or_create(
-                **statement_object_data)[0]
-        elif statement_object_data['objectType'] == 'SubStatement':
-            stmt_data['object_substatement'] = SubStatementManager(
-                statement_object_data, auth_info).model_object
-        elif statement_object_data['objectType'] == 'StatementRef':
-            stmt_data['object_statementref'] = uuid.UUID(
+        object_type = statement_object_data.get('objectType', 'Activity')
+        if object_type == 'Activity':
+            self.fields['object_activity'] = self.get_activity(
+                auth_info, statement_object_data)
+            self.activity_relations.append(
+                ('object', self.fields['object_activity'].pk))
+        elif object_type in valid_agent_objects:
+            self.fields['object_agent'] = self.get_agent(
+                statement_object_data)
+        elif object_type == 'SubStatement':
+            sub_manager = SubStatementManager(
+                statement_object_data, auth_info, self.batch)
+            self.fields['object_substatement'] = sub_manager.model_object
+            # The substatement's activities are indexed with the statement
+            self.activity_relations.extend((SUBSTATEMENT_PREFIX + relation, activity_id)
+                                           for relation, activity_id in sub_manager.activity_relations)
+        elif object_type == 'StatementRef':
+            self.fields['object_statementref'] = uuid.UUID(
                 statement_object_data['id'])
-        del stmt_data['object']
 
-    def populate(self, auth_info, stmt_data, payload_sha2s):
+    def populate(self, auth_info, stmt_data, payloads):
         if self.__class__.__name__ == 'StatementManager':
-            stmt_data['voided'] = False
+            self.fields['voided'] = False
 
         self.build_verb(stmt_data)
         self.build_statement_object(auth_info, stmt_data)
-        stmt_data['actor'] = Agent.objects.retrieve_or_create(
-            **stmt_data['actor'])[0]
+        self.fields['actor'] = self.get_agent(stmt_data['actor'])
         self.build_context(stmt_data)
         self.build_result(stmt_data)
         # Substatement could not have timestamp
         if 'timestamp' in stmt_data:
-            stmt_data['timestamp'] = convert_to_datetime_object(stmt_data[
-                                                                'timestamp'])
-        attachment_data = stmt_data.pop('attachments', None)
+            self.fields['timestamp'] = convert_to_datetime_object(
+                stmt_data['timestamp'])
 
         if self.__class__.__name__ == 'StatementManager':
             # Save statement/substatement
             self.model_object = self.build_statement(auth_info, stmt_data)
         else:
             self.model_object = self.build_substatement(auth_info, stmt_data)
+        attachment_data = stmt_data.get('attachments', None)
         if attachment_data:
-            self.build_attachments(auth_info, attachment_data, payload_sha2s)
+            self.build_attachments(auth_info, attachment_data, payloads)
 
 
 class SubStatementManager(StatementManager):
 
-    def __init__(self, substmt_data, auth_info):
-        StatementManager.__init__(self, substmt_data, auth_info, None)
+    def __init__(self, substmt_data, auth_info, batch=None):
+        StatementManager.__init__(self, substmt_data, auth_info, None, batch)
@@ -4,7 +4,7 @@ import uuid
 from collections import OrderedDict
 
 from django.db import models, IntegrityError
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
 from django.core.files.storage import FileSystemStorage
@@ -13,7 +13,11 @@ from django.utils import timezone
 from oauth_provider.consts import MAX_URL_LENGTH
 
 from .exceptions import BadRequest
-from .utils import get_lang
+from .utils.agent_cache import agent_cache
+from .utils.render import render_agent, render_verb, render_activity, render_attachment, \
+    render_result, render_context, CONTEXT_ACTIVITY_TYPES
+from .utils.render_cache import render_cache
+from .utils.upsert import upsert
 
 AGENT_PROFILE_UPLOAD_TO = "agent_profile"
 ACTIVITY_STATE_UPLOAD_TO = "activity_state"
@@ -39,12 +43,7 @@ class Verb(models.Model):
     canonical_data = JSONField(default=dict)
 
     def return_verb_with_lang(self, lang=None, ids_only=False):
-        if ids_only:
-            return {'id': self.verb_id}
-        ret = OrderedDict(self.canonical_data)
-        if 'display' in ret and ret['display'].items():
-            ret['display'] = get_lang(self.canonical_data['display'], lang)
-        return ret
+        return render_verb(self.verb_id, self.canonical_data, lang, ids_only)
 
     def get_a_name(self):
         if 'display' in self.canonical_data:
@@ -55,6 +54,14 @@ class Verb(models.Model):
         return json.dumps(self.canonical_data, sort_keys=False)
 
 
+# Statements are rendered with their verbs' and activities' definitions, a
+# change to any of them drops every rendered statement
+def invalidate_rendered_statements(sender, **kwargs):
+    if not kwargs["created"]:
+        render_cache.invalidate_definitions()
+post_save.connect(invalidate_rendered_statements, sender=Verb)
+
+
 class AgentManager(models.Manager):
 
     def retrieve(self, **kwargs):
@@ -74,14 +81,21 @@ class AgentManager(models.Manager):
                 # Set ifp_dict and kwargs
                 ifp_dict['account_homePage'] = kwargs['account']['homePage']
                 ifp_dict['account_name'] = kwargs['account']['name']
+            return self.retrieve_by_ifp(ifp_dict)
+        else:
+            return None
+
+    def retrieve_by_ifp(self, ifp_dict):
+        # Check the IFI cache before querying, agents read from the database
+        # are cached once the transaction commits
+        agent = agent_cache.get(Agent, ifp_dict)
+        if agent is None:
             try:
-                # Try getting agent by IFP in ifp_dict
                 agent = Agent.objects.filter(**ifp_dict)[0]
-                return agent
             except IndexError:
                 return None
-        else:
-            return None
+            agent_cache.add(agent)
+        return agent
 
     def retrieve_or_create(self, **kwargs):
         agent_ifps_can_only_be_one = [
@@ -111,20 +125,15 @@ class AgentManager(models.Manager):
                 ifp_dict['account_name'] = kwargs['account']['name']
                 kwargs['account_name'] = kwargs['account']['name']
                 del kwargs['account']
-            try:
-                # Try getting agent by IFP in ifp_dict
-                agent = Agent.objects.filter(**ifp_dict)[0]
-                created = False
-            except IndexError:
-                # If DNE create the agent based off of kwargs (kwargs now
-                # includes account_homePage and account_name fields)
-                try:
-                    agent = Agent.objects.create(**kwargs)
-                    created = True
-                except IntegrityError, ValidationError:
-                    # Try getting agent by IFP in ifp_dict
-                    agent = Agent.objects.filter(**ifp_dict)[0]
-                    created = False
+            # Try getting agent by IFP in ifp_dict from the cache, else get
+            # it or create it based off of kwargs in one query (kwargs now
+            # includes account_homePage and account_name fields)
+            agent = agent_cache.get(Agent, ifp_dict)
+            created = False
+            from_db = agent is None
+            if from_db:
+                agent, created, updated = upsert(
+                    Agent(**kwargs), ifp_dict.keys())
 
             # For identified groups with members
             if is_group and has_member:
@@ -134,6 +143,9 @@ class AgentManager(models.Manager):
                     members = [self.retrieve_or_create(**a) for a in member]
                     agent.member.add(*(a for a, c in members))
                     agent.save()
+            # Cached once the members above are saved
+            if from_db:
+                agent_cache.add(agent)
         # Only way it doesn't have IFP is if anonymous group
         else:
             agent, created = self.retrieve_or_create_anonymous_group(
@@ -191,11 +203,11 @@ class AgentManager(models.Manager):
         return agent, created
 
     def oauth_group(self, **kwargs):
-        try:
-            g = Agent.objects.get(oauth_identifier=kwargs['oauth_identifier'])
+        g = self.retrieve_by_ifp(
+            {'oauth_identifier': kwargs['oauth_identifier']})
+        if g is not None:
             return g, False
-        except Agent.DoesNotExist:
-            return Agent.objects.retrieve_or_create(**kwargs)
+        return Agent.objects.retrieve_or_create(**kwargs)
 
 
 class Agent(models.Model):
@@ -219,30 +231,8 @@ class Agent(models.Model):
         unique_together = ("account_homePage", "account_name")
 
     def to_dict(self, ids_only=False):
-        ret = OrderedDict()
-        if self.mbox:
-            ret['mbox'] = self.mbox
-        if self.mbox_sha1sum:
-            ret['mbox_sha1sum'] = self.mbox_sha1sum
-        if self.openid:
-            ret['openid'] = self.openid
-        if self.account_name:
-            ret['account'] = OrderedDict()
-            ret['account']['name'] = self.account_name
-            ret['account']['homePage'] = self.account_homePage
-        if self.objectType == 'Group':
-            ret['objectType'] = self.objectType
-            # show members for groups if ids_only is false
-            # show members' ids for anon groups if ids_only is true
-            if not ids_only or not (set(['mbox', 'mbox_sha1sum', 'openid', 'account']) & set(ret.keys())):
-                if self.member.all():
-                    ret['member'] = [a.to_dict(ids_only)
-                                     for a in self.member.all()]
-
-        ret['objectType'] = self.objectType
-        if self.name and not ids_only:
-            ret['name'] = self.name
-        return ret
+        return render_agent(vars(self), ids_only,
+                            (a.to_dict(ids_only) for a in self.member.all()))
 
     # Used only for /agent GET endpoint (check spec)
     def to_dict_person(self):
@@ -292,6 +282,30 @@ class Agent(models.Model):
         return json.dumps(self.to_dict(), sort_keys=False)
 
 
+# Keep the agent IFI cache in line with the agent table
+def invalidate_agent(sender, **kwargs):
+    agent_cache.invalidate(kwargs["instance"])
+post_save.connect(invalidate_agent, sender=Agent)
+post_delete.connect(invalidate_agent, sender=Agent)
+
+
+# Members aren't part of the cached row, but drop a group whose membership
+# changes so nothing holds on to a row read before the change
+def invalidate_agent_members(sender, **kwargs):
+    if kwargs["action"] in ("post_add", "post_remove", "pre_clear"):
+        agent_cache.invalidate(kwargs["instance"])
+m2m_changed.connect(invalidate_agent_members, sender=Agent.member.through)
+
+
+# Deleting a user nulls its agent's user_id without a save()
+def invalidate_user_agent(sender, **kwargs):
+    try:
+        agent_cache.invalidate(kwargs["instance"].agent)
+    except Agent.DoesNotExist:
+        pass
+pre_delete.connect(invalidate_user_agent, sender=User)
+
+
 class Activity(models.Model):
     activity_id = models.CharField(
         max_length=MAX_URL_LENGTH, db_index=True, unique=True)
@@ -299,38 +313,7 @@ class Activity(models.Model):
     authority = models.ForeignKey(Agent, null=True)
 
     def return_activity_with_lang_format(self, lang=None, ids_only=False):
-        if ids_only:
-            return {'id': self.activity_id}
-        ret = self.canonical_data
-        if 'objectType' not in self.canonical_data:
-            ret['objectType'] = 'Activity'
-        if 'definition' in self.canonical_data:
-            if 'name' in ret['definition'] and ret['definition']['name'].items():
-                ret['definition']['name'] = get_lang(
-                    ret['definition']['name'], lang)
-            if 'description' in ret['definition'] and ret['definition']['description'].items():
-                ret['definition']['description'] = get_lang(
-                    ret['definition']['description'], lang)
-            if 'scale' in ret['definition']:
-                for s in ret['definition']['scale']:
-                    if s.items():
-                        s['description'] = get_lang(s['description'], lang)
-            if 'choices' in ret['definition']:
-                for c in ret['definition']['choices']:
-                    if c.items():
-                        c['description'] = get_lang(c['description'], lang)
-            if 'steps' in ret['definition']:
-                for st in ret['definition']['steps']:
-                    if st.items:
-                        st['description'] = get_lang(st['description'], lang)
-            if 'source' in ret['definition']:
-                for so in ret['definition']['source']:
-                    if so.items:
-                        so['description'] = get_lang(so['description'], lang)
-                for t in ret['definition']['target']:
-                    if t.items():
-                        t['description'] = get_lang(t['description'], lang)
-        return ret
+        return render_activity(self.activity_id, self.canonical_data, lang, ids_only)
 
     def get_a_name(self):
         if 'definition' in self.canonical_data:
@@ -341,6 +324,21 @@ class Activity(models.Model):
     def __unicode__(self):
         return json.dumps(self.canonical_data, sort_keys=False)
 
+post_save.connect(invalidate_rendered_statements, sender=Activity)
+
+
+def stmt_context(stmt, lang, ids_only):
+    # The context of a Statement or SubStatement
+    instructor = team = None
+    if stmt.context_instructor_id is not None:
+        instructor = stmt.context_instructor.to_dict(ids_only)
+    if stmt.context_team_id is not None:
+        team = stmt.context_team.to_dict(ids_only)
+    context_activities = {con_act_type: [act.return_activity_with_lang_format(lang, ids_only) for act in
+                                         getattr(stmt, 'context_ca_%s' % con_act_type).all()]
+                          for con_act_type in CONTEXT_ACTIVITY_TYPES}
+    return render_context(vars(stmt), instructor, team, context_activities)
+
 
 class SubStatement(models.Model):
     object_agent = models.ForeignKey(
@@ -397,71 +395,12 @@ class SubStatement(models.Model):
             ret['object'] = {
                 'id': str(self.object_statementref), 'objectType': 'StatementRef'}
 
-        ret['result'] = OrderedDict()
-        if self.result_success is not None:
-            ret['result']['success'] = self.result_success
-        if self.result_completion is not None:
-            ret['result']['completion'] = self.result_completion
-        if self.result_response:
-            ret['result']['response'] = self.result_response
-        if self.result_duration:
-            ret['result']['duration'] = self.result_duration
-
-        ret['result']['score'] = OrderedDict()
-        if self.result_score_scaled is not None:
-            ret['result']['score']['scaled'] = self.result_score_scaled
-        if self.result_score_raw is not None:
-            ret['result']['score']['raw'] = self.result_score_raw
-        if self.result_score_min is not None:
-            ret['result']['score']['min'] = self.result_score_min
-        if self.result_score_max is not None:
-            ret['result']['score']['max'] = self.result_score_max
-        # If there is no score, delete from dict
-        if not ret['result']['score']:
-            del ret['result']['score']
-        if self.result_extensions:
-            ret['result']['extensions'] = self.result_extensions
-        # If no result, delete from dict
-        if not ret['result']:
-            del ret['result']
-
-        ret['context'] = OrderedDict()
-        if self.context_registration:
-            ret['context']['registration'] = self.context_registration
-        if self.context_instructor:
-            ret['context'][
-                'instructor'] = self.context_instructor.to_dict(ids_only)
-        if self.context_team:
-            ret['context']['team'] = self.context_team.to_dict(ids_only)
-        if self.context_revision:
-            ret['context']['revision'] = self.context_revision
-        if self.context_platform:
-            ret['context']['platform'] = self.context_platform
-        if self.context_language:
-            ret['context']['language'] = self.context_language
-        if self.context_statement:
-            ret['context']['statement'] = {
-                'id': self.context_statement, 'objectType': 'StatementRef'}
-
-        ret['context']['contextActivities'] = OrderedDict()
-        if self.context_ca_parent.all():
-            ret['context']['contextActivities']['parent'] = [cap.return_activity_with_lang_format(
-                lang, ids_only) for cap in self.context_ca_parent.all()]
-        if self.context_ca_grouping.all():
-            ret['context']['contextActivities']['grouping'] = [cag.return_activity_with_lang_format(
-                lang, ids_only) for cag in self.context_ca_grouping.all()]
-        if self.context_ca_category.all():
-            ret['context']['contextActivities']['category'] = [cac.return_activity_with_lang_format(
-                lang, ids_only) for cac in self.context_ca_category.all()]
-        if self.context_ca_other.all():
-            ret['context']['contextActivities']['other'] = [cao.return_activity_with_lang_format(
-                lang, ids_only) for cao in self.context_ca_other.all()]
-        if self.context_extensions:
-            ret['context']['extensions'] = self.context_extensions
-        if not ret['context']['contextActivities']:
-            del ret['context']['contextActivities']
-        if not ret['context']:
-            del ret['context']
+        result = render_result(vars(self))
+        if result:
+            ret['result'] = result
+        context = stmt_context(self, lang, ids_only)
+        if context:
+            ret['context'] = context
 
         if self.timestamp:
             ret['timestamp'] = self.timestamp.isoformat()
@@ -566,79 +505,21 @@ class Statement(models.Model):
             ret['object'] = {
                 'id': str(self.object_statementref), 'objectType': 'StatementRef'}
 
-        ret['result'] = OrderedDict()
-        if self.result_success is not None:
-            ret['result']['success'] = self.result_success
-        if self.result_completion is not None:
-            ret['result']['completion'] = self.result_completion
-        if self.result_response:
-            ret['result']['response'] = self.result_response
-        if self.result_duration:
-            ret['result']['duration'] = self.result_duration
-
-        ret['result']['score'] = OrderedDict()
-        if self.result_score_scaled is not None:
-            ret['result']['score']['scaled'] = self.result_score_scaled
-        if self.result_score_raw is not None:
-            ret['result']['score']['raw'] = self.result_score_raw
-        if self.result_score_min is not None:
-            ret['result']['score']['min'] = self.result_score_min
-        if self.result_score_max is not None:
-            ret['result']['score']['max'] = self.result_score_max
-        # If there is no score, delete from dict
-        if not ret['result']['score']:
-            del ret['result']['score']
-        if self.result_extensions:
-            ret['result']['extensions'] = self.result_extensions
-        if not ret['result']:
-            del ret['result']
-
-        ret['context'] = OrderedDict()
-        if self.context_registration:
-            ret['context']['registration'] = self.context_registration
-        if self.context_instructor:
-            ret['context'][
-                'instructor'] = self.context_instructor.to_dict(ids_only)
-        if self.context_team:
-            ret['context']['team'] = self.context_team.to_dict(ids_only)
-        if self.context_revision:
-            ret['context']['revision'] = self.context_revision
-        if self.context_platform:
-            ret['context']['platform'] = self.context_platform
-        if self.context_language:
-            ret['context']['language'] = self.context_language
-        if self.context_statement:
-            ret['context']['statement'] = {
-                'id': self.context_statement, 'objectType': 'StatementRef'}
-
-        ret['context']['contextActivities'] = OrderedDict()
-        if self.context_ca_parent.all():
-            ret['context']['contextActivities']['parent'] = [cap.return_activity_with_lang_format(
-                lang, ids_only) for cap in self.context_ca_parent.all()]
-        if self.context_ca_grouping.all():
-            ret['context']['contextActivities']['grouping'] = [cag.return_activity_with_lang_format(
-                lang, ids_only) for cag in self.context_ca_grouping.all()]
-        if self.context_ca_category.all():
-            ret['context']['contextActivities']['category'] = [cac.return_activity_with_lang_format(
-                lang, ids_only) for cac in self.context_ca_category.all()]
-        if self.context_ca_other.all():
-            ret['context']['contextActivities']['other'] = [cao.return_activity_with_lang_format(
-                lang, ids_only) for cao in self.context_ca_other.all()]
-        if self.context_extensions:
-            ret['context']['extensions'] = self.context_extensions
-        if not ret['context']['contextActivities']:
-            del ret['context']['contextActivities']
-        if not ret['context']:
-            del ret['context']
+        result = render_result(vars(self))
+        if result:
+            ret['result'] = result
+        context = stmt_context(self, lang, ids_only)
+        if context:
+            ret['context'] = context
 
         ret['timestamp'] = self.timestamp.isoformat()
         ret['stored'] = self.stored.isoformat()
         if self.authority is not None:
             ret['authority'] = self.authority.to_dict(ids_only)
         ret['version'] = self.version
-        if self.stmt_attachments.all():
-            ret['attachments'] = [a.return_attachment_with_lang(
-                lang) for a in self.stmt_attachments.all()]
+        attachments = [a.return_attachment_with_lang(lang) for a in self.stmt_attachments.all()]
+        if attachments:
+            ret['attachments'] = attachments
         return ret
 
     def get_a_name(self):
@@ -670,7 +551,14 @@ class AttachmentFileSystemStorage(FileSystemStorage):
             # if the file exists, do not call the superclasses _save method
             return name
         # if the file is new, DO call it
-        return super(AttachmentFileSystemStorage, self)._save(name, content)
+        try:
+            return super(AttachmentFileSystemStorage, self)._save(name, content)
+        except (IOError, OSError):
+            # Another request renamed the same spooled payload into place
+            # first
+            if self.exists(name):
+                return name
+            raise
 
 
 class StatementAttachment(models.Model):
@@ -681,18 +569,42 @@ class StatementAttachment(models.Model):
         Statement, related_name="stmt_attachments", null=True)
 
     def return_attachment_with_lang(self, lang=None):
-        ret = OrderedDict(self.canonical_data)
-        if 'display' in ret and ret['display'].items():
-            ret['display'] = get_lang(self.canonical_data['display'], lang)
-        if 'description' in ret and ret['description'].items():
-            ret['description'] = get_lang(
-                self.canonical_data['description'], lang)
-        return ret
+        return render_attachment(self.canonical_data, lang)
 
     def __unicode__(self):
         return json.dumps(self.canonical_data, sort_keys=False)
 
 
+class StatementAgent(models.Model):
+    # Every agent a statement refers to with the role it has there, including
+    # the ones in its substatement, so statements can be found by agent with
+    # one index lookup instead of a join per role. Written at ingest, see
+    # lrs/utils/statement_index.py
+    statement = models.ForeignKey(
+        Statement, related_name="agent_index", on_delete=models.CASCADE)
+    agent = models.ForeignKey(
+        Agent, related_name="statement_index", on_delete=models.CASCADE)
+    role = models.CharField(max_length=24)
+
+    class Meta:
+        index_together = ("agent", "role")
+
+
+class StatementActivity(models.Model):
+    # Every activity a statement refers to with how it relates to it - its
+    # object or one of its context activity types, also in its substatement -
+    # so statements can be found by activity without joining the four context
+    # activity tables twice. Written at ingest like StatementAgent
+    statement = models.ForeignKey(
+        Statement, related_name="activity_index", on_delete=models.CASCADE)
+    activity = models.ForeignKey(
+        Activity, related_name="statement_index", on_delete=models.CASCADE)
+    relation = models.CharField(max_length=24)
+
+    class Meta:
+        index_together = ("activity", "relation")
+
+
 class ActivityState(models.Model):
     state_id = models.CharField(max_length=MAX_URL_LENGTH)
     updated = models.DateTimeField(
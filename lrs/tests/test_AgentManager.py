@@ -7,6 +7,7 @@ from django.core.urlresolvers import reverse
 from django.conf import settings
 
 from ..models import Agent, Statement
+from ..utils.agent_cache import agent_cache, agent_keys, agent_row
 
 from adl_lrs.views import register
 
@@ -445,3 +446,37 @@ class AgentManagerTests(TestCase):
                 self.assertEquals(m['mbox'], badguy_m['mbox'])
             else:
                 self.fail("got an unexpected mbox: " % m['mbox'])
+
+    def test_agent_cache(self):
+        agent_cache.clear()
+        bob = Agent.objects.create(
+            name="bob", mbox="mailto:bob.cached@example.com")
+        # Entries are only written on commit, which never happens in a test
+        self.assertIsNone(agent_cache.get(Agent, {'mbox': bob.mbox}))
+        agent_cache.store(agent_keys(bob), agent_row(bob))
+
+        with self.assertNumQueries(0):
+            cached, created = Agent.objects.retrieve_or_create(
+                objectType="Agent", mbox=bob.mbox)
+        self.assertFalse(created)
+        self.assertEqual(cached.pk, bob.pk)
+        self.assertEqual(cached.name, "bob")
+        self.assertEqual(agent_cache.stats()['local_hits'], 1)
+
+        group = Agent.objects.create(
+            objectType="Group", name="bobs", openid="http://bobs.example.com")
+        agent_cache.store(agent_keys(group), agent_row(group))
+        # Adding a member drops the group, it's read again
+        group.member.add(bob)
+        with self.assertNumQueries(1):
+            Agent.objects.retrieve(openid=group.openid)
+
+        bob.name = "robert"
+        bob.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(Agent.objects.retrieve(
+                mbox=bob.mbox).name, "robert")
+        # bob before he was stored, the group after the member was added and
+        # bob after he was saved
+        self.assertEqual(agent_cache.stats()['misses'], 3)
+        agent_cache.clear()
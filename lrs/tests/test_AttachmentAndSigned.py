@@ -4,6 +4,7 @@ import uuid
 import urllib
 import hashlib
 import os
+import time
 from jose import jws
 
 from datetime import datetime
@@ -19,6 +20,8 @@ from django.utils.timezone import utc
 from django.conf import settings
 
 from ..models import Statement, StatementAttachment
+from ..utils.attachment_spool import attachment_spool
+from ..utils.jws_verify import key_cache
 
 from adl_lrs.views import register
 
@@ -63,6 +66,8 @@ class AttachmentAndSignedTests(TestCase):
                 os.unlink(file_path)
             except Exception, e:
                 raise e
+        for the_file in os.listdir(attachment_spool.directory()):
+            os.unlink(os.path.join(attachment_spool.directory(), the_file))
 
     def test_multipart(self):
         stmt = {"actor": {"mbox": "mailto:tom@example.com"},
@@ -1022,6 +1027,103 @@ class AttachmentAndSignedTests(TestCase):
         self.assertEqual(parts[2].get('Content-Type'), 'image/png')
         self.assertEqual(parts[2].get('Content-Transfer-Encoding'), 'binary')
 
+    def test_multipart_spooled_attachment(self):
+        # Spans several reads of the request and ends in line breaks, which
+        # have to be kept as part of the payload
+        data = "".join(chr(i % 256) for i in range(200000)).replace(
+            "\n--", "\n-") + "\r\n\r\n"
+        datasha = hashlib.sha256(data).hexdigest()
+        stmt = {"actor": {"mbox": "mailto:tom@example.com"},
+                "verb": {"id": "http://tom.com/verb/butted"},
+                "object": {"id": "act:tom.com/objs/heads"},
+                "attachments": [
+            {"usageType": "http://example.com/attachment-usage/test",
+             "display": {"en-US": "A test binary file"},
+             "contentType": "application/octet-stream",
+             "length": len(data),
+             "sha2": datasha}]}
+
+        message = MIMEMultipart(boundary="myboundary")
+        stmtdata = MIMEApplication(json.dumps(
+            stmt), _subtype="json", _encoder=json.JSONEncoder)
+        bindata = MIMEApplication(data, 'octet-stream')
+        bindata.add_header('X-Experience-API-Hash', datasha)
+        bindata.replace_header('Content-Transfer-Encoding', 'binary')
+        bindata.set_payload(data)
+        message.attach(stmtdata)
+        message.attach(bindata)
+
+        r = self.client.post(reverse('lrs:statements'), message.as_string().replace("\n--myboundary", "\r\n--myboundary"),
+                             content_type='multipart/mixed; boundary="myboundary"', Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 200)
+        attachment = StatementAttachment.objects.get(
+            statement__statement_id=json.loads(r.content)[0])
+        attachment.payload.open()
+        self.assertEqual(attachment.payload.read(), data)
+        attachment.payload.close()
+
+        bindata.replace_header('X-Experience-API-Hash', hashlib.sha256(data[:-1]).hexdigest())
+        r = self.client.post(reverse('lrs:statements'), message.as_string(),
+                             content_type='multipart/mixed; boundary="myboundary"', Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 400)
+        self.assertIn("did not match calculated hash", r.content)
+
+    def test_attachment_spool(self):
+        txt = u"howdy.. this is a text attachment"
+        txtsha = hashlib.sha256(txt).hexdigest()
+        part_file, part_path = attachment_spool.new_part()
+        part_file.write(txt)
+        part_file.close()
+        payload = attachment_spool.store(part_path, txtsha, len(txt))
+        self.assertEqual(payload.temporary_file_path(), attachment_spool.path(txtsha))
+        self.assertEqual(payload.read(), txt)
+        self.assertFalse(os.path.exists(part_path))
+
+        # Only payloads past the TTL are swept
+        self.assertEqual(attachment_spool.sweep(), 0)
+        expired = time.time() - settings.ATTACHMENT_SPOOL_TTL - 1
+        os.utime(payload.name, (expired, expired))
+        self.assertEqual(attachment_spool.sweep(), 1)
+        self.assertFalse(os.path.exists(payload.name))
+
+        stmt = {"actor": {"mbox": "mailto:tom@example.com"},
+                "verb": {"id": "http://tom.com/verb/butted"},
+                "object": {"id": "act:tom.com/objs/heads"},
+                "attachments": [
+            {"usageType": "http://example.com/attachment-usage/test",
+             "display": {"en-US": "A test attachment"},
+             "contentType": "text/plain; charset=utf-8",
+             "length": len(txt),
+             "sha2": txtsha}]}
+        message = MIMEMultipart(boundary="myboundary")
+        stmtdata = MIMEApplication(json.dumps(
+            stmt), _subtype="json", _encoder=json.JSONEncoder)
+        textdata = MIMEText(txt, 'plain', 'utf-8')
+        textdata.add_header('X-Experience-API-Hash', txtsha)
+        textdata.replace_header('Content-Transfer-Encoding', 'binary')
+        textdata.set_payload(txt, 'utf-8')
+        message.attach(stmtdata)
+        message.attach(textdata)
+
+        quota = settings.ATTACHMENT_SPOOL_QUOTA
+        settings.ATTACHMENT_SPOOL_QUOTA = len(txt) - 1
+        r = self.client.post(reverse('lrs:statements'), message.as_string(),
+                             content_type='multipart/mixed; boundary="myboundary"', Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        settings.ATTACHMENT_SPOOL_QUOTA = quota
+        self.assertEqual(r.status_code, 400)
+        self.assertIn("attachment spool quota", r.content)
+        # The partly written payload isn't left behind
+        self.assertEqual(os.listdir(attachment_spool.directory()), [])
+
+        # Saving the statement renames the payload out of the spool
+        r = self.client.post(reverse('lrs:statements'), message.as_string(),
+                             content_type='multipart/mixed; boundary="myboundary"', Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(os.listdir(attachment_spool.directory()), [])
+        attachment = StatementAttachment.objects.get(
+            statement__statement_id=json.loads(r.content)[0])
+        self.assertEqual(attachment.payload.size, len(txt))
+
     def test_example_signed_statement(self):
         payload = json.loads(exstmt)
         signature = jws.sign(payload, privatekey, algorithm='RS256')
@@ -1455,6 +1557,45 @@ class AttachmentAndSignedTests(TestCase):
         self.assertEqual(
             r.content, 'The JWS is not valid: Signature verification failed.')
 
+    def test_example_signed_statement_batch_x509_verification(self):
+        def signed_batch(key):
+            payload = json.loads(exstmt)
+            signature = jws.sign(payload, privatekey, {
+                                 'x5c': [base64.b64encode(key)]}, 'RS256')
+            sha2 = hashlib.sha256(signature).hexdigest()
+            payload['attachments'][0]["sha2"] = sha2
+            stmts = [dict(payload, id=str(uuid.uuid4())) for i in range(3)]
+
+            message = MIMEMultipart(boundary="myboundary")
+            stmtdata = MIMEApplication(json.dumps(
+                stmts), _subtype="json", _encoder=json.JSONEncoder)
+            jwsdata = MIMEApplication(signature, _subtype="octet-stream")
+            jwsdata.add_header('X-Experience-API-Hash', sha2)
+            jwsdata.replace_header('Content-Transfer-Encoding', 'binary')
+            jwsdata.set_payload(signature)
+            message.attach(stmtdata)
+            message.attach(jwsdata)
+            return self.client.post(reverse('lrs:statements'), message.as_string(),
+                                    content_type='multipart/mixed; boundary="myboundary"', Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+
+        # Verified on the request thread, the certificate is only parsed once
+        key_cache.clear()
+        r = signed_batch(publickey)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(key_cache.misses, 1)
+        self.assertEqual(key_cache.hits, 2)
+
+        # Verified in the process pool, with the same results
+        threshold = settings.JWS_VERIFY_PARALLEL_THRESHOLD
+        settings.JWS_VERIFY_PARALLEL_THRESHOLD = 1
+        r = signed_batch(publickey)
+        self.assertEqual(r.status_code, 200)
+        r = signed_batch(wrongpublickey)
+        settings.JWS_VERIFY_PARALLEL_THRESHOLD = threshold
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(
+            r.content, 'The JWS is not valid: Signature verification failed.')
+
 exstmt = """{
     "version": "1.0.0",
     "id": "33cff416-e331-4c9d-969e-5373a1756120",
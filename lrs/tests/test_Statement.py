@@ -14,7 +14,7 @@ from django.conf import settings
 from django.test.utils import override_settings
 
 from ..models import Statement, Activity, Agent, Verb, SubStatement
-from ..utils import retrieve_statement
+from ..utils import retrieve_statement, validation_cache
 
 from adl_lrs.views import register
 
@@ -1931,8 +1931,129 @@ class StatementTests(TestCase):
                                 Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
         self.assertEqual(resp2.status_code, 204)
 
+    def test_batch_duplicate_ids(self):
+        stmt_guid = str(uuid.uuid4())
+        stmts = [{"id": stmt_guid, "actor": {"mbox": "mailto:dup@example.com"},
+                  "verb": {"id": "http://example.com/verbs/did"},
+                  "object": {"id": "act:dup%s" % i}} for i in range(2)]
+        response = self.client.post(reverse('lrs:statements'), json.dumps(stmts), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, "Statement batch contains duplicate ID %s" % stmt_guid)
+        self.assertEqual(Statement.objects.count(), 0)
+
+    def test_batch_existing_id(self):
+        stmt_guid = str(uuid.uuid4())
+        stmt = {"id": stmt_guid, "actor": {"mbox": "mailto:dup@example.com"},
+                "verb": {"id": "http://example.com/verbs/did"},
+                "object": {"id": "act:dup"}}
+        response = self.client.post(reverse('lrs:statements'), json.dumps(stmt), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 200)
+
+        stmts = [{"actor": {"mbox": "mailto:dup@example.com"},
+                  "verb": {"id": "http://example.com/verbs/did"},
+                  "object": {"id": "act:dup2"}}, stmt]
+        response = self.client.post(reverse('lrs:statements'), json.dumps(stmts), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.content, "A statement with ID %s already exists" % stmt_guid)
+        self.assertEqual(Statement.objects.count(), 1)
+
+    def test_batch_void_voiding_statement(self):
+        stmt_guid = str(uuid.uuid4())
+        void_guid = str(uuid.uuid4())
+        stmts = [{"id": stmt_guid, "actor": {"mbox": "mailto:void@example.com"},
+                  "verb": {"id": "http://example.com/verbs/did"},
+                  "object": {"id": "act:void"}},
+                 {"id": void_guid, "actor": {"mbox": "mailto:void@example.com"},
+                  "verb": {"id": "http://adlnet.gov/expapi/verbs/voided"},
+                  "object": {"objectType": "StatementRef", "id": stmt_guid}},
+                 {"actor": {"mbox": "mailto:void@example.com"},
+                  "verb": {"id": "http://adlnet.gov/expapi/verbs/voided"},
+                  "object": {"objectType": "StatementRef", "id": void_guid}}]
+        response = self.client.post(reverse('lrs:statements'), json.dumps(stmts), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, "Statement with ID: %s is a voiding statement and cannot be voided." % void_guid)
+        self.assertEqual(Statement.objects.count(), 0)
+
     @override_settings(CELERY_ALWAYS_EAGER=True,
                        TEST_RUNNER='djcelery.contrib.test_runner.CeleryTestSuiteRunner')
+    def test_streamed_batch(self):
+        settings.STATEMENT_STREAM_CHUNK = 2
+        stmts = [{"id": str(uuid.uuid4()), "actor": {"mbox": "mailto:stream@example.com"},
+                  "verb": {"id": "http://example.com/verbs/streamed"},
+                  "object": {"id": "act:stream%s" % i}} for i in range(5)]
+        response = self.client.post(reverse('lrs:statements'), json.dumps(stmts), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), [st["id"] for st in stmts])
+
+        # A duplicate in a later chunk fails the request after the first
+        # chunks were saved - none of them are kept
+        dup_stmts = [{"id": str(uuid.uuid4()), "actor": {"mbox": "mailto:stream@example.com"},
+                      "verb": {"id": "http://example.com/verbs/streamed"},
+                      "object": {"id": "act:stream_dup%s" % i}} for i in range(3)]
+        dup_stmts.append(dict(dup_stmts[0]))
+        response = self.client.post(reverse('lrs:statements'), json.dumps(dup_stmts), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, "Statement batch contains duplicate ID %s" % dup_stmts[0]["id"])
+        self.assertEqual(Statement.objects.count(), 5)
+        settings.STATEMENT_STREAM_CHUNK = 100
+
+    def test_streamed_body_too_large(self):
+        settings.STATEMENT_BODY_MAX_SIZE = 100
+        stmts = [{"actor": {"mbox": "mailto:stream@example.com"},
+                  "verb": {"id": "http://example.com/verbs/streamed"},
+                  "object": {"id": "act:stream%s" % i}} for i in range(5)]
+        response = self.client.post(reverse('lrs:statements'), json.dumps(stmts), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, "Request body is larger than the maximum of 100 bytes")
+
+        # Parameters of the media type don't keep the body from being streamed
+        response = self.client.post(reverse('lrs:statements'), json.dumps(stmts),
+                                    content_type="application/json; charset=utf-8",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, "Request body is larger than the maximum of 100 bytes")
+        settings.STATEMENT_BODY_MAX_SIZE = 100 * 1024 * 1024
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, STATEMENT_STREAM_CHUNK=1,
+                       TEST_RUNNER='djcelery.contrib.test_runner.CeleryTestSuiteRunner')
+    def test_streamed_void_across_chunks(self):
+        # The voiding statement comes a chunk before the one it voids
+        stmt_guid = str(uuid.uuid4())
+        void_guid = str(uuid.uuid4())
+        stmts = [{"id": void_guid, "actor": {"mbox": "mailto:void@example.com"},
+                  "verb": {"id": "http://adlnet.gov/expapi/verbs/voided"},
+                  "object": {"objectType": "StatementRef", "id": stmt_guid}},
+                 {"id": stmt_guid, "actor": {"mbox": "mailto:void@example.com"},
+                  "verb": {"id": "http://example.com/verbs/did"},
+                  "object": {"id": "act:void"}}]
+        response = self.client.post(reverse('lrs:statements'), json.dumps(stmts), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(Statement.objects.get(statement_id=stmt_guid).voided)
+        self.assertFalse(Statement.objects.get(statement_id=void_guid).voided)
+
+        # A voiding statement voided by an earlier chunk is still refused
+        voiding_guid = str(uuid.uuid4())
+        stmts = [{"actor": {"mbox": "mailto:void@example.com"},
+                  "verb": {"id": "http://adlnet.gov/expapi/verbs/voided"},
+                  "object": {"objectType": "StatementRef", "id": voiding_guid}},
+                 {"id": voiding_guid, "actor": {"mbox": "mailto:void@example.com"},
+                  "verb": {"id": "http://adlnet.gov/expapi/verbs/voided"},
+                  "object": {"objectType": "StatementRef", "id": void_guid}}]
+        response = self.client.post(reverse('lrs:statements'), json.dumps(stmts), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content,
+                         "Statement with ID: %s is a voiding statement and cannot be voided." % voiding_guid)
+        self.assertEqual(Statement.objects.count(), 2)
+
     def test_void(self):
         stmt_guid = str(uuid.uuid4())
         stmt = {"actor": {"mbox": "mailto:tinytom@example.com"},
@@ -2075,6 +2196,66 @@ class StatementTests(TestCase):
         act = Activity.objects.get(id=stmt_db.object_activity.id)
         self.assertEqual(act.activity_id, act_id)
 
+    def test_validation_cache(self):
+        validation_cache.clear()
+        stmts = [{"verb": {"id": "http://example.com/verbs/cached", "display": {"en-US": "cached"}},
+                  "object": {"id": "act:cached_%s" % (x % 2)},
+                  "actor": {"mbox": "mailto:cached@example.com"}} for x in range(4)]
+        response = self.client.post(reverse('lrs:statements'), json.dumps(stmts), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 200)
+        stats = validation_cache.stats()
+        # The verb id and the two activity ids are only parsed once
+        self.assertEqual(stats['iri']['size'], 3)
+        self.assertGreaterEqual(stats['iri']['hits'], 5)
+        self.assertEqual(stats['language']['size'], 1)
+        self.assertGreaterEqual(stats['language']['hits'], 3)
+
+        # Invalid IRIs aren't kept and keep failing
+        bad = json.dumps({"verb": {"id": "http://example.com/verbs/cached"},
+                          "object": {"id": "bad iri"},
+                          "actor": {"mbox": "mailto:cached@example.com"}})
+        for _ in range(2):
+            response = self.client.post(reverse('lrs:statements'), bad, content_type="application/json",
+                                        Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(
+                response.content, 'Activity id with value bad iri was not a valid IRI')
+        self.assertEqual(validation_cache.stats()['iri']['size'], 3)
+        validation_cache.clear()
+
+    def test_parallel_validation(self):
+        threshold = settings.STATEMENT_VALIDATE_PARALLEL_THRESHOLD
+        chunk = settings.STATEMENT_VALIDATE_CHUNK
+        settings.STATEMENT_VALIDATE_PARALLEL_THRESHOLD = 2
+        settings.STATEMENT_VALIDATE_CHUNK = 2
+        stmts = [{"verb": {"id": "http://example.com/verbs/validated"},
+                  "object": {"id": "act:parallel_%s" % x},
+                  "actor": {"mbox": "mailto:parallel@example.com"}} for x in range(5)]
+        # Invalid statements in the second and last chunks, the first one is
+        # reported
+        bad = [dict(st) for st in stmts]
+        bad[4]['verb'] = {"id": "bad verb"}
+        bad[2]['object'] = {"id": "bad act"}
+        response = self.client.post(reverse('lrs:statements'), json.dumps(bad), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.content, 'Activity id with value bad act was not a valid IRI')
+
+        response = self.client.post(reverse('lrs:statements'), json.dumps(stmts), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        settings.STATEMENT_VALIDATE_PARALLEL_THRESHOLD = threshold
+        settings.STATEMENT_VALIDATE_CHUNK = chunk
+        self.assertEqual(response.status_code, 200)
+        ids = json.loads(response.content)
+        self.assertEqual(len(ids), 5)
+        # objectTypes filled in by the validator in the pool are kept
+        for x, stmt_id in enumerate(ids):
+            st = Statement.objects.get(statement_id=stmt_id)
+            self.assertEqual(st.object_activity.activity_id, "act:parallel_%s" % x)
+            self.assertEqual(st.full_statement['object']['objectType'], 'Activity')
+
     @override_settings(CELERY_ALWAYS_EAGER=True,
                        TEST_RUNNER='djcelery.contrib.test_runner.CeleryTestSuiteRunner')
     def test_large_batch(self):
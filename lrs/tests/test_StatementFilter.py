@@ -20,6 +20,7 @@ from django.conf import settings
 
 from ..models import Statement
 from ..utils import convert_to_datetime_object
+from ..utils.retrieve_statement import build_filter, stmt_ref_search, complex_get
 
 from adl_lrs.views import register
 
@@ -3249,3 +3250,76 @@ class StatementFilterTests(TestCase):
         returned_stmts = returned['statements']
         self.assertEqual(len(returned_stmts), len(stmt_list))
         self.assertEqual(returned['more'], "")
+
+    def test_statement_ref_chain(self):
+        # Each statement refers to the one before it, only the first has the
+        # verb filtered on
+        guids = [str(uuid.uuid1()) for i in range(5)]
+        stmt_list = [{"id": guids[0], "actor": {"mbox": "mailto:chain@example.com"},
+                      "verb": {"id": "http://example.com/verbs/started"}, "object": {"id": "act:chain"}}]
+        for i in range(1, 5):
+            stmt_list.append({"id": guids[i], "actor": {"mbox": "mailto:chain@example.com"},
+                              "verb": {"id": "http://example.com/verbs/followed"},
+                              "object": {"objectType": "StatementRef", "id": guids[i - 1]}})
+        r = self.client.post(reverse('lrs:statements'), json.dumps(stmt_list), content_type="application/json",
+                             HTTP_AUTHORIZATION=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(r.status_code, 200)
+
+        # The whole chain is one query
+        filterQ, untilQ, sinceQ, reffilter = build_filter({"verb": "http://example.com/verbs/started"})
+        with self.assertNumQueries(1):
+            found = [str(st_id) for st_id in stmt_ref_search(
+                Statement.objects.filter(filterQ), untilQ, sinceQ).values_list('statement_id', flat=True)]
+        self.assertEqual(sorted(found), sorted(guids))
+
+        # References stored after until aren't followed
+        stored = Statement.objects.get(statement_id=guids[2]).stored
+        filterQ, untilQ, sinceQ, reffilter = build_filter(
+            {"verb": "http://example.com/verbs/started", "until": stored.isoformat()})
+        found = [str(st_id) for st_id in stmt_ref_search(
+            Statement.objects.filter(filterQ), untilQ, sinceQ).values_list('statement_id', flat=True)]
+        self.assertEqual(sorted(found), sorted(
+            g for g in guids if Statement.objects.get(statement_id=g).stored <= stored))
+
+        r = self.client.get(reverse('lrs:statements'), {"verb": "http://example.com/verbs/started"},
+                            X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(sorted(st['id'] for st in json.loads(r.content)['statements']), sorted(guids))
+
+    def test_total_count(self):
+        for i in range(1, 4):
+            stmt = {"actor": {"mbox": "mailto:test%s@mail.com" % i}, "verb": {
+                "id": "http://tom.com/tested"}, "object": {"id": "act:activity%s" % i}}
+            resp = self.client.post(reverse('lrs:statements'), json.dumps(
+                stmt), Authorization=self.auth, content_type="application/json", X_Experience_API_Version=settings.XAPI_VERSION)
+            self.assertEqual(resp.status_code, 200)
+
+        # A page that isn't full is one query for its ids, nothing is counted
+        with self.assertNumQueries(1):
+            result = complex_get({}, 5, None, "exact", False)
+        self.assertEqual(len(result['statements']), 3)
+        self.assertEqual(result['more'], "")
+        self.assertNotIn('total', result)
+        self.assertEqual(complex_get({}, 5, None, "exact", False, 'exact')['total'], 3)
+        self.assertNotIn('total', complex_get({}, 2, None, "exact", False))
+
+        # No total unless it's asked for
+        r = self.client.get(reverse('lrs:statements'), {"limit": 2},
+                            X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertFalse(r.has_header('X-Total-Count'))
+
+        for count in ('exact', 'estimated'):
+            r = self.client.get(reverse('lrs:statements'), {"limit": 2}, HTTP_PREFER="count=%s" % count,
+                                X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r['X-Total-Count'], '3')
+            self.assertEqual(r['Preference-Applied'], 'count=%s' % count)
+            self.assertEqual(len(json.loads(r.content)['statements']), 2)
+            self.assertTrue(json.loads(r.content)['more'])
+            self.assertNotIn('total', json.loads(r.content))
+
+        with self.settings(STATEMENT_MORE_MODE='cursor'):
+            r = self.client.get(reverse('lrs:statements'), {"limit": 2}, HTTP_PREFER="count=exact",
+                                X_Experience_API_Version=settings.XAPI_VERSION, Authorization=self.auth)
+            self.assertEqual(r['X-Total-Count'], '3')
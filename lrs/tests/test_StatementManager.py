@@ -2,13 +2,16 @@ import uuid
 import json
 import urllib
 import base64
+from StringIO import StringIO
 
+from django.core.management import call_command
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 from django.conf import settings
 
-from ..models import Verb, Agent, Activity, Statement, SubStatement
-from ..managers.ActivityManager import ActivityManager
+from ..models import Verb, Agent, Activity, Statement, SubStatement, StatementAgent, StatementActivity
+from ..managers.ActivityManager import ActivityManager, definition_updates
+from ..utils.verb_registry import verb_registry
 
 from adl_lrs.views import register
 
@@ -817,3 +820,214 @@ class StatementManagerTests(TestCase):
                       'definition']['correctResponsesPattern'])
         self.assertIn('true', act2.canonical_data[
                       'definition']['correctResponsesPattern'])
+
+    def test_activity_upsert(self):
+        auth = Agent.objects.create(mbox="mailto:definer@example.com")
+        act1 = ActivityManager({
+            'objectType': 'Activity', 'id': 'act:upsert',
+            'definition': {'name': {'en-US': 'upserted'}, 'type': 'type:one'}}, auth=auth).activity
+        self.assertEqual(act1.authority, auth)
+
+        with self.assertNumQueries(1):
+            act2 = ActivityManager({
+                'objectType': 'Activity', 'id': 'act:upsert',
+                'definition': {'name': {'fr': 'upserte'}, 'type': 'type:two'}}, auth=auth).activity
+        self.assertEqual(act2.pk, act1.pk)
+        self.assertEqual(act2.canonical_data['definition']['name'], {
+                         'en-US': 'upserted', 'fr': 'upserte'})
+        self.assertEqual(act2.canonical_data['definition']['description'], {})
+        self.assertEqual(act2.canonical_data['definition']['type'], 'type:one')
+
+        other = Agent.objects.create(mbox="mailto:other@example.com")
+        act3 = ActivityManager({
+            'objectType': 'Activity', 'id': 'act:upsert',
+            'definition': {'name': {'de': 'upserted'}}}, auth=other).activity
+        self.assertNotIn('de', act3.canonical_data['definition']['name'])
+        self.assertEqual(len(Activity.objects.filter(activity_id='act:upsert')), 1)
+
+        # Created without define permission, the first one to define it
+        # becomes its authority
+        ActivityManager({'objectType': 'Activity', 'id': 'act:unowned',
+                         'definition': {'name': {'en-US': 'unowned'}}}, auth=auth, define=False)
+        self.assertIsNone(Activity.objects.get(activity_id='act:unowned').authority)
+        ActivityManager({'objectType': 'Activity', 'id': 'act:unowned'}, auth=other)
+        self.assertIsNone(Activity.objects.get(activity_id='act:unowned').authority)
+        act4 = ActivityManager({'objectType': 'Activity', 'id': 'act:unowned',
+                                'definition': {'name': {'en-US': 'owned'}}}, auth=other).activity
+        self.assertEqual(act4.authority, other)
+        self.assertEqual(act4.canonical_data['definition']['name'], {'en-US': 'owned'})
+        act5 = ActivityManager({'objectType': 'Activity', 'id': 'act:unowned',
+                                'definition': {'name': {'fr': 'possede'}}}, auth=auth).activity
+        self.assertEqual(act5.authority, other)
+        self.assertNotIn('fr', act5.canonical_data['definition']['name'])
+
+    def test_activity_noop_definition_update(self):
+        act_data = {'objectType': 'Activity', 'id': 'act:choices',
+                    'definition': {'name': {'en-US': 'choose'}, 'description': {'en-US': 'pick one'},
+                                   'type': 'http://adlnet.gov/expapi/activities/cmi.interaction',
+                                   'interactionType': 'choice', 'correctResponsesPattern': ['a'],
+                                   'choices': [{'id': 'a', 'description': {'en-US': 'A'}},
+                                               {'id': 'b', 'description': {'en-US': 'B'}}]}}
+        ActivityManager(json.loads(json.dumps(act_data)))
+        skipped = definition_updates['skipped']
+        applied = definition_updates['applied']
+
+        # Same definition again - only the lookup, no write
+        with self.assertNumQueries(1):
+            ActivityManager(json.loads(json.dumps(act_data)))
+        self.assertEqual(definition_updates['skipped'], skipped + 1)
+
+        act_data['definition']['choices'][1]['description'] = {'fr': 'Be'}
+        act = ActivityManager(act_data).activity
+        self.assertEqual(definition_updates['applied'], applied + 1)
+        self.assertEqual(Activity.objects.get(pk=act.pk).canonical_data['definition']['choices'][1]['description'],
+                         {'en-US': 'B', 'fr': 'Be'})
+
+    def test_bulk_ingest(self):
+        settings.BULK_INGEST_THRESHOLD = 2
+        stmts = []
+        for i in range(5):
+            stmts.append({"actor": {"objectType": "Agent", "mbox": "mailto:bulk%s@example.com" % (i % 2)},
+                          "verb": {"id": "http://example.com/verbs/bulked", "display": {"en-US": "bulked %s" % i}},
+                          "object": {"id": "act:bulk", "definition": {"name": {"en-US": "bulk %s" % i}}},
+                          "context": {"contextActivities": {"parent": {"id": "act:bulk_parent"},
+                                                            "other": [{"id": "act:bulk_other1"}, {"id": "act:bulk_other2"}]}}})
+        stmts.append({"actor": {"objectType": "Agent", "mbox": "mailto:bulk0@example.com"},
+                      "verb": {"id": "http://example.com/verbs/bulked"},
+                      "object": {"objectType": "SubStatement",
+                                 "actor": {"objectType": "Agent", "mbox": "mailto:bulksub@example.com"},
+                                 "verb": {"id": "http://example.com/verbs/subbulked"},
+                                 "object": {"id": "act:bulk"},
+                                 "context": {"contextActivities": {"grouping": {"id": "act:bulk_parent"}}}}})
+        response = self.client.post(reverse('lrs:statements'), json.dumps(stmts), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 200)
+        stmt_ids = json.loads(response.content)
+        self.assertEqual(len(stmt_ids), 6)
+        self.assertEqual(Statement.objects.filter(statement_id__in=stmt_ids).count(), 6)
+
+        self.assertEqual(Verb.objects.filter(verb_id="http://example.com/verbs/bulked").count(), 1)
+        verb = Verb.objects.get(verb_id="http://example.com/verbs/bulked")
+        self.assertEqual(verb.canonical_data['display'], {"en-US": "bulked 4"})
+        self.assertEqual(Agent.objects.filter(mbox__startswith="mailto:bulk").count(), 3)
+        act = Activity.objects.get(activity_id="act:bulk")
+        self.assertEqual(act.canonical_data['definition']['name'], {"en-US": "bulk 4"})
+
+        for st_id in stmt_ids[:5]:
+            st = Statement.objects.get(statement_id=st_id)
+            self.assertEqual(st.object_activity, act)
+            self.assertEqual([a.activity_id for a in st.context_ca_parent.all()], ["act:bulk_parent"])
+            self.assertEqual(sorted([a.activity_id for a in st.context_ca_other.all()]),
+                             ["act:bulk_other1", "act:bulk_other2"])
+
+        sub_st = Statement.objects.get(statement_id=stmt_ids[5])
+        sub = sub_st.object_substatement
+        self.assertEqual(sub.actor.mbox, "mailto:bulksub@example.com")
+        self.assertEqual(sub.object_activity, act)
+        self.assertEqual([a.activity_id for a in sub.context_ca_grouping.all()], ["act:bulk_parent"])
+        settings.BULK_INGEST_THRESHOLD = 10
+
+    def test_verb_registry(self):
+        verb_id = "http://example.com/verbs/registered"
+        verb = Verb.objects.create(verb_id=verb_id, canonical_data={
+                                   "id": verb_id, "display": {"en-US": "registered"}})
+        verb_registry.verbs[verb_id] = verb
+        self.assertEqual(verb_registry.cached(verb_id, [{"en-US": "registered"}]), verb)
+        self.assertEqual(verb_registry.cached(verb_id, []), verb)
+        self.assertIsNone(verb_registry.cached(verb_id, [{"en-GB": "registered"}]))
+
+        stmt = json.dumps({"actor": {"objectType": "Agent", "mbox": "mailto:tincan@adlnet.gov"},
+                           "verb": {"id": verb_id, "display": {"en-GB": "signed up"}},
+                           "object": {"id": "act:registry"}})
+        response = self.client.post(reverse('lrs:statements'), stmt, content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 200)
+        verb = Verb.objects.get(verb_id=verb_id)
+        self.assertEqual(verb.canonical_data['display'], {"en-US": "registered", "en-GB": "signed up"})
+        verb_registry.verbs.clear()
+
+    def test_statement_agent_index(self):
+        def index(st_id):
+            return sorted((row.role, row.agent.mbox) for row in
+                          StatementAgent.objects.filter(statement__statement_id=st_id).select_related('agent'))
+
+        stmt = {"actor": {"mbox": "mailto:index_actor@example.com"},
+                "verb": {"id": "http://example.com/verbs/indexed"},
+                "object": {"objectType": "SubStatement",
+                           "actor": {"mbox": "mailto:index_sub_actor@example.com"},
+                           "verb": {"id": "http://example.com/verbs/indexed"},
+                           "object": {"objectType": "Agent", "mbox": "mailto:index_sub_object@example.com"},
+                           "context": {"instructor": {"mbox": "mailto:index_instructor@example.com"}}},
+                "context": {"instructor": {"mbox": "mailto:index_instructor@example.com"}}}
+        expected = [("actor", "mailto:index_actor@example.com"),
+                    ("authority", "mailto:test1@tester.com"),
+                    ("instructor", "mailto:index_instructor@example.com"),
+                    ("substatement_actor", "mailto:index_sub_actor@example.com"),
+                    ("substatement_instructor", "mailto:index_instructor@example.com"),
+                    ("substatement_object", "mailto:index_sub_object@example.com")]
+
+        # Saved one at a time and in bulk
+        settings.BULK_INGEST_THRESHOLD = 2
+        response = self.client.post(reverse('lrs:statements'), json.dumps([stmt]), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 200)
+        single_id = json.loads(response.content)[0]
+        response = self.client.post(reverse('lrs:statements'), json.dumps([stmt, stmt]), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        settings.BULK_INGEST_THRESHOLD = 10
+        self.assertEqual(response.status_code, 200)
+        stmt_ids = [single_id] + json.loads(response.content)
+        for st_id in stmt_ids:
+            self.assertEqual(index(st_id), expected)
+
+        StatementAgent.objects.all().delete()
+        call_command('backfill_statement_index', stdout=StringIO())
+        for st_id in stmt_ids:
+            self.assertEqual(index(st_id), expected)
+
+    def test_statement_activity_index(self):
+        def index(st_id):
+            return sorted((row.relation, row.activity.activity_id) for row in
+                          StatementActivity.objects.filter(statement__statement_id=st_id).select_related('activity'))
+
+        stmt = {"actor": {"mbox": "mailto:index_actor@example.com"},
+                "verb": {"id": "http://example.com/verbs/indexed"},
+                "object": {"objectType": "SubStatement",
+                           "actor": {"mbox": "mailto:index_sub_actor@example.com"},
+                           "verb": {"id": "http://example.com/verbs/indexed"},
+                           "object": {"id": "act:index_sub_object"},
+                           "context": {"contextActivities": {"category": {"id": "act:index_category"}}}},
+                "context": {"contextActivities": {"parent": [{"id": "act:index_parent"}, {"id": "act:index_parent"}],
+                                                  "grouping": [{"id": "act:index_parent"},
+                                                               {"id": "act:index_grouping"}]}}}
+        expected = [("grouping", "act:index_grouping"),
+                    ("grouping", "act:index_parent"),
+                    ("parent", "act:index_parent"),
+                    ("substatement_category", "act:index_category"),
+                    ("substatement_object", "act:index_sub_object")]
+
+        settings.BULK_INGEST_THRESHOLD = 2
+        response = self.client.post(reverse('lrs:statements'), json.dumps([stmt]), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        self.assertEqual(response.status_code, 200)
+        single_id = json.loads(response.content)[0]
+        response = self.client.post(reverse('lrs:statements'), json.dumps([stmt, stmt]), content_type="application/json",
+                                    Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+        settings.BULK_INGEST_THRESHOLD = 10
+        self.assertEqual(response.status_code, 200)
+        stmt_ids = [single_id] + json.loads(response.content)
+        for st_id in stmt_ids:
+            self.assertEqual(index(st_id), expected)
+
+        StatementActivity.objects.all().delete()
+        call_command('backfill_statement_index', stdout=StringIO())
+        for st_id in stmt_ids:
+            self.assertEqual(index(st_id), expected)
+
+        # Found through the substatement's context only with related_activities
+        for related, count in (("false", 0), ("true", 3)):
+            param = {"activity": "act:index_category", "related_activities": related}
+            response = self.client.get("%s?%s" % (reverse('lrs:statements'), urllib.urlencode(param)),
+                                       Authorization=self.auth, X_Experience_API_Version=settings.XAPI_VERSION)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(json.loads(response.content)['statements']), count)
@@ -5,12 +5,16 @@ import uuid
 from datetime import datetime, timedelta
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.utils.timezone import utc
 
-from ..models import Statement
+from ..models import Statement, Activity
 from ..utils import retrieve_statement
+from ..utils.render import RenderMemo
+from ..utils.render_cache import render_cache
+from ..utils.statement_serializer import serialize_statements
 
 from adl_lrs.views import register
 
@@ -1291,3 +1295,184 @@ class StatementMoreTests(TestCase):
         self.assertEqual(stmts[2]['id'], self.guid23)
         self.assertEqual(stmts[3]['id'], self.guid24)
         self.assertEqual(stmts[4]['id'], self.guid25)
+
+    def test_cursor_more_stmts_url(self):
+        settings.STATEMENT_MORE_MODE = 'cursor'
+        pages = []
+        r = self.client.get(reverse('lrs:statements'), {"limit": 10},
+                            X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+        while True:
+            self.assertEqual(r.status_code, 200)
+            sresults = json.loads(r.content)
+            pages.append([st['id'] for st in sresults['statements']])
+            if not sresults['more']:
+                break
+            more = sresults['more'].split('/')[-1]
+            r = self.client.get(reverse('lrs:statements_more', kwargs={'more_id': more}),
+                                X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+        guids = [getattr(self, "guid%s" % n) for n in range(25, 0, -1)]
+        self.assertEqual(pages, [guids[:10], guids[10:20], guids[20:]])
+
+        # The filters and order carry over to the next page
+        r = self.client.get(reverse('lrs:statements'), {"limit": 3, "since": self.fourthTime, "ascending": "true"},
+                            X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(r.status_code, 200)
+        sresults = json.loads(r.content)
+        first_page = [st['id'] for st in sresults['statements']]
+        r = self.client.get(reverse('lrs:statements_more', kwargs={'more_id': sresults['more'].split('/')[-1]}),
+                            X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(r.status_code, 200)
+        second_page = [st['id'] for st in json.loads(r.content)['statements']]
+        self.assertEqual(first_page + second_page,
+                         [getattr(self, "guid%s" % n) for n in range(16, 22)])
+
+        r = self.client.get(reverse('lrs:statements_more', kwargs={'more_id': 'notacursor'}),
+                            X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+        settings.STATEMENT_MORE_MODE = 'cache'
+        self.assertEqual(r.status_code, 404)
+
+    @override_settings(STATEMENT_MORE_MODE='cursor')
+    def test_tampered_cursor(self):
+        r = self.client.get(reverse('lrs:statements'), {"limit": 10},
+                            X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+        more = json.loads(r.content)['more'].split('/')[-1]
+        cursor = json.loads(base64.urlsafe_b64decode(str(more) + '=' * (-len(more) % 4)))
+
+        tampered = []
+        for key, value in (('position', [1]), ('position', [1, 2]), ('position', [cursor['position'][0], "2"]),
+                           ('filters', {'agent': "mailto:not@example.com"}), ('filters', {'verb': 42}),
+                           ('filters', {'activity': ["act:foo"]}), ('filters', {'since': "yesterday"}),
+                           ('filters', {'ascending': "true"}), ('format', "everything")):
+            altered = dict(cursor)
+            altered[key] = value
+            tampered.append(base64.urlsafe_b64encode(json.dumps(altered)).rstrip('='))
+        for more_id in tampered:
+            r = self.client.get(reverse('lrs:statements_more', kwargs={'more_id': more_id}),
+                                X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+            self.assertEqual(r.status_code, 404)
+
+        r = self.client.get(reverse('lrs:statements_more', kwargs={'more_id': more}),
+                            X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(r.status_code, 200)
+
+    def test_signed_more_stmts_url(self):
+        settings.STATEMENT_MORE_MODE = 'cursor'
+        r = self.client.get(reverse('lrs:statements'), {"limit": 10},
+                            X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+        unsigned = json.loads(r.content)['more'].split('/')[-1]
+
+        settings.STATEMENT_MORE_MODE = 'signed'
+        r = self.client.get(reverse('lrs:statements'), {"limit": 10},
+                            X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(r.status_code, 200)
+        token = json.loads(r.content)['more'].split('/')[-1]
+        r = self.client.get(reverse('lrs:statements_more', kwargs={'more_id': token}),
+                            X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(r.status_code, 200)
+        stmts = json.loads(r.content)['statements']
+        self.assertEqual([st['id'] for st in stmts],
+                         [getattr(self, "guid%s" % n) for n in range(15, 5, -1)])
+
+        # Altered tokens and unsigned cursors aren't accepted
+        payload, timestamp, signature = token.rsplit(':', 2)
+        altered = ':'.join([payload, timestamp, signature[::-1]])
+        for more_id in (altered, unsigned):
+            r = self.client.get(reverse('lrs:statements_more', kwargs={'more_id': more_id}),
+                                X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+            self.assertEqual(r.status_code, 404)
+
+        # Still valid once signing is off
+        settings.STATEMENT_MORE_MODE = 'cache'
+        r = self.client.get(reverse('lrs:statements_more', kwargs={'more_id': token}),
+                            X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(r.status_code, 200)
+
+    def test_streamed_stmts(self):
+        r = self.client.get(reverse('lrs:statements'), {"limit": 10},
+                            X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r['Content-Length'], str(len(r.content)))
+        whole = json.loads(r.content)
+
+        # Loaded a few statements at a time and streamed without a length
+        settings.STATEMENT_STREAM_THRESHOLD = 5
+        settings.STATEMENT_PAGE_CHUNK = 3
+        r = self.client.get(reverse('lrs:statements'), {"limit": 10},
+                            X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.streaming)
+        self.assertFalse(r.has_header('Content-Length'))
+        streamed = json.loads(''.join(r.streaming_content))
+        self.assertEqual([st['id'] for st in streamed['statements']],
+                         [st['id'] for st in whole['statements']])
+        self.assertEqual(len(streamed['statements']), 10)
+
+        r = self.client.get(reverse('lrs:statements_more', kwargs={'more_id': streamed['more'].split('/')[-1]}),
+                            X_Experience_API_Version=settings.XAPI_VERSION, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.streaming)
+        self.assertEqual(len(json.loads(''.join(r.streaming_content))['statements']), 10)
+        settings.STATEMENT_STREAM_THRESHOLD = 1000
+        settings.STATEMENT_PAGE_CHUNK = 500
+
+    def test_exact_page_json(self):
+        ids = list(Statement.objects.order_by('-stored').values_list('id', flat=True)[:10])
+        page = retrieve_statement.StatementPage(ids, None, 'exact')
+        # Only the stored statements are read, nothing related to them
+        with self.assertNumQueries(1):
+            stmts = [json.loads(st) for st in page.json()]
+        self.assertEqual(stmts, [Statement.objects.get(id=st_id).full_statement for st_id in ids])
+
+    def test_page_serializer_queries(self):
+        # Statements with an activity object, a context activity and an
+        # authority. A page of them is read with one query for the statements,
+        # one per context activity type and one each for their agents, verbs,
+        # activities and attachments, however many there are
+        ids = [Statement.objects.get(statement_id=getattr(self, "guid%s" % n)).id for n in range(1, 5)]
+        for stmt_format in ('canonical', 'ids'):
+            for page in (ids[:1], ids):
+                with self.assertNumQueries(9):
+                    stmts = serialize_statements(page, ['en-US'], stmt_format)
+                self.assertEqual(stmts, [Statement.objects.get(id=st_id).to_dict(['en-US'], stmt_format)
+                                         for st_id in page])
+
+    @override_settings(STATEMENT_RENDER_CACHE='default')
+    def test_render_cache(self):
+        ids = [Statement.objects.get(statement_id=getattr(self, "guid%s" % n)).id for n in range(1, 5)]
+        page = retrieve_statement.StatementPage(ids, ['en-US'], 'canonical')
+
+        def render():
+            stats = render_cache.stats()
+            stmts = list(page.json())
+            return stmts, render_cache.stats()['hits'] - stats['hits']
+
+        stmts, hits = render()
+        self.assertEqual(hits, 0)
+        self.assertEqual([json.loads(st) for st in stmts],
+                         json.loads(json.dumps(serialize_statements(ids, ['en-US'], 'canonical'))))
+        self.assertEqual(render(), (stmts, 4))
+        # Other languages and formats are separate
+        page.language = ['en-GB']
+        self.assertEqual(render()[1], 0)
+        page.language = ['en-US']
+
+        # Voided statements and definition changes are rendered again
+        render_cache.void(ids[:1])
+        self.assertEqual(render(), (stmts, 3))
+        Activity.objects.get(activity_id='act:foogie').save()
+        self.assertEqual(render(), (stmts, 0))
+        self.assertEqual(render(), (stmts, 4))
+
+    def test_render_memo(self):
+        ids = [Statement.objects.get(statement_id=getattr(self, "guid%s" % n)).id for n in range(1, 5)]
+        memo = RenderMemo()
+        first = serialize_statements(ids[:2], ['en-US'], 'canonical', memo)
+        # Their agents, verbs and activities are already rendered, only the
+        # statements, their context activities and attachments are read
+        with self.assertNumQueries(6):
+            second = serialize_statements(ids[:2], ['en-US'], 'canonical', memo)
+        self.assertEqual(first, second)
+        # Every statement has the same actor, rendered once
+        stmts = serialize_statements(ids, ['en-US'], 'canonical', memo)
+        self.assertTrue(all(st['actor'] is first[0]['actor'] for st in stmts))
+        self.assertEqual(stmts, serialize_statements(ids, ['en-US'], 'canonical'))
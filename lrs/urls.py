@@ -8,7 +8,7 @@ urlpatterns = [
     url(r'^$', RedirectView.as_view(url='/')),
 
     # xapi endpoints
-    url(r'^statements/more/(?P<more_id>.{32})$',
+    url(r'^statements/more/(?P<more_id>[A-Za-z0-9_\-.:]+)$',
         views.statements_more, name='statements_more'),
     url(r'^statements/more$', views.statements_more_placeholder,
         name='statements_more_placeholder'),
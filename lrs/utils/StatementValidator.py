@@ -4,45 +4,66 @@ from rfc3987 import parse as iriparse
 from uuid import UUID
 
 from . import convert_to_datatype
+from validation_cache import iri_cache, language_cache
 from ..exceptions import ParamError
 
-statement_allowed_fields = ['id', 'actor', 'verb', 'object', 'result', 'stored',
-                            'context', 'timestamp', 'authority', 'version', 'attachments']
-statement_required_fields = ['actor', 'verb', 'object']
+# Allowed fields are frozensets so checking an object is a set difference.
+# Required fields stay ordered, the first one missing is the one reported
+statement_allowed_fields = frozenset(['id', 'actor', 'verb', 'object', 'result', 'stored',
+                                      'context', 'timestamp', 'authority', 'version', 'attachments'])
+statement_required_fields = ('actor', 'verb', 'object')
 
-attachment_allowed_fields = ['usageType', 'display',
-                             'description', 'contentType', 'length', 'sha2', 'fileUrl']
-attachment_required_fields = ['usageType', 'display', 'contentType', 'length']
+attachment_allowed_fields = frozenset(['usageType', 'display',
+                                       'description', 'contentType', 'length', 'sha2', 'fileUrl'])
+attachment_required_fields = ('usageType', 'display', 'contentType', 'length')
 
 agent_ifis_can_only_be_one = ['mbox', 'mbox_sha1sum', 'openid', 'account']
-agent_allowed_fields = ['objectType', 'name', 'member',
-                        'mbox', 'mbox_sha1sum', 'openid', 'account']
+agent_allowed_fields = frozenset(['objectType', 'name', 'member',
+                                  'mbox', 'mbox_sha1sum', 'openid', 'account'])
 
-account_fields = ['homePage', 'name']
+account_fields = ('homePage', 'name')
+account_allowed_fields = frozenset(account_fields)
 
-verb_allowed_fields = ['id', 'display']
+verb_allowed_fields = frozenset(['id', 'display'])
 
-ref_fields = ['id', 'objectType']
+ref_fields = ('id', 'objectType')
+ref_allowed_fields = frozenset(ref_fields)
 
-activity_allowed_fields = ['objectType', 'id', 'definition']
+activity_allowed_fields = frozenset(['objectType', 'id', 'definition'])
 
-act_def_allowed_fields = ['name', 'description', 'type', 'moreInfo', 'extensions',
-                          'interactionType', 'correctResponsesPattern', 'choices', 'scale', 'source', 'target', 'steps']
+act_def_allowed_fields = frozenset(['name', 'description', 'type', 'moreInfo', 'extensions',
+                                    'interactionType', 'correctResponsesPattern', 'choices', 'scale', 'source', 'target', 'steps'])
 
-int_act_fields = ['id', 'description']
+int_act_fields = ('id', 'description')
+int_act_allowed_fields = frozenset(int_act_fields)
 
-sub_allowed_fields = ['actor', 'verb', 'object',
-                      'result', 'context', 'timestamp', "objectType"]
-sub_required_fields = ['actor', 'verb', 'object']
+sub_allowed_fields = frozenset(['actor', 'verb', 'object',
+                                'result', 'context', 'timestamp', "objectType"])
+sub_required_fields = ('actor', 'verb', 'object')
 
-result_allowed_fields = ['score', 'success',
-                         'completion', 'response', 'duration', 'extensions']
+result_allowed_fields = frozenset(['score', 'success',
+                                   'completion', 'response', 'duration', 'extensions'])
 
-score_allowed_fields = ['scaled', 'raw', 'min', 'max']
+score_allowed_fields = frozenset(['scaled', 'raw', 'min', 'max'])
 
-context_allowed_fields = ['registration', 'instructor', 'team', 'contextActivities',
-                          'revision', 'platform', 'language', 'statement', 'extensions']
+context_allowed_fields = frozenset(['registration', 'instructor', 'team', 'contextActivities',
+                                    'revision', 'platform', 'language', 'statement', 'extensions'])
 
+scorm_interaction_types = frozenset(['true-false', 'choice', 'fill-in', 'long-fill-in', 'matching',
+                                     'performance', 'sequencing', 'likert', 'numeric', 'other'])
+
+interaction_components = frozenset(["choices", "scale", "source", "target", "steps"])
+
+context_activity_types = ['parent', 'grouping', 'category', 'other']
+
+# Compiled once here instead of on every call
+email_re = re.compile("[^@]+@[^@]+\.[^@]+")
+sha1sum_re = re.compile('([a-fA-F\d]{40}$)')
+sha2_re = re.compile("^[a-f0-9]{64}$")
+version_re = re.compile("^1\.0(\.\d+)?$")
+language_part_re = re.compile("^[A-Za-z0-9]*$")
+duration_re = re.compile(
+    '^(-?)P(?=\d|T\d)(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)([DW]))?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d+)?)S)?)?$')
 
 
 class StatementValidator():
@@ -83,7 +104,6 @@ class StatementValidator():
     def validate_email(self, email):
         if isinstance(email, basestring):
             if email.startswith("mailto:"):
-                email_re = re.compile("[^@]+@[^@]+\.[^@]+")
                 if not email_re.match(email[7:]):
                     self.return_error(
                         "mbox value %s is not a valid email" % email)
@@ -97,16 +117,19 @@ class StatementValidator():
         if not isinstance(lang, basestring):
             self.return_error(
                 "language %s is not valid in %s" % (lang, field))
+        if language_cache.get(lang):
+            return
         lang_parts = lang.split('-')
         for idx, part in enumerate(lang_parts):
             # If part exists and is only alpha/numeric
-            if part and re.match("^[A-Za-z0-9]*$", part):
+            if part and language_part_re.match(part):
                 if len(part) > 8:
                     self.return_error(
                         "language %s is not valid in %s" % (lang, field))
             else:
                 self.return_error(
-                    "language %s is not valid in %s" % (lang, field))        
+                    "language %s is not valid in %s" % (lang, field))
+        language_cache.set(lang, True)
 
     def validate_lang_map(self, lang_map, field):
         for lang in lang_map:
@@ -120,7 +143,6 @@ class StatementValidator():
 
     def validate_email_sha1sum(self, sha1sum):
         if isinstance(sha1sum, basestring):
-            sha1sum_re = re.compile('([a-fA-F\d]{40}$)')
             if not sha1sum_re.match(sha1sum):
                 self.return_error(
                     "mbox_sha1sum value [%s] is not a valid sha1sum" % sha1sum)
@@ -129,11 +151,14 @@ class StatementValidator():
 
     def validate_iri(self, iri_value, field):
         if isinstance(iri_value, basestring):
+            if iri_cache.get(iri_value):
+                return
             try:
                 iriparse(iri_value, rule='IRI')
             except Exception:
                 self.return_error(
                     "%s with value %s was not a valid IRI" % (field, iri_value))
+            iri_cache.set(iri_value, True)
         else:
             self.return_error("%s must be a string type" % field)
 
@@ -148,26 +173,32 @@ class StatementValidator():
         else:
             self.return_error("%s must be a string type" % field)
 
-    def check_if_dict(self, obj, field):
+    # The field/obj_name these take can be a format string with its args
+    # passed after it, so the name is only built when there is an error
+
+    def check_if_dict(self, obj, field, *args):
         if not isinstance(obj, dict):
             self.return_error(
-                "%s is not a properly formatted dictionary" % field)
+                "%s is not a properly formatted dictionary" % (field % args if args else field))
 
-    def check_if_list(self, obj, field):
+    def check_if_list(self, obj, field, *args):
         if not isinstance(obj, list):
-            self.return_error("%s is not a properly formatted array" % field)
-
-    def check_allowed_fields(self, allowed, obj, obj_name):
-        # Check for fields that aren't in spec
-        failed_list = [x for x in obj.keys() if x not in allowed]
-        if failed_list:
+            self.return_error("%s is not a properly formatted array" %
+                              (field % args if args else field))
+
+    def check_allowed_fields(self, allowed, obj, obj_name, *args):
+        # Check for fields that aren't in spec. allowed is a frozenset, the
+        # failed fields are listed in the object's order
+        if obj.viewkeys() - allowed:
+            failed_list = [x for x in obj.keys() if x not in allowed]
             self.return_error("Invalid field(s) found in %s - %s" %
-                              (obj_name, ', '.join(failed_list)))
+                              (obj_name % args if args else obj_name, ', '.join(failed_list)))
 
-    def check_required_fields(self, required, obj, obj_name):
+    def check_required_fields(self, required, obj, obj_name, *args):
         for field in required:
             if field not in obj:
-                self.return_error("%s is missing in %s" % (field, obj_name))
+                self.return_error("%s is missing in %s" %
+                                  (field, obj_name % args if args else obj_name))
 
     def validate_statement(self, stmt):
         # Ensure dict was submitted as stmt and check allowed and required
@@ -181,8 +212,7 @@ class StatementValidator():
         # is 1.0.0 +
         if 'version' in stmt:
             if isinstance(stmt['version'], basestring):
-                version_regex = re.compile("^1\.0(\.\d+)?$")
-                if not version_regex.match(stmt['version']):
+                if not version_re.match(stmt['version']):
                     self.return_error(
                         "%s is not a supported version" % stmt['version'])
             else:
@@ -280,7 +310,6 @@ class StatementValidator():
                 # Ensure sha2 is submitted as string
                 if not isinstance(attach['sha2'], basestring):
                     self.return_error("Attachment sha2 must be a string")
-                sha2_re =  re.compile("^[a-f0-9]{64}$")
                 if not sha2_re.match(attach['sha2']):
                     self.return_error("Not a valid sha2 inside the statement")
 
@@ -306,7 +335,7 @@ class StatementValidator():
 
     def validate_extensions(self, extensions, field):
         # Ensure incoming extensions is a dict
-        self.check_if_dict(extensions, "%s extensions" % field)
+        self.check_if_dict(extensions, "%s extensions", field)
 
         # Ensure each key in extensions is a valid IRI
         for k, v in extensions.items():
@@ -314,7 +343,7 @@ class StatementValidator():
 
     def validate_agent(self, agent, placement):
         # Ensure incoming agent is a dict and check allowed fields
-        self.check_if_dict(agent, "Agent in %s" % placement)
+        self.check_if_dict(agent, "Agent in %s", placement)
         self.check_allowed_fields(agent_allowed_fields, agent, "Agent/Group")
         # If the agent is the object of a stmt, the objectType must be present
         if placement == 'object' and 'objectType' not in agent:
@@ -398,7 +427,7 @@ class StatementValidator():
         # Ensure incoming account is a dict and check allowed and required
         # fields
         self.check_if_dict(account, "Account")
-        self.check_allowed_fields(account_fields, account, "Account")
+        self.check_allowed_fields(account_allowed_fields, account, "Account")
         self.check_required_fields(account_fields, account, "Account")
 
         # Ensure homePage is a valid IRI
@@ -461,7 +490,7 @@ class StatementValidator():
             self.return_error(
                 "StatementRef objectType must be set to 'StatementRef'")
 
-        self.check_allowed_fields(ref_fields, ref, "StatementRef")
+        self.check_allowed_fields(ref_allowed_fields, ref, "StatementRef")
         self.check_required_fields(ref_fields, ref, "StatementRef")
 
         # Ensure id is a valid UUID
@@ -516,9 +545,6 @@ class StatementValidator():
                 self.return_error(
                     "Activity definition interactionType must be a string")
 
-            scorm_interaction_types = ['true-false', 'choice', 'fill-in', 'long-fill-in', 'matching', 'performance',
-                                       'sequencing', 'likert', 'numeric', 'other']
-
             # Check if valid SCORM interactionType
             if definition['interactionType'] not in scorm_interaction_types:
                 self.return_error("Activity definition interactionType %s is not valid" % definition[
@@ -549,12 +575,7 @@ class StatementValidator():
                 definition['extensions'], 'activity definition extensions')
 
     def check_other_interaction_component_fields(self, allowed, definition):
-        interaction_components = set(
-            ["choices", "scale", "source", "target", "steps"])
-        keys = set(definition.keys())
-
-        both = interaction_components.intersection(keys)
-        not_allowed = list(both - set(allowed))
+        not_allowed = list(interaction_components.intersection(definition) - set(allowed))
 
         if not_allowed:
             self.return_error("Only interaction component field(s) allowed (%s) - not allowed: %s" %
@@ -608,11 +629,11 @@ class StatementValidator():
         for act in activities:
             # Ensure each interaction activity is a dict and check allowed
             # fields
-            self.check_if_dict(act, "%s interaction component" % field)
+            self.check_if_dict(act, "%s interaction component", field)
             self.check_allowed_fields(
-                int_act_fields, act, "Activity definition %s" % field)
+                int_act_allowed_fields, act, "Activity definition %s", field)
             self.check_required_fields(
-                int_act_fields, act, "Activity definition %s" % field)
+                int_act_fields, act, "Activity definition %s", field)
 
             # Ensure id value is string
             if not isinstance(act['id'], basestring):
@@ -623,7 +644,7 @@ class StatementValidator():
             if 'description' in act:
                 # Ensure description is a dict (language map)
                 self.check_if_dict(
-                    act['description'], "%s interaction component description" % field)
+                    act['description'], "%s interaction component description", field)
                 self.validate_lang_map(act['description'].keys(
                 ), "%s interaction component description" % field)
 
@@ -682,8 +703,6 @@ class StatementValidator():
         # Ensure incoming result is dict and check allowed fields
         self.check_if_dict(result, "Result")
         self.check_allowed_fields(result_allowed_fields, result, "Result")
-        duration_re = re.compile(
-            '^(-?)P(?=\d|T\d)(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)([DW]))?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d+)?)S)?)?$')
         # If duration included, ensure valid duration can be parsed from it
         if 'duration' in result:
             if not duration_re.match(result['duration']):
@@ -818,7 +837,6 @@ class StatementValidator():
     def validate_context_activities(self, conacts):
         # Ensure incoming conact is dict
         self.check_if_dict(conacts, "Context activity")
-        context_activity_types = ['parent', 'grouping', 'category', 'other']
         for conact in conacts.items():
             # Check if conact is a valid type
             if not conact[0] in context_activity_types:
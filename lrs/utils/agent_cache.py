@@ -0,0 +1,120 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from .lru_cache import LRUCache
+
+SHARED_KEY_PREFIX = 'lrs_agent:'
+
+
+def ifi_key(ifp_dict):
+    # ifp_dict is in field form (account already split into account_homePage
+    # and account_name) so the key is the same however the agent was sent
+    return tuple(sorted(ifp_dict.items()))
+
+
+def agent_keys(agent):
+    keys = []
+    if agent.mbox:
+        keys.append(ifi_key({'mbox': agent.mbox}))
+    if agent.mbox_sha1sum:
+        keys.append(ifi_key({'mbox_sha1sum': agent.mbox_sha1sum}))
+    if agent.openid:
+        keys.append(ifi_key({'openid': agent.openid}))
+    if agent.account_name:
+        keys.append(ifi_key({'account_homePage': agent.account_homePage,
+                             'account_name': agent.account_name}))
+    if agent.oauth_identifier:
+        keys.append(ifi_key({'oauth_identifier': agent.oauth_identifier}))
+    return keys
+
+
+def agent_row(agent):
+    return {f.attname: getattr(agent, f.attname)
+            for f in agent._meta.concrete_fields}
+
+
+def shared_key(key):
+    return SHARED_KEY_PREFIX + hashlib.sha1(json.dumps(key)).hexdigest()
+
+
+class AgentCache():
+    # Maps an agent's inverse functional identifier to its row (primary key
+    # plus the rest of its columns) so retrieving a known agent doesn't hit the
+    # agent table. The in-process LRU is checked first, then the shared cache
+    # if AGENT_CACHE_SHARED names one. Members are never cached - group
+    # membership is always read from the database - and entries are only
+    # written once the transaction that read or created the agent commits, so
+    # a group is never cached before its members are saved.
+
+    def __init__(self):
+        self.local = LRUCache(settings.AGENT_CACHE_SIZE,
+                              settings.AGENT_CACHE_TIMEOUT)
+        self.shared_hits = 0
+        self.misses = 0
+
+    def shared(self):
+        if settings.AGENT_CACHE_SHARED:
+            return caches[settings.AGENT_CACHE_SHARED]
+        return None
+
+    def get(self, model, ifp_dict):
+        key = ifi_key(ifp_dict)
+        row = self.local.get(key)
+        if row is None:
+            shared = self.shared()
+            if shared is not None:
+                row = shared.get(shared_key(key))
+                if row is not None:
+                    self.shared_hits += 1
+                    self.local.set(key, row)
+        fields = [f.attname for f in model._meta.concrete_fields]
+        # Rows cached before a schema change are treated as missing
+        if row is None or set(fields) != set(row):
+            self.misses += 1
+            return None
+        return model.from_db(DEFAULT_DB_ALIAS, fields, [row[f] for f in fields])
+
+    def store(self, keys, row):
+        shared = self.shared()
+        for key in keys:
+            self.local.set(key, row)
+            if shared is not None:
+                shared.set(shared_key(key), row, settings.AGENT_CACHE_TIMEOUT)
+
+    def add(self, agent):
+        # Take the row now, a later save() in the same transaction
+        # invalidates it again after this runs
+        keys = agent_keys(agent)
+        if keys:
+            row = agent_row(agent)
+            transaction.on_commit(lambda: self.store(keys, row))
+
+    def remove(self, keys):
+        shared = self.shared()
+        for key in keys:
+            self.local.delete(key)
+            if shared is not None:
+                shared.delete(shared_key(key))
+
+    def invalidate(self, agent):
+        # Drop it now so the rest of this transaction reads the database, and
+        # again on commit in case another request cached the old row meanwhile
+        keys = agent_keys(agent)
+        self.remove(keys)
+        transaction.on_commit(lambda: self.remove(keys))
+
+    def clear(self):
+        self.local.clear()
+        self.shared_hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'local_hits': self.local.hits, 'shared_hits': self.shared_hits,
+                'misses': self.misses, 'size': len(self.local),
+                'max_size': self.local.size}
+
+agent_cache = AgentCache()
@@ -0,0 +1,130 @@
+import errno
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.files import File
+
+from ..exceptions import BadRequest
+
+# Parts still being written, they get their sha2 name once complete
+PART_SUFFIX = '.part'
+# Longest time (seconds) between sweeps of expired payloads
+SWEEP_INTERVAL = 3600
+
+
+class SpooledPayload(File):
+    # A complete payload in the spool. Storage renames it into place through
+    # temporary_file_path instead of reading it, so no file is held open
+
+    def __init__(self, path, size):
+        super(SpooledPayload, self).__init__(None, path)
+        self.size = size
+
+    def temporary_file_path(self):
+        return self.name
+
+    def read(self):
+        with open(self.name, 'rb') as f:
+            return f.read()
+
+    def close(self):
+        pass
+
+
+class AttachmentSpool():
+    # Content-addressed store on the local filesystem for attachment payloads
+    # between parsing a request and saving its statements. A payload is
+    # written to a temporary part file and renamed to its sha2 once complete,
+    # so the same payload is only spooled once however many requests send it,
+    # and renamed again into the attachment storage when its statement is
+    # saved. ATTACHMENT_SPOOL_DIR must be on the same filesystem as
+    # MEDIA_ROOT for that rename to be atomic. Payloads left behind by failed
+    # requests are removed once they're older than ATTACHMENT_SPOOL_TTL, and
+    # a request is refused when the spool would grow past
+    # ATTACHMENT_SPOOL_QUOTA bytes.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_sweep = 0
+
+    def directory(self):
+        directory = settings.ATTACHMENT_SPOOL_DIR
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return directory
+
+    def path(self, sha2):
+        return os.path.join(self.directory(), sha2)
+
+    def files(self):
+        # (path, size, modified time) of everything in the spool
+        directory = self.directory()
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Renamed or swept meanwhile
+                continue
+            yield path, stat.st_size, stat.st_mtime
+
+    def usage(self):
+        return sum(size for path, size, mtime in self.files())
+
+    def available(self):
+        # Bytes that can still be spooled, sweeping first if the spool is full
+        # or hasn't been swept for a while
+        now = time.time()
+        if now - self.last_sweep > min(SWEEP_INTERVAL, settings.ATTACHMENT_SPOOL_TTL):
+            self.sweep(now)
+        available = settings.ATTACHMENT_SPOOL_QUOTA - self.usage()
+        if available <= 0:
+            self.sweep(now)
+            available = settings.ATTACHMENT_SPOOL_QUOTA - self.usage()
+        return available
+
+    def sweep(self, now=None):
+        # Removes payloads older than the TTL, returns how many there were
+        now = now or time.time()
+        with self.lock:
+            self.last_sweep = now
+            removed = 0
+            for path, size, mtime in self.files():
+                if now - mtime > settings.ATTACHMENT_SPOOL_TTL:
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        pass
+            return removed
+
+    def new_part(self):
+        # Open file and path a part is written to before its sha2 is known
+        fd, path = tempfile.mkstemp(suffix=PART_SUFFIX, dir=self.directory())
+        return os.fdopen(fd, 'wb'), path
+
+    def store(self, part_path, sha2, size):
+        # Another copy of the same payload is simply replaced, which also
+        # restarts its TTL
+        path = self.path(sha2)
+        os.rename(part_path, path)
+        return SpooledPayload(path, size)
+
+    def discard(self, part_path):
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+
+    def quota_exceeded(self):
+        raise BadRequest(
+            "Attachments would exceed the attachment spool quota of %s bytes" %
+            settings.ATTACHMENT_SPOOL_QUOTA)
+
+attachment_spool = AttachmentSpool()
@@ -0,0 +1,53 @@
+import base64
+import hashlib
+from Crypto.PublicKey import RSA
+from jose import jws
+
+from django.conf import settings
+
+from lru_cache import LRUCache
+from process_pool import ProcessPool
+
+# Parsed public keys by certificate fingerprint. Each pool worker fills its
+# own copy
+key_cache = LRUCache(settings.JWS_KEY_CACHE_SIZE)
+
+pool = ProcessPool('JWS_VERIFY_PROCESSES')
+
+
+def cert_fingerprint(der):
+    return hashlib.sha256(der).hexdigest()
+
+
+def cert_to_key(cert):
+    # cert is a base64 encoded x5c entry
+    der = base64.b64decode(cert)
+    fingerprint = cert_fingerprint(der)
+    key = key_cache.get(fingerprint)
+    if key is None:
+        key = RSA.importKey(der)
+        key_cache.set(fingerprint, key)
+    return key
+
+
+def verify_signature(job):
+    # job is (signature, cert, algorithm). Returns the error message for a
+    # signature that doesn't verify, None if it does. Only takes and returns
+    # strings so it can run in the pool
+    signature, cert, algorithm = job
+    try:
+        verified = jws.verify(signature, cert_to_key(cert), algorithm)
+    except Exception as e:
+        return "The JWS is not valid: %s" % e.message
+    if not verified:
+        return "The JWS is not valid - could not verify signature"
+    return None
+
+
+def verify_signatures(jobs):
+    # Returns verify_signature's result for each job, in order. Enough
+    # signatures to be worth it are spread over the pool's processes, RSA
+    # verification holds the GIL so threads wouldn't help
+    if len(jobs) < settings.JWS_VERIFY_PARALLEL_THRESHOLD:
+        return [verify_signature(job) for job in jobs]
+    return pool.map(verify_signature, jobs)
@@ -0,0 +1,215 @@
+import cgi
+import hashlib
+from cStringIO import StringIO
+from email.parser import HeaderParser
+
+from attachment_spool import attachment_spool
+from ..exceptions import BadRequest
+
+READ_SIZE = 65536
+# Part headers are only a few lines, anything longer isn't a valid part
+MAX_HEADER_SIZE = 16384
+
+MULTIPART_HEADER = 'Content-Type: multipart/mixed; boundary='
+
+
+def get_boundary(content_type):
+    # Boundary parameter of a multipart Content-Type, quoted or not
+    if content_type:
+        boundary = cgi.parse_header(content_type)[1].get('boundary', None)
+        if boundary:
+            return boundary
+    return None
+
+
+class Part():
+    # Headers of a part are read like the email.message.Message they're
+    # parsed into
+
+    def __getitem__(self, name):
+        return self.headers[name]
+
+    def __contains__(self, name):
+        return name in self.headers
+
+    def get(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class MemoryPart(Part):
+    # A part whose content is kept in memory (the statements), capped at
+    # max_size bytes
+
+    def __init__(self, headers, max_size):
+        self.headers = headers
+        self.max_size = max_size
+        self.content = StringIO()
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise BadRequest(
+                "Statement part is larger than the maximum of %s bytes" % self.max_size)
+        self.content.write(data)
+
+    def finish(self):
+        pass
+
+    def abort(self):
+        pass
+
+    def read(self):
+        return self.content.getvalue()
+
+
+class SpooledPart(Part):
+    # A part whose content is written to the attachment spool as it arrives
+    # and hashed on the way, so the payload is never held in memory. Once
+    # complete, file is the spooled payload
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.available = attachment_spool.available()
+        self.part_file, self.part_path = attachment_spool.new_part()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.available:
+            attachment_spool.quota_exceeded()
+        self.sha256.update(data)
+        self.part_file.write(data)
+
+    def finish(self):
+        self.part_file.close()
+        self.sha2 = self.sha256.hexdigest()
+        self.file = attachment_spool.store(self.part_path, self.sha2, self.size)
+
+    def abort(self):
+        self.part_file.close()
+        attachment_spool.discard(self.part_path)
+
+    def read(self):
+        # Only for small parts, i.e. JWS signatures
+        return self.file.read()
+
+
+class MultipartStream():
+    # Reads a multipart body from the request part by part. Content is handed
+    # to the part as it's read, at most one read buffer plus the length of
+    # the boundary is held in memory. The line break before each boundary
+    # belongs to the boundary (RFC 2046), so a part's content is exactly the
+    # bytes that were sent.
+
+    def __init__(self, stream, content_type):
+        self.stream = stream
+        self.eof = False
+        # Starting with a line break lets the first boundary match at the very
+        # start of the body
+        self.buffer = '\n'
+        self.boundary = get_boundary(content_type)
+        if not self.boundary:
+            # The header can also be at the start of the body itself
+            line_end = self.find('\n', 1, MAX_HEADER_SIZE)
+            first_line = self.buffer[1:line_end].rstrip('\r')
+            if first_line.startswith(MULTIPART_HEADER):
+                self.boundary = get_boundary(first_line[len('Content-Type:'):])
+            if not self.boundary:
+                raise BadRequest(
+                    "Could not find the boundary for the multipart content")
+        self.delimiter = '\n--' + self.boundary
+
+    def read(self):
+        if self.eof:
+            return False
+        data = self.stream.read(READ_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer += data
+        return True
+
+    def find(self, value, start=0, limit=None):
+        # Index of value in the buffer, reading until it's there. -1 at the
+        # end of the body or once more than limit bytes have been searched
+        while True:
+            index = self.buffer.find(value, start)
+            if index != -1 or (limit and len(self.buffer) - start > limit) or not self.read():
+                return index
+
+    def skip_boundary(self, index):
+        # Drops everything up to the end of the boundary line at index,
+        # returns False if it was the closing boundary
+        end = index + len(self.delimiter)
+        while len(self.buffer) < end + 2 and self.read():
+            pass
+        closing = self.buffer[end:end + 2] == '--'
+        line_end = self.find('\n', end, MAX_HEADER_SIZE)
+        if line_end == -1:
+            if not closing:
+                raise BadRequest("Could not parse the multipart content")
+            line_end = len(self.buffer)
+        self.buffer = self.buffer[line_end + 1:]
+        return not closing
+
+    def read_headers(self):
+        lines = []
+        start = 0
+        while True:
+            line_end = self.find('\n', start, MAX_HEADER_SIZE)
+            if line_end == -1 or line_end > MAX_HEADER_SIZE:
+                raise BadRequest("Could not parse the headers of a multipart part")
+            line = self.buffer[start:line_end].rstrip('\r')
+            start = line_end + 1
+            if not line:
+                break
+            lines.append(line)
+        # Keep the blank line's line break, the content may be empty and the
+        # next boundary start right after it
+        self.buffer = self.buffer[start - 1:]
+        return HeaderParser().parsestr('\n'.join(lines))
+
+    def read_content(self, part):
+        # Writes the part's content into part, returns whether another part
+        # follows
+        keep = len(self.delimiter) + 1
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index != -1:
+                end = index
+                if end and self.buffer[end - 1] == '\r':
+                    end -= 1
+                # The first character has either been written already or is
+                # the line break before the content
+                part.write(self.buffer[1:end] if end else '')
+                part.finish()
+                return self.skip_boundary(index)
+            if len(self.buffer) > keep:
+                # Hold back what could be the start of the boundary and its
+                # carriage return
+                part.write(self.buffer[1:-keep])
+                self.buffer = self.buffer[-keep - 1:]
+            if not self.read():
+                raise BadRequest(
+                    "Multipart content ended before its closing boundary")
+
+    def parts(self, new_part):
+        # Yields each part once its content has been read. new_part(headers,
+        # index) returns the part the content is written to, so a part can be
+        # rejected on its headers before its content is read
+        index = self.find(self.delimiter, 0, MAX_HEADER_SIZE)
+        if index == -1:
+            raise BadRequest("Could not find the boundary in the multipart content")
+        more = self.skip_boundary(index)
+        count = 0
+        while more:
+            part = new_part(self.read_headers(), count)
+            try:
+                more = self.read_content(part)
+            except Exception:
+                part.abort()
+                raise
+            count += 1
+            yield part
@@ -0,0 +1,39 @@
+from django.conf import settings
+
+from process_pool import ProcessPool
+from StatementValidator import StatementValidator
+from ..exceptions import ParamError
+
+pool = ProcessPool('STATEMENT_VALIDATE_PROCESSES')
+
+
+def validate_chunk(statements):
+    # Runs in the pool. Returns the error of the first invalid statement, or
+    # the statements as the validator left them since it fills in missing
+    # objectTypes and the pool only works on copies
+    try:
+        StatementValidator(statements).validate()
+    except Exception as e:
+        return e.message, None
+    return None, statements
+
+
+def validate_statements(statements):
+    # Validates a list of statements like StatementValidator(statements)
+    # does, raising a ParamError for the first invalid one. Batches of at
+    # least STATEMENT_VALIDATE_PARALLEL_THRESHOLD statements are split into
+    # chunks validated in the pool. The results come back in order, so the
+    # error reported is still the one of the lowest invalid statement
+    threshold = settings.STATEMENT_VALIDATE_PARALLEL_THRESHOLD
+    if not threshold or len(statements) < threshold:
+        StatementValidator(statements).validate()
+        return
+
+    size = settings.STATEMENT_VALIDATE_CHUNK
+    chunks = [statements[i:i + size] for i in range(0, len(statements), size)]
+    validated = []
+    for error, chunk in pool.map(validate_chunk, chunks):
+        if error is not None:
+            raise ParamError(error)
+        validated.extend(chunk)
+    statements[:] = validated
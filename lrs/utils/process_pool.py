@@ -0,0 +1,52 @@
+import multiprocessing
+import os
+import threading
+import weakref
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+# Every database connection opened in this process, of any thread. Pool
+# processes are forked while requests are being served, so they start with
+# copies of all of them
+open_connections = weakref.WeakSet()
+
+
+def track_connection(sender, connection, **kwargs):
+    open_connections.add(connection.connection)
+connection_created.connect(track_connection)
+
+
+def detach_connections():
+    # Runs first in each pool process. Its copies of the database sockets are
+    # pointed at /dev/null, nothing it does - not even the connection objects
+    # being freed - can write to the server's sessions of the parent
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for conn in list(open_connections):
+        if not conn.closed:
+            os.dup2(devnull, conn.fileno())
+    os.close(devnull)
+    open_connections.clear()
+
+
+class ProcessPool():
+    # A multiprocessing pool of as many processes as the setting named
+    # processes says (None for one per CPU), created on first use. One
+    # created before the process serving requests was forked belongs to the
+    # parent, the child creates its own
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.pool = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                self.pool = multiprocessing.Pool(getattr(settings, self.processes), initializer=detach_connections)
+                self.pid = os.getpid()
+        return self.pool
+
+    def map(self, func, iterable):
+        return self.get().map(func, iterable)
@@ -0,0 +1,162 @@
+from collections import OrderedDict
+
+from . import get_lang
+
+IFP_KEYS = set(['mbox', 'mbox_sha1sum', 'openid', 'account'])
+CONTEXT_ACTIVITY_TYPES = ('parent', 'grouping', 'category', 'other')
+# Parts of an activity definition with a language map description
+INTERACTION_COMPONENTS = ('scale', 'choices', 'steps', 'source', 'target')
+
+
+class RenderMemo():
+    # Rendered agents, verbs and activities by (kind, pk, lang, ids_only), so
+    # one that's in many statements of a request is rendered once. The same
+    # fragment goes into every statement it's in, nothing may change it
+
+    def __init__(self):
+        self.fragments = {}
+
+    def key(self, kind, pk, lang, ids_only):
+        return kind, pk, tuple(lang) if lang else None, ids_only
+
+    def has(self, kind, pk, lang, ids_only):
+        return self.key(kind, pk, lang, ids_only) in self.fragments
+
+    def get(self, kind, pk, lang, ids_only, render):
+        # render() is only called the first time
+        key = self.key(kind, pk, lang, ids_only)
+        if key not in self.fragments:
+            self.fragments[key] = render()
+        return self.fragments[key]
+
+
+# The xAPI JSON of the statement parts. They work from plain values - a
+# mapping of an object's fields (vars() of a model instance or a values() row)
+# or the fields themselves - so statements can be rendered from models or
+# from rows read for a whole page at once
+
+
+def render_agent(agent, ids_only, members=()):
+    # members are the group's rendered members, only read if they're shown
+    ret = OrderedDict()
+    if agent['mbox']:
+        ret['mbox'] = agent['mbox']
+    if agent['mbox_sha1sum']:
+        ret['mbox_sha1sum'] = agent['mbox_sha1sum']
+    if agent['openid']:
+        ret['openid'] = agent['openid']
+    if agent['account_name']:
+        ret['account'] = OrderedDict()
+        ret['account']['name'] = agent['account_name']
+        ret['account']['homePage'] = agent['account_homePage']
+    if agent['objectType'] == 'Group':
+        ret['objectType'] = agent['objectType']
+        # show members for groups if ids_only is false
+        # show members' ids for anon groups if ids_only is true
+        if not ids_only or not (IFP_KEYS & set(ret.keys())):
+            members = list(members)
+            if members:
+                ret['member'] = members
+
+    ret['objectType'] = agent['objectType']
+    if agent['name'] and not ids_only:
+        ret['name'] = agent['name']
+    return ret
+
+
+def render_verb(verb_id, canonical_data, lang, ids_only):
+    if ids_only:
+        return {'id': verb_id}
+    ret = OrderedDict(canonical_data)
+    if 'display' in ret and ret['display'].items():
+        ret['display'] = get_lang(canonical_data['display'], lang)
+    return ret
+
+
+def render_activity(activity_id, canonical_data, lang, ids_only):
+    # Copies what it changes, canonical_data is left as it is
+    if ids_only:
+        return {'id': activity_id}
+    ret = OrderedDict(canonical_data)
+    if 'objectType' not in ret:
+        ret['objectType'] = 'Activity'
+    if 'definition' in ret:
+        definition = ret['definition'] = OrderedDict(ret['definition'])
+        for key in ('name', 'description'):
+            if key in definition and definition[key].items():
+                definition[key] = get_lang(definition[key], lang)
+        for key in INTERACTION_COMPONENTS:
+            if key in definition:
+                definition[key] = [render_component(c, lang) for c in definition[key]]
+    return ret
+
+
+def render_component(component, lang):
+    if component.get('description'):
+        component = OrderedDict(component)
+        component['description'] = get_lang(component['description'], lang)
+    return component
+
+
+def render_attachment(canonical_data, lang):
+    ret = OrderedDict(canonical_data)
+    if 'display' in ret and ret['display'].items():
+        ret['display'] = get_lang(canonical_data['display'], lang)
+    if 'description' in ret and ret['description'].items():
+        ret['description'] = get_lang(canonical_data['description'], lang)
+    return ret
+
+
+def render_result(stmt):
+    # The result of a statement or substatement, None if it has none
+    ret = OrderedDict()
+    if stmt['result_success'] is not None:
+        ret['success'] = stmt['result_success']
+    if stmt['result_completion'] is not None:
+        ret['completion'] = stmt['result_completion']
+    if stmt['result_response']:
+        ret['response'] = stmt['result_response']
+    if stmt['result_duration']:
+        ret['duration'] = stmt['result_duration']
+
+    score = OrderedDict()
+    for key in ('scaled', 'raw', 'min', 'max'):
+        if stmt['result_score_%s' % key] is not None:
+            score[key] = stmt['result_score_%s' % key]
+    if score:
+        ret['score'] = score
+    if stmt['result_extensions']:
+        ret['extensions'] = stmt['result_extensions']
+    return ret or None
+
+
+def render_context(stmt, instructor, team, context_activities):
+    # The context of a statement or substatement, None if it has none.
+    # instructor and team are rendered agents, context_activities the
+    # rendered activities of each context activity type
+    ret = OrderedDict()
+    if stmt['context_registration']:
+        ret['registration'] = stmt['context_registration']
+    if instructor:
+        ret['instructor'] = instructor
+    if team:
+        ret['team'] = team
+    if stmt['context_revision']:
+        ret['revision'] = stmt['context_revision']
+    if stmt['context_platform']:
+        ret['platform'] = stmt['context_platform']
+    if stmt['context_language']:
+        ret['language'] = stmt['context_language']
+    if stmt['context_statement']:
+        ret['statement'] = {
+            'id': stmt['context_statement'], 'objectType': 'StatementRef'}
+
+    activities = OrderedDict()
+    for con_act_type in CONTEXT_ACTIVITY_TYPES:
+        if context_activities.get(con_act_type):
+            activities[con_act_type] = context_activities[con_act_type]
+    if activities:
+        ret['contextActivities'] = activities
+    if stmt['context_extensions']:
+        ret['extensions'] = stmt['context_extensions']
+    return ret or None
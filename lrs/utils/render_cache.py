@@ -0,0 +1,92 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+# Shared token that changes whenever an activity or verb definition is
+# rewritten. It's part of every entry's key, so a new one drops them all
+GENERATION_KEY = 'lrs_render_cache_generation'
+KEY_PREFIX = 'lrs_render:'
+
+
+class RenderCache():
+    # The JSON of statements rendered in the canonical and ids formats, one
+    # entry per statement holding each format and language list it was asked
+    # for. Stored statements don't change apart from being voided, which drops
+    # their entry, but what they render to also depends on the definitions of
+    # their activities and verbs - changing any of those starts a new
+    # generation of entries. Only used if STATEMENT_RENDER_CACHE names a cache
+    # in CACHES.
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def store(self):
+        if settings.STATEMENT_RENDER_CACHE:
+            return caches[settings.STATEMENT_RENDER_CACHE]
+        return None
+
+    def generation(self, store):
+        generation = store.get(GENERATION_KEY)
+        if generation is None:
+            store.add(GENERATION_KEY, uuid.uuid4().hex, None)
+            generation = store.get(GENERATION_KEY)
+        return generation
+
+    def key(self, generation, stmt_id):
+        return '%s%s:%s' % (KEY_PREFIX, generation, stmt_id)
+
+    def render(self, stmt_ids, lang, stmt_format, render):
+        # Returns {statement id: JSON} for the statements. The ones that
+        # aren't cached are rendered with render(ids), which returns the same
+        # map for them, and added
+        store = self.store()
+        if store is None:
+            return render(stmt_ids)
+        variant = '%s:%s' % (stmt_format, ','.join(lang or ()))
+        generation = self.generation(store)
+        keys = {stmt_id: self.key(generation, stmt_id) for stmt_id in stmt_ids}
+        found = store.get_many(keys.values())
+        entries = {stmt_id: found.get(key, {}) for stmt_id, key in keys.iteritems()}
+        rendered = {stmt_id: entry[variant] for stmt_id, entry in entries.iteritems()
+                    if variant in entry}
+        missing = [stmt_id for stmt_id in stmt_ids if stmt_id not in rendered]
+        self.hits += len(rendered)
+        self.misses += len(missing)
+        if missing:
+            fresh = render(missing)
+            for stmt_id, stmt_json in fresh.iteritems():
+                entries[stmt_id][variant] = stmt_json
+            store.set_many({keys[stmt_id]: entries[stmt_id] for stmt_id in fresh})
+            rendered.update(fresh)
+        return rendered
+
+    def remove(self, stmt_ids):
+        store = self.store()
+        if store is not None:
+            generation = self.generation(store)
+            store.delete_many([self.key(generation, stmt_id) for stmt_id in stmt_ids])
+
+    def void(self, stmt_ids):
+        # Drop them now and again on commit in case another request rendered
+        # them meanwhile
+        self.remove(stmt_ids)
+        transaction.on_commit(lambda: self.remove(stmt_ids))
+
+    def new_generation(self):
+        store = self.store()
+        if store is not None:
+            store.set(GENERATION_KEY, uuid.uuid4().hex, None)
+
+    def invalidate_definitions(self):
+        # An activity or verb definition changed, now and on commit like
+        # void()
+        self.new_generation()
+        transaction.on_commit(self.new_generation)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+render_cache = RenderCache()
@@ -1,28 +1,26 @@
 import ast
-import base64
-import email
-import hashlib
+import cgi
 import json
 from isodate.isoerror import ISO8601Error
 from isodate.isodatetime import parse_datetime
-from Crypto.PublicKey import RSA
 from jose import jws
 
+from django.conf import settings
 from django.contrib.sites.shortcuts import get_current_site
-from django.core.cache import caches
 from django.core.urlresolvers import reverse
 from django.http import QueryDict
 
 from . import convert_to_datatype, convert_post_body_to_dict
 from etag import get_etag_info
+from jws_verify import verify_signatures
+from multipart_stream import MultipartStream, MemoryPart, SpooledPart
+from statement_stream import StatementStream
 from ..exceptions import OauthUnauthorized, OauthBadRequest, ParamError, BadRequest
 
 from oauth_provider.utils import get_oauth_request, require_params
 from oauth_provider.decorators import CheckOauth
 from oauth_provider.store import store
 
-att_cache = caches['attachment_cache']
-
 
 def parse(request, more_id=None):
     # Parse request into body, headers, and params
@@ -114,6 +112,13 @@ def parse_post_put_body(request, r_dict):
         # signed statements)
         if 'multipart/mixed' in r_dict['headers']['CONTENT_TYPE']:
             parse_attachment(request, r_dict)
+        # JSON statement POSTs are read from the request as the statements are
+        # validated and saved
+        elif request.method == 'POST' and \
+                cgi.parse_header(r_dict['headers']['CONTENT_TYPE'])[0].lower() == 'application/json' and \
+                r_dict['auth']['endpoint'] == reverse('lrs:statements').lower():
+            r_dict['body'] = StatementStream(
+                request, settings.STATEMENT_BODY_MAX_SIZE)
         # If it's any other content-type try parsing it out
         else:
             if request.body:
@@ -219,61 +224,56 @@ def parse_normal_request(request, r_dict):
 
 
 def parse_attachment(request, r_dict):
-    message = request.body
-    # Python email parse library insists on having the multipart header in the body
-    # workaround to add it to the beginning since it will always be included in the header
-    lines = message.splitlines()
-    if not lines[0].startswith('Content-Type: multipart/mixed; boundary='):
-        if 'boundary' in r_dict['headers']['CONTENT_TYPE']:
-            message = "Content-Type:" + \
-                r_dict['headers']['CONTENT_TYPE'] + "\r\n" + message
-        else:
-            raise BadRequest(
-                "Could not find the boundary for the multipart content")
-    # end workaround
-    msg = email.message_from_string(message)
-    if msg.is_multipart():
-        # Stmt part will always be first
-        stmt_part = msg.get_payload().pop(0)
-        if stmt_part['Content-Type'] != "application/json":
-            raise ParamError(
-                "Content-Type of statement was not application/json")
-        try:
-            r_dict['body'] = json.loads(stmt_part.get_payload())
-        except Exception:
-            raise ParamError("Statement was not valid JSON")
-        if isinstance(r_dict['body'], dict):
-            stmt_sha2s = [a['sha2'] for a in r_dict['body']['attachments'] if 'attachments' in r_dict['body']]
-        else:
-            stmt_sha2s = [a['sha2'] for s in r_dict['body'] if 'attachments' in s for a in s['attachments']]
-        # Each attachment in msg must have binary encoding and hash in header
-        part_dict = {}
-        for part in msg.get_payload():
-            encoding = part.get('Content-Transfer-Encoding', None)
-            if encoding != "binary":
-                raise BadRequest(
-                    "Each attachment part should have 'binary' as Content-Transfer-Encoding")
-            if 'X-Experience-API-Hash' not in part:
-                raise BadRequest(
-                    "X-Experience-API-Hash header was missing from attachment")
-            part_hash = part.get('X-Experience-API-Hash')
-            validate_hash(part_hash, part)
-            part_dict[part_hash] = part
-        r_dict['payload_sha2s'] = [p['X-Experience-API-Hash']
-                         for p in msg.get_payload()]
-        if not set(r_dict['payload_sha2s']).issubset(set(stmt_sha2s)):
-            raise BadRequest("Not all attachments match with statement payload")
-        parse_signature_attachments(r_dict, part_dict)
-    else:
+    # Attachment parts are written to temporary files and hashed as they are
+    # read, only the statement part is kept in memory
+    parts = MultipartStream(
+        request, r_dict['headers']['CONTENT_TYPE']).parts(new_multipart_part)
+    try:
+        stmt_part = next(parts)
+    except StopIteration:
         raise ParamError(
             "This content was not multipart for the multipart request.")
-    # Saves all attachments (including signatures) to memory temporarily
-    # for further processing
-    temp_save_attachments(msg)
+    try:
+        r_dict['body'] = json.loads(stmt_part.read())
+    except Exception:
+        raise ParamError("Statement was not valid JSON")
+    if isinstance(r_dict['body'], dict):
+        stmt_sha2s = [a['sha2'] for a in r_dict['body']['attachments'] if 'attachments' in r_dict['body']]
+    else:
+        stmt_sha2s = [a['sha2'] for s in r_dict['body'] if 'attachments' in s for a in s['attachments']]
+    part_dict = {}
+    for part in parts:
+        part_hash = part.get('X-Experience-API-Hash')
+        validate_hash(part_hash, part)
+        part_dict[part_hash] = part
+    if not set(part_dict).issubset(set(stmt_sha2s)):
+        raise BadRequest("Not all attachments match with statement payload")
+    # Spooled files by sha2, moved into attachment storage when the
+    # statements are saved
+    r_dict['payloads'] = {sha2: part.file for sha2, part in part_dict.items()}
+    parse_signature_attachments(r_dict, part_dict)
+
+
+def new_multipart_part(headers, index):
+    # Stmt part will always be first
+    if index == 0:
+        if headers['Content-Type'] != "application/json":
+            raise ParamError(
+                "Content-Type of statement was not application/json")
+        return MemoryPart(headers, settings.STATEMENT_BODY_MAX_SIZE)
+    # Each attachment in msg must have binary encoding and hash in header
+    encoding = headers.get('Content-Transfer-Encoding', None)
+    if encoding != "binary":
+        raise BadRequest(
+            "Each attachment part should have 'binary' as Content-Transfer-Encoding")
+    if 'X-Experience-API-Hash' not in headers:
+        raise BadRequest(
+            "X-Experience-API-Hash header was missing from attachment")
+    return SpooledPart(headers)
 
 
 def validate_hash(part_hash, part):
-    if part_hash != str(hashlib.sha256(get_part_payload(part)).hexdigest()):
+    if part_hash != part.sha2:
         raise BadRequest(
             "Hash header %s did not match calculated hash" \
             % part_hash)
@@ -298,10 +298,10 @@ def parse_signature_attachments(r_dict, part_dict):
 
     if unsigned_stmts:
         for tup in unsigned_stmts:
-            validate_non_signature_attachment(unsigned_stmts, r_dict['payload_sha2s'], part_dict)
+            validate_non_signature_attachment(unsigned_stmts, r_dict['payloads'], part_dict)
 
     if signed_stmts:
-        handle_signatures(signed_stmts, r_dict['payload_sha2s'], part_dict)
+        handle_signatures(signed_stmts, r_dict['payloads'], part_dict)
 
 
 def validate_non_signature_attachment(unsigned_stmts, sha2s, part_dict):
@@ -319,59 +319,71 @@ def validate_non_signature_attachment(unsigned_stmts, sha2s, part_dict):
 
 
 def handle_signatures(stmt_tuples, sha2s, part_dict):
+    # Headers of every signature are checked first, then all x.509
+    # signatures are verified together (in parallel for large batches) and
+    # the results are gone through in statement order, so the error reported
+    # is the same as checking one statement after another. Errors found
+    # while collecting are kept with their place in that order, nothing after
+    # the first of them would be reached so it's where collecting stops
+    checks = []
     for tup in stmt_tuples:
-        for sha2 in tup[1]:           
+        for sha2 in tup[1]:
             # Should be listed in sha2s - sha2s couldn't not match
             if sha2 not in sha2s:
-                raise BadRequest(
-                    "Could not find attachment payload with sha: %s" % sha2)                    
+                checks.append((BadRequest(
+                    "Could not find attachment payload with sha: %s" % sha2), None, tup, None))
+                break
             part = part_dict[sha2]
             # Content type must be set to octet/stream
             if part['Content-Type'] != 'application/octet-stream':
-                raise BadRequest(
-                    "Signature attachment must have Content-Type of "\
-                    "'application/octet-stream'")
-            validate_signature(tup, part)
+                checks.append((BadRequest(
+                    "Signature attachment must have Content-Type of "
+                    "'application/octet-stream'"), None, tup, None))
+                break
+            # Unparseable signatures raise
+            try:
+                checks.append(check_signature(tup, part))
+            except Exception as e:
+                checks.append((e, None, tup, None))
+            if checks[-1][0]:
+                break
+        if checks and checks[-1][0]:
+            break
+    jobs = [check[1] for check in checks if check[1]]
+    results = iter(verify_signatures(jobs))
+    for error, job, tup, jws_payload in checks:
+        if error:
+            raise error
+        if job:
+            error = next(results)
+            if error:
+                raise BadRequest(error)
+        # Compare statements
+        if not compare_payloads(jws_payload, tup[0], tup[1][0]):
+            raise BadRequest(
+                "The JWS is not valid - payload and body statements do not match")
 
 
-def validate_signature(tup, part):
-    sha2_key = tup[1][0]
-    signature = get_part_payload(part)
-    algorithm = jws.get_unverified_headers(signature).get('alg', None)
+def check_signature(tup, part):
+    # Returns (BadRequest, verification job, tup, jws payload) - the job is None
+    # when there's an error or no x5c to verify against
+    signature = part.read()
+    headers = jws.get_unverified_headers(signature)
+    algorithm = headers.get('alg', None)
     if not algorithm:
-        raise BadRequest(
-            "No signing algorithm found for JWS signature")
+        return BadRequest("No signing algorithm found for JWS signature"), None, tup, None
     if algorithm != 'RS256' and algorithm != 'RS384' and algorithm != 'RS512':
-        raise BadRequest(
-            "JWS signature must be calculated with SHA-256, SHA-384 or" \
-            "SHA-512 algorithms")
-    x5c = jws.get_unverified_headers(signature).get('x5c', None)
+        return BadRequest("JWS signature must be calculated with SHA-256, SHA-384 or"
+                          "SHA-512 algorithms"), None, tup, None
+    x5c = headers.get('x5c', None)
     jws_payload = jws.get_unverified_claims(signature)
-    body_payload = tup[0]
     # If x.509 was used to sign, the public key should be in the x5c header and you need to verify it
     # If using RS256, RS384, or RS512 some JWS libs require a real private key to create JWS - xAPI spec
     # only has SHOULD - need to look into. If x.509 is necessary then
     # if no x5c header is found this should fail
     if x5c:
-        verified = False
-        try:
-            verified = jws.verify(
-                signature, cert_to_key(x5c[0]), algorithm)
-        except Exception as e:
-            raise BadRequest("The JWS is not valid: %s" % e.message)
-        else:
-            if not verified:
-                raise BadRequest(
-                    "The JWS is not valid - could not verify signature")
-            # Compare statements
-            if not compare_payloads(jws_payload, body_payload, sha2_key):
-                raise BadRequest(
-                    "The JWS is not valid - payload and body statements do not match")
-    else:
-        # Compare statements
-        if not compare_payloads(jws_payload, body_payload, sha2_key):
-            raise BadRequest(
-                "The JWS is not valid - payload and body statements do not match")
+        return None, (signature, x5c[0], algorithm), tup, jws_payload
+    return None, None, tup, jws_payload
 
 
 def compare_payloads(jws_payload, body_payload, sha2_key):
@@ -408,29 +420,6 @@ def compare_payloads(jws_payload, body_payload, sha2_key):
     return json.dumps(jws_placeholder, sort_keys=True) == json.dumps(body_placeholder, sort_keys=True)
 
 
-def temp_save_attachments(msg):
-    for part in msg.get_payload():
-        xhash = part.get('X-Experience-API-Hash')
-        att_cache.set(xhash, get_part_payload(part))
-
-
-def get_part_payload(part):
-    c_type = part['Content-Type']
-    # Email class adds newline for text/plain
-    # workaround
-    if "text/plain" in c_type:
-        payload = part.get_payload()
-        if payload.endswith('\n'):
-            payload = payload[:-1]
-    else:
-        payload = part.get_payload()
-    return payload
-
-
-def cert_to_key(cert):
-    return RSA.importKey(base64.b64decode(cert))
-
-
 def get_endpoint(request):
     # Used for OAuth scope
     parts = request.path.split("/")
@@ -488,6 +477,12 @@ def get_headers(headers):
     elif 'HTTP_ACCEPT_LANGUAGE' in headers:
         header_dict['language'] = headers.pop('HTTP_ACCEPT_LANGUAGE')
 
+    # Get preferences, only count is looked at
+    if 'HTTP_PREFER' in headers:
+        header_dict['prefer'] = headers.pop('HTTP_PREFER')
+    elif 'Prefer' in headers:
+        header_dict['prefer'] = headers.pop('Prefer')
+
     # Get xapi version
     if 'X-Experience-API-Version' in headers:
         header_dict[
@@ -1,23 +1,25 @@
 import json
 import uuid
-import copy
 from datetime import datetime
 
-from django.http import HttpResponse, HttpResponseNotFound, JsonResponse
+from django.http import HttpResponse, HttpResponseNotFound, JsonResponse, StreamingHttpResponse
 from django.conf import settings
 from django.utils.timezone import utc
 
+from render_cache import render_cache
 from retrieve_statement import complex_get, parse_more_request
+from verb_registry import verb_registry
 from ..exceptions import NotFound
 from ..models import Statement, Agent, Activity
 from ..managers.ActivityProfileManager import ActivityProfileManager
 from ..managers.ActivityStateManager import ActivityStateManager
 from ..managers.AgentProfileManager import AgentProfileManager
+from ..managers.StatementBatchManager import StatementBatchManager
 from ..managers.StatementManager import StatementManager
 from ..tasks import check_activity_metadata, check_statement_hooks
 
 
-def process_statement(stmt, auth, payload_sha2s):
+def prepare_statement(stmt):
     # Add id to statement if not present
     if 'id' not in stmt:
         stmt['id'] = str(uuid.uuid4())
@@ -46,21 +48,32 @@ def process_statement(stmt, auth, payload_sha2s):
     if 'timestamp' not in stmt:
         stmt['timestamp'] = stmt['stored']
 
-    # Copy full statement and send off to StatementManager to save
-    stmt['full_statement'] = copy.deepcopy(stmt)
-    st = StatementManager(stmt, auth, payload_sha2s).model_object
 
-    if stmt['verb'].verb_id == 'http://adlnet.gov/expapi/verbs/voided':
+def statement_response(st):
+    if st.verb.verb_id == 'http://adlnet.gov/expapi/verbs/voided':
         return st.statement_id, st.object_statementref
     return st.statement_id, None
 
 
-def process_body(stmts, auth, payload_sha2s):
-    return [process_statement(st, auth, payload_sha2s) for st in stmts]
+def process_statement(stmt, auth, payloads):
+    prepare_statement(stmt)
+    st = StatementManager(stmt, auth, payloads).model_object
+    return statement_response(st)
+
+
+def process_body(stmts, auth, payloads):
+    verb_registry.sync()
+    # Larger batches resolve their verbs, agents and activities together and
+    # are written with bulk inserts
+    if auth.get('agent', None) and len(stmts) >= settings.BULK_INGEST_THRESHOLD:
+        for st in stmts:
+            prepare_statement(st)
+        return [statement_response(st) for st in
+                StatementBatchManager(stmts, auth, payloads).model_objects]
+    return [process_statement(st, auth, payloads) for st in stmts]
 
 
 def process_complex_get(req_dict):
-    mime_type = "application/json"
     # Parse out params into single dict-GET data not in body
     param_dict = {}
     try:
@@ -111,45 +124,97 @@ def process_complex_get(req_dict):
     except Exception:
         attachments = False
 
-    # Create returned stmt list from the req dict
-    stmt_result = complex_get(param_dict, limit, language, format, attachments)
+    # See if the total number of matching statements was asked for
+    count = requested_count(req_dict.get('headers', {}))
 
-    # Get the length of the response - make sure in string format to count
-    # every character
-    if isinstance(stmt_result, dict):
-        content_length = len(json.dumps(stmt_result))
-    else:
-        content_length = len(stmt_result)
+    # Create returned stmt list from the req dict
+    stmt_result = complex_get(param_dict, limit, language, format, attachments, count)
+    # The total only goes in a header, never in the StatementResult
+    total = stmt_result.pop('total', None)
 
     # If attachments=True in req_dict then include the attachment payload and
     # return different mime type
     if attachments:
-        stmt_result, mime_type, content_length = build_response(stmt_result)
-        resp = HttpResponse(stmt_result, content_type=mime_type, status=200)
-    # Else attachments are false for the complex get so just dump the
+        resp, content_length = attachment_response(stmt_result)
+    # Else attachments are false for the complex get so just write the
     # stmt_result
     else:
-        if isinstance(stmt_result, dict):
-            stmt_result = json.dumps(stmt_result)
-        resp = HttpResponse(stmt_result, content_type=mime_type, status=200)
+        resp, content_length = statement_result_response(stmt_result)
+    if count:
+        resp['X-Total-Count'] = str(total)
+        resp['Preference-Applied'] = 'count=%s' % count
     return resp, content_length
 
 
+def requested_count(headers):
+    # 'exact' or 'estimated' from a Prefer: count=... header, None if the
+    # total isn't wanted
+    for preference in headers.get('prefer', '').split(','):
+        name, _, value = preference.strip().partition('=')
+        if name.strip().lower() == 'count' and value.strip().lower() in ('exact', 'estimated'):
+            return value.strip().lower()
+    return None
+
+
+def write_statement_result(stmt_result):
+    # The JSON of a statement result in pieces, serializing its statements
+    # one at a time as they're loaded
+    yield '{"statements": ['
+    separator = ''
+    for stmt in stmt_result['statements'].json():
+        yield separator + stmt
+        separator = ', '
+    yield '], "more": %s}' % json.dumps(stmt_result['more'])
+
+
+def statement_result_response(stmt_result):
+    # Returns the response and its content length. Pages of at least
+    # STATEMENT_STREAM_THRESHOLD statements are streamed as they're written,
+    # without a length, smaller ones are written to a single string
+    content = write_statement_result(stmt_result)
+    threshold = settings.STATEMENT_STREAM_THRESHOLD
+    if threshold is not None and len(stmt_result['statements']) >= threshold:
+        return StreamingHttpResponse(content, content_type="application/json", status=200), None
+    content = ''.join(content)
+    return HttpResponse(content, content_type="application/json", status=200), len(content)
+
+
+def attachment_response(stmt_result):
+    # The multipart body needs the attachments of every statement, so the
+    # page is loaded whole
+    stmt_result['statements'] = list(stmt_result['statements'])
+    stmt_result, mime_type, content_length = build_response(stmt_result)
+    return HttpResponse(stmt_result, content_type=mime_type, status=200), content_length
+
+
+def void_statements(stmts_to_void):
+    voided = Statement.objects.filter(statement_id__in=stmts_to_void)
+    render_cache.void(list(voided.values_list('id', flat=True)))
+    voided.update(voided=True)
+
+
 def statements_post(req_dict):
     auth = req_dict['auth']
+    # Streamed bodies come in validated chunks, each one is saved before the
+    # next is read
+    if 'body_chunks' in req_dict:
+        chunks = req_dict['body_chunks']
     # If single statement, put in list
-    if isinstance(req_dict['body'], dict):
-        body = [req_dict['body']]
+    elif isinstance(req_dict['body'], dict):
+        chunks = [[req_dict['body']]]
     else:
-        body = req_dict['body']
+        chunks = [req_dict['body']]
 
-    stmt_responses = process_body(body, auth, req_dict.get('payload_sha2s', None))
+    stmt_responses = []
+    for body in chunks:
+        stmt_responses.extend(process_body(
+            body, auth, req_dict.get('payloads', None)))
     stmt_ids = [stmt_tup[0] for stmt_tup in stmt_responses]
     stmts_to_void = [str(stmt_tup[1])
                      for stmt_tup in stmt_responses if stmt_tup[1]]
     check_activity_metadata.delay(stmt_ids)
     if stmts_to_void:
-        Statement.objects.filter(statement_id__in=stmts_to_void).update(voided=True)
+        void_statements(stmts_to_void)
     if settings.USE_HOOKS:
         check_statement_hooks.delay(stmt_ids)
     return JsonResponse([st for st in stmt_ids], safe=False)
@@ -158,40 +223,30 @@ def statements_post(req_dict):
 def statements_put(req_dict):
     auth = req_dict['auth']
     # Since it is single stmt put in list
-    stmt_responses = process_body([req_dict['body']], auth, req_dict.get('payload_sha2s', None))
+    stmt_responses = process_body([req_dict['body']], auth, req_dict.get('payloads', None))
     stmt_ids = [stmt_tup[0] for stmt_tup in stmt_responses]
     stmts_to_void = [str(stmt_tup[1])
                      for stmt_tup in stmt_responses if stmt_tup[1]]
     check_activity_metadata.delay(stmt_ids)
     if stmts_to_void:
-        Statement.objects.filter(statement_id__in=stmts_to_void).update(voided=True)
+        void_statements(stmts_to_void)
     if settings.USE_HOOKS:
         check_statement_hooks.delay(stmt_ids)
     return HttpResponse("No Content", status=204)
 
 
 def statements_more_get(req_dict):
-    stmt_result, attachments = parse_more_request(req_dict['more_id'])
-
-    if isinstance(stmt_result, dict):
-        content_length = len(json.dumps(stmt_result))
-    else:
-        content_length = len(stmt_result)
-    mime_type = "application/json"
+    stmt_result, attachments = parse_more_request(
+        req_dict['more_id'], req_dict.get('auth', None))
 
     # If there are attachments, include them in the payload
     if attachments:
-        stmt_result, mime_type, content_length = build_response(stmt_result)
-        resp = HttpResponse(stmt_result, content_type=mime_type, status=200)
-    # If not, just dump the stmt_result
+        resp, content_length = attachment_response(stmt_result)
+    # If not, just write the stmt_result
     else:
-        if isinstance(stmt_result, basestring):
-            resp = HttpResponse(
-                stmt_result, content_type=mime_type, status=200)
-        else:
-            resp = HttpResponse(json.dumps(stmt_result),
-                                content_type=mime_type, status=200)
-    resp['Content-Length'] = str(content_length)
+        resp, content_length = statement_result_response(stmt_result)
+    if content_length is not None:
+        resp['Content-Length'] = str(content_length)
 
     return resp
 
@@ -217,7 +272,9 @@ def statements_get(req_dict):
     # Complex GET
     else:
         resp, content_length = process_complex_get(req_dict)
-    resp['Content-Length'] = str(content_length)
+    # Streamed pages have no length until they're written
+    if content_length is not None:
+        resp['Content-Length'] = str(content_length)
 
     return resp
 
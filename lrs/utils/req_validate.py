@@ -2,16 +2,23 @@ from isodate.isodatetime import parse_datetime
 from isodate.isoerror import ISO8601Error
 import uuid
 
+from django.conf import settings
+
 from . import get_agent_ifp, convert_to_datatype
 from authorization import auth
+from parallel_validation import validate_statements
+from statement_stream import StatementStream
 from StatementValidator import StatementValidator
 
 from ..models import Statement, Agent, Activity, ActivityState, ActivityProfile, AgentProfile
 from ..exceptions import ParamConflict, ParamError, Forbidden, BadRequest, IDNotFoundError
 
 
-def check_for_existing_statementId(stmtID):
-    return Statement.objects.filter(statement_id=stmtID).exists()
+def check_for_existing_statementIds(stmt_ids):
+    # Return the ids from stmt_ids that are already stored
+    existing = Statement.objects.filter(
+        statement_id__in=stmt_ids).values_list('statement_id')
+    return set(str(st_id[0]) for st_id in existing)
 
 
 def check_for_no_other_params_supplied(query_dict):
@@ -39,37 +46,110 @@ def validate_oauth_for_documents(req_dict, endpoint):
                 raise Forbidden(err_msg)
 
 
-def validate_void_statement(void_id):
-    # Retrieve statement, check if the verb is 'voided' - if not then set the voided flag to true else return error
+def validate_statement_ids(body):
+    # Normalize ids so the same UUID in different forms is still caught
+    stmt_ids = [str(uuid.UUID(stmt['id'])) for stmt in body if 'id' in stmt]
+    seen = set()
+    for statement_id in stmt_ids:
+        if statement_id in seen:
+            err_msg = "Statement batch contains duplicate ID %s" % statement_id
+            raise BadRequest(err_msg)
+        seen.add(statement_id)
+
+    if stmt_ids:
+        existing = check_for_existing_statementIds(stmt_ids)
+        for statement_id in stmt_ids:
+            if statement_id in existing:
+                err_msg = "A statement with ID %s already exists" % statement_id
+                raise ParamConflict(err_msg)
+
+
+def validate_void_statements(body):
+    # Retrieve statements, check if the verb is 'voided' - if not then set the voided flag to true else return error
     # since you cannot unvoid a statement and should just reissue the
     # statement under a new ID.
-    stmts = Statement.objects.filter(statement_id=void_id)
-    if len(stmts) > 1:
-        raise IDNotFoundError(
-            "Something went wrong. %s statements found with id %s" % (len(stmts), void_id))
-    elif len(stmts) == 1:
-        if stmts[0].voided:
-            err_msg = "Statement with ID: %s is already voided, cannot unvoid. Please re-issue the statement under a new ID." % void_id
-            raise BadRequest(err_msg)
-        if stmts[0].verb.verb_id == "http://adlnet.gov/expapi/verbs/voided":
+    voiding_stmts = [stmt for stmt in body
+                     if stmt['verb']['id'] == 'http://adlnet.gov/expapi/verbs/voided']
+    if not voiding_stmts:
+        return
+    void_ids = [stmt['object']['id'] for stmt in voiding_stmts]
+
+    # A statement in the batch cannot void another voiding statement in it
+    batch_voiding_ids = set(str(uuid.UUID(stmt['id']))
+                            for stmt in voiding_stmts if 'id' in stmt)
+    for void_id in void_ids:
+        if str(uuid.UUID(void_id)) in batch_voiding_ids:
             err_msg = "Statement with ID: %s is a voiding statement and cannot be voided." % void_id
             raise BadRequest(err_msg)
 
+    found = {}
+    for st_id, voided, verb_id in Statement.objects.filter(statement_id__in=void_ids) \
+            .values_list('statement_id', 'voided', 'verb__verb_id'):
+        found.setdefault(str(st_id), []).append((voided, verb_id))
+    for void_id in void_ids:
+        stmts = found.get(str(uuid.UUID(void_id)), [])
+        if len(stmts) > 1:
+            raise IDNotFoundError(
+                "Something went wrong. %s statements found with id %s" % (len(stmts), void_id))
+        elif len(stmts) == 1:
+            voided, verb_id = stmts[0]
+            if voided:
+                err_msg = "Statement with ID: %s is already voided, cannot unvoid. Please re-issue the statement under a new ID." % void_id
+                raise BadRequest(err_msg)
+            if verb_id == "http://adlnet.gov/expapi/verbs/voided":
+                err_msg = "Statement with ID: %s is a voiding statement and cannot be voided." % void_id
+                raise BadRequest(err_msg)
+
+
 def validate_body(body, auth, content_type):
+    # Id and voiding checks run once for the whole batch
+    validate_statement_ids(body)
+    validate_void_statements(body)
     [server_validate_statement(
         stmt, auth, content_type) for stmt in body]
 
 
-def server_validate_statement(stmt, auth, content_type):
-    if 'id' in stmt:
-        statement_id = stmt['id']
-        if check_for_existing_statementId(statement_id):
-            err_msg = "A statement with ID %s already exists" % statement_id
-            raise ParamConflict(err_msg)
+def validate_statement_stream(stream, auth, content_type):
+    # Validates the statements a chunk at a time as they are read from the
+    # request. Each chunk is saved before the next one is read, so ids and
+    # voids are also checked against the chunks before it
+    statement_ids = set()
+    voided_ids = set()
+    chunks = 0
+    for chunk in stream.chunks(settings.STATEMENT_STREAM_CHUNK):
+        chunks += 1
+        try:
+            validate_statements(chunk)
+        except Exception as e:
+            raise BadRequest(e.message)
+
+        chunk_ids = [str(uuid.UUID(stmt['id'])) for stmt in chunk if 'id' in stmt]
+        for statement_id in chunk_ids:
+            if statement_id in statement_ids:
+                err_msg = "Statement batch contains duplicate ID %s" % statement_id
+                raise BadRequest(err_msg)
+        # Statements are only voided once the last chunk is saved, so any
+        # statement of the batch can be voided by any other. Voiding
+        # statements in earlier chunks are already saved and caught by
+        # validate_void_statements, one voided by an earlier chunk needs
+        # checking here
+        voiding_ids = [str(uuid.UUID(stmt['id'])) for stmt in chunk if 'id' in stmt and
+                       stmt['verb']['id'] == 'http://adlnet.gov/expapi/verbs/voided']
+        for statement_id in voiding_ids:
+            if statement_id in voided_ids:
+                err_msg = "Statement with ID: %s is a voiding statement and cannot be voided." % statement_id
+                raise BadRequest(err_msg)
+        validate_body(chunk, auth, content_type)
+
+        statement_ids.update(chunk_ids)
+        voided_ids.update(str(uuid.UUID(stmt['object']['id'])) for stmt in chunk
+                          if stmt['verb']['id'] == 'http://adlnet.gov/expapi/verbs/voided')
+        yield chunk
+    if not chunks:
+        raise BadRequest("There are no statements to validate")
 
-    if stmt['verb']['id'] == 'http://adlnet.gov/expapi/verbs/voided':
-        validate_void_statement(stmt['object']['id'])
 
+def server_validate_statement(stmt, auth, content_type):
     if 'attachments' in stmt:
         attachment_data = stmt['attachments']
         validate_attachments(attachment_data, content_type)
@@ -81,9 +161,18 @@ def statements_post(req_dict):
         raise ParamError("The post statements request contained unexpected parameters: %s" % ", ".join(
             req_dict['params'].keys()))
 
+    # Streamed bodies are validated while they're being saved
+    if isinstance(req_dict['body'], StatementStream):
+        req_dict['body_chunks'] = validate_statement_stream(
+            req_dict['body'], req_dict['auth'], req_dict['headers']['CONTENT_TYPE'])
+        return req_dict
+
     try:
-        validator = StatementValidator(req_dict['body'])
-        validator.validate()
+        if isinstance(req_dict['body'], list):
+            validate_statements(req_dict['body'])
+        else:
+            validator = StatementValidator(req_dict['body'])
+            validator.validate()
     except Exception as e:
         raise BadRequest(e.message)
     except ParamError as e:
@@ -164,7 +253,6 @@ def statements_get(req_dict):
         raise ParamError(
             "The get statements request contained unexpected parameters: %s" % ", ".join(rogueparams))
 
-    validator = StatementValidator()
     if 'agent' in req_dict['params']:
         try:
             agent = convert_to_datatype(req_dict['params']['agent'])
@@ -172,7 +260,6 @@ def statements_get(req_dict):
         except Exception:
             raise ParamError("agent param %s is not valid" % \
                 req_dict['params']['agent'])
-        validator.validate_agent(agent, "Agent param")    
 
     formats = ['exact', 'canonical', 'ids']
     if 'format' in req_dict['params']:
@@ -186,20 +273,6 @@ def statements_get(req_dict):
     if 'statementId' in req_dict['params'] or 'voidedStatementId' in req_dict['params']:
         req_dict['statementId'] = validate_statementId(req_dict)
 
-    if 'since' in req_dict['params']:
-        try:
-            parse_datetime(req_dict['params']['since'])
-        except (Exception, ISO8601Error):
-            raise ParamError(
-                "since parameter was not a valid ISO8601 timestamp")
-
-    if 'until' in req_dict['params']:
-        try:
-            parse_datetime(req_dict['params']['until'])
-        except (Exception, ISO8601Error):
-            raise ParamError(
-                "until parameter was not a valid ISO8601 timestamp")
-
     if 'ascending' in req_dict['params']:
         if req_dict['params']['ascending'].lower() == 'true':
             req_dict['params']['ascending'] = True
@@ -257,15 +330,42 @@ def statements_get(req_dict):
     else:
         req_dict['params']['limit'] = 0
 
-    if 'registration' in req_dict['params']:
-        validator.validate_uuid(req_dict['params']['registration'], "Registration param")          
-
-    if 'verb' in req_dict['params']:
-        validator.validate_iri(
-                    req_dict['params']['verb'], "verb param")
+    validate_statement_filters(req_dict['params'])
     return req_dict
 
 
+def validate_statement_filters(params):
+    # The statement query filters once the agent is parsed and the flags are
+    # booleans - also what the more URL of a cursor carries to the next page
+    validator = StatementValidator()
+    if 'agent' in params:
+        if not isinstance(params['agent'], dict):
+            raise ParamError("agent param %s is not valid" % params['agent'])
+        validator.validate_agent(params['agent'], "Agent param")
+
+    for param in ('since', 'until'):
+        if param in params:
+            try:
+                parse_datetime(params[param])
+            except (Exception, ISO8601Error):
+                raise ParamError(
+                    "%s parameter was not a valid ISO8601 timestamp" % param)
+
+    for param in ('ascending', 'related_agents', 'related_activities'):
+        if param in params and not isinstance(params[param], bool):
+            raise ParamError(
+                "%s parameter was not a boolean value" % param)
+
+    if 'registration' in params:
+        validator.validate_uuid(params['registration'], "Registration param")
+
+    if 'verb' in params:
+        validator.validate_iri(params['verb'], "verb param")
+
+    if 'activity' in params and not isinstance(params['activity'], basestring):
+        raise ParamError("activity param %s is not valid" % params['activity'])
+
+
 @auth
 def statements_put(req_dict):
     # Find any unexpected parameters
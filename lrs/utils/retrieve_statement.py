@@ -1,22 +1,110 @@
+import base64
 import bencode
 import hashlib
 import json
+import re
 import uuid
 from datetime import datetime
 from itertools import chain
+from isodate.isodatetime import parse_datetime
+from isodate.isoerror import ISO8601Error
 
+from django.core import signing
 from django.core.cache import cache
 from django.conf import settings
 from django.core.paginator import Paginator
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.db.models.sql.datastructures import EmptyResultSet
 
 from . import convert_to_datetime_object
+from .req_validate import validate_statement_filters
+from .statement_index import agent_statements, activity_statements
+from .render import RenderMemo
+from .render_cache import render_cache
+from .statement_serializer import serialize_statements, serialize_statement_map
 from ..models import Statement, Agent
-from ..exceptions import NotFound
-
-
-def complex_get(param_dict, limit, language, stmt_format, attachments):
+from ..exceptions import NotFound, ParamError
+
+# more ids of lists stored in the cache, anything else is a cursor
+CACHE_KEY_RE = re.compile('^[0-9a-f]{32}$')
+# Keeps more tokens from being valid as anything else signed with SECRET_KEY
+MORE_TOKEN_SALT = 'lrs.statements.more'
+# Statements matching a filter and the ones that refer to them through
+# StatementRefs, followed to any depth in one query. UNION stops at statements
+# already found, so a cycle of references ends
+STMT_REF_SEARCH = """%(statement_id)s IN (WITH RECURSIVE refs(statement_id) AS (%(matching)s
+    UNION SELECT ref.statement_id FROM (%(referencing)s) AS ref JOIN refs ON ref.object_statementref = refs.statement_id)
+    SELECT statement_id FROM refs)"""
+# Query parameters a cursor carries to the next page
+CURSOR_FILTERS = ('agent', 'verb', 'activity', 'registration', 'related_activities',
+                  'related_agents', 'since', 'until', 'ascending')
+
+
+class StatementPage():
+    # The statements of a page of results, from their ids in order. They're
+    # loaded and turned into dicts STATEMENT_PAGE_CHUNK at a time as the
+    # page is iterated, so the page is never held as a whole
+
+    def __init__(self, ids, language, stmt_format):
+        self.ids = ids
+        self.language = language
+        self.stmt_format = stmt_format
+        # Shared by the chunks, the agents, verbs and activities of the page
+        # are rendered once
+        self.memo = RenderMemo()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def chunks(self):
+        size = settings.STATEMENT_PAGE_CHUNK
+        for i in range(0, len(self.ids), size):
+            yield self.ids[i:i + size]
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            # The exact format is the statement as it was stored, nothing else
+            # is needed from the database
+            if self.stmt_format == 'exact':
+                stmts = dict(Statement.objects.filter(id__in=chunk).values_list('id', 'full_statement'))
+                for stmt_id in chunk:
+                    if stmt_id in stmts:
+                        yield stmts[stmt_id]
+                continue
+            for stmt in serialize_statements(chunk, self.language, self.stmt_format, self.memo):
+                yield stmt
+
+    def render(self, stmt_ids):
+        return {stmt_id: json.dumps(stmt) for stmt_id, stmt in
+                serialize_statement_map(stmt_ids, self.language, self.stmt_format, self.memo).iteritems()}
+
+    def json(self):
+        # The JSON of each statement of the page. In the exact format postgres
+        # writes out the stored statement as text, which goes into the
+        # response as it is without being decoded and encoded again. The
+        # other formats come from the render cache when it's on
+        for chunk in self.chunks():
+            if self.stmt_format == 'exact':
+                stmts = dict(Statement.objects.filter(id__in=chunk)
+                             .annotate(full_statement_text=RawSQL('full_statement::text', ()))
+                             .values_list('id', 'full_statement_text'))
+                for stmt_id in chunk:
+                    if stmt_id in stmts:
+                        yield stmts[stmt_id].encode('utf-8')
+                continue
+            stmts = render_cache.render(chunk, self.language, self.stmt_format, self.render)
+            for stmt_id in chunk:
+                # Could have been deleted since the page was read
+                if stmt_id in stmts:
+                    yield stmts[stmt_id]
+
+
+def build_filter(param_dict):
+    # Returns (filterQ, untilQ, sinceQ, reffilter) for the query parameters,
+    # None if the agent filtered on doesn't exist.
     # keep track if a filter other than time or sequence is used
     reffilter = False
 
@@ -28,11 +116,6 @@ def complex_get(param_dict, limit, language, stmt_format, attachments):
     if 'until' in param_dict:
         untilQ = Q(stored__lte=convert_to_datetime_object(param_dict['until']))
 
-    # If want ordered by ascending
-    stored_param = '-stored'
-    if 'ascending' in param_dict and param_dict['ascending']:
-        stored_param = 'stored'
-
     # For statements/read/mine oauth scope
     authQ = Q()
     if 'auth' in param_dict and (param_dict['auth'] and 'statements_mine_only' in param_dict['auth']):
@@ -58,29 +141,14 @@ def complex_get(param_dict, limit, language, stmt_format, attachments):
             'related_agents']
         agent = Agent.objects.retrieve(**data)
         if agent:
-            agentQ = Q(actor=agent) | Q(object_agent=agent)
-            if related:
-                agentQ = agentQ | Q(authority=agent) \
-                    | Q(context_instructor=agent) | Q(context_team=agent) \
-                    | Q(object_substatement__actor=agent) \
-                    | Q(object_substatement__object_agent=agent) \
-                    | Q(object_substatement__context_instructor=agent) \
-                    | Q(object_substatement__context_team=agent)
+            agent_ids = [agent.pk]
             # If it is an agent and not a group, retrieve all groups it is part of
             if agent.objectType == "Agent":
-                groups = agent.member.all()
-                if groups.exists():
-                    for g in groups.iterator():
-                        agentQ = agentQ | Q(actor=g) | Q(object_agent=g)
-                        if related:
-                            agentQ = agentQ | Q(authority=g) \
-                                | Q(context_instructor=g) | Q(context_team=g) \
-                                | Q(object_substatement__actor=g) \
-                                | Q(object_substatement__object_agent=g) \
-                                | Q(object_substatement__context_instructor=g) \
-                                | Q(object_substatement__context_team=g)
+                agent_ids.extend(agent.member.values_list('pk', flat=True))
+            # One lookup in the statement agent index for every role
+            agentQ = Q(id__in=agent_statements(agent_ids, related))
         else:
-            return create_under_limit_stmt_result([], stored_param, language, stmt_format)
+            return None
 
     verbQ = Q()
     if 'verb' in param_dict:
@@ -91,57 +159,93 @@ def complex_get(param_dict, limit, language, stmt_format, attachments):
     activityQ = Q()
     if 'activity' in param_dict:
         reffilter = True
-        activityQ = Q(object_activity__activity_id=param_dict['activity'])
-        if 'related_activities' in param_dict and param_dict['related_activities']:
-            activityQ = activityQ | Q(context_ca_parent__activity_id=param_dict['activity']) \
-                | Q(context_ca_grouping__activity_id=param_dict['activity']) \
-                | Q(context_ca_category__activity_id=param_dict['activity']) \
-                | Q(context_ca_other__activity_id=param_dict['activity']) \
-                | Q(object_substatement__object_activity__activity_id=param_dict['activity']) \
-                | Q(object_substatement__context_ca_parent__activity_id=param_dict['activity']) \
-                | Q(object_substatement__context_ca_grouping__activity_id=param_dict['activity']) \
-                | Q(object_substatement__context_ca_category__activity_id=param_dict['activity']) \
-                | Q(object_substatement__context_ca_other__activity_id=param_dict['activity'])
+        related = 'related_activities' in param_dict and param_dict['related_activities']
+        # One lookup in the statement activity index for every relation
+        activityQ = Q(id__in=activity_statements(param_dict['activity'], related))
 
     registrationQ = Q()
     if 'registration' in param_dict:
         reffilter = True
         registrationQ = Q(context_registration=param_dict['registration'])
 
-    voidQ = Q(voided=False)
-    stmtset = Statement.objects.select_related('actor', 'verb', 'context_team', 'context_instructor', 'authority',
-                                               'object_agent', 'object_activity', 'object_substatement') \
-        .prefetch_related('context_ca_parent', 'context_ca_grouping', 'context_ca_category', 'context_ca_other') \
-        .filter(untilQ & sinceQ & authQ & agentQ & verbQ & activityQ & registrationQ).distinct()
-    # Workaround since flat doesn't work with UUIDFields
-    st_ids = stmtset.values_list('statement_id')
-    stmtset = [st_id[0] for st_id in st_ids]
+    filterQ = untilQ & sinceQ & authQ & agentQ & verbQ & activityQ & registrationQ
+    return filterQ, untilQ, sinceQ, reffilter
+
+
+def complex_get(param_dict, limit, language, stmt_format, attachments, count=None):
+    # count is 'exact' or 'estimated' if the total number of matching
+    # statements was asked for, it's returned as total
+    # If want ordered by ascending
+    stored_param = '-stored'
+    if 'ascending' in param_dict and param_dict['ascending']:
+        stored_param = 'stored'
+
+    if settings.STATEMENT_MORE_MODE in ('cursor', 'signed'):
+        result = create_cursor_stmt_result(param_dict, None, limit, language, stmt_format, attachments)
+        if count:
+            result['total'] = count_statements(cursor_statements(param_dict, None), count)
+        return result
 
+    filters = build_filter(param_dict)
+    if filters is None:
+        return create_under_limit_stmt_result([], language, stmt_format, count)
+    filterQ, untilQ, sinceQ, reffilter = filters
+
+    # Agent and activity filters are semi-joins on the statement index, so no
+    # filter can return a statement twice and there is nothing to distinct
+    stmtset = Statement.objects.filter(filterQ)
     if reffilter:
-        stmtset = stmtset + stmt_ref_search(stmtset, untilQ, sinceQ)
-        actual_length = Statement.objects.filter(
-            Q(statement_id__in=stmtset) & voidQ).distinct().count()        
-    else:
-        actual_length = len(stmtset)
+        stmtset = stmt_ref_search(stmtset, untilQ, sinceQ)
+    stmtset = stmtset.filter(voided=False)
 
     # Calculate limit of stmts to return
     return_limit = set_limit(limit)
 
-    # If there are more stmts than the limit, need to break it up and return
-    # more id
-    if actual_length > return_limit:
-        return create_over_limit_stmt_result(stmtset, stored_param, return_limit, language, stmt_format, attachments)
+    # One more id than the limit tells if there is more than a page without
+    # counting or reading every match. Only then are all the ids read, the
+    # more pages are cut from them
+    ids = list(stmtset.order_by(stored_param).values_list('id', flat=True)[:return_limit + 1])
+    if len(ids) > return_limit:
+        return create_over_limit_stmt_result(stmtset, stored_param, return_limit, language, stmt_format,
+                                             attachments, count)
     else:
-        return create_under_limit_stmt_result(stmtset, stored_param, language, stmt_format)
-
-
-def stmt_ref_search(stmt_list, untilQ, sinceQ, acc=[]):
-    while stmt_list:
-        ref_list = [sid for sid in Statement.objects.filter(
-            Q(object_statementref__in=stmt_list) & untilQ & sinceQ)
-            .distinct().values_list('statement_id', flat=True)]
-        (acc, stmt_list) = (acc + stmt_list, ref_list)
-    return acc
+        return create_under_limit_stmt_result(ids, language, stmt_format, count)
+
+
+def count_statements(stmtset, count):
+    # The number of statements in stmtset. An estimated count is the
+    # planner's guess at the number of rows, which costs no more than planning
+    # the query, unless it's below STATEMENT_COUNT_ESTIMATE_THRESHOLD where
+    # they're counted
+    if count == 'estimated':
+        try:
+            sql, params = stmtset.order_by().values('id').query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        # psycopg2 doesn't always decode the plan
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        estimate = plan[0]['Plan']['Plan Rows']
+        if estimate >= settings.STATEMENT_COUNT_ESTIMATE_THRESHOLD:
+            return estimate
+    return stmtset.count()
+
+
+def stmt_ref_search(stmtset, untilQ, sinceQ):
+    # The statements of stmtset and every statement stored within the time
+    # filters that refers to one of them, directly or through other
+    # StatementRefs
+    qn = connection.ops.quote_name
+    matching, matching_params = stmtset.order_by().values('statement_id').query.sql_with_params()
+    referencing, referencing_params = Statement.objects.filter(
+        untilQ & sinceQ & Q(object_statementref__isnull=False)).order_by() \
+        .values('statement_id', 'object_statementref').query.sql_with_params()
+    where = STMT_REF_SEARCH % {'statement_id': '%s.%s' % (qn(Statement._meta.db_table), qn('statement_id')),
+                               'matching': matching, 'referencing': referencing}
+    return Statement.objects.extra(where=[where], params=matching_params + referencing_params)
 
 
 def set_limit(req_limit):
@@ -150,20 +254,13 @@ def set_limit(req_limit):
     return req_limit
 
 
-def create_under_limit_stmt_result(stmt_set, stored, language, stmt_format):
+def create_under_limit_stmt_result(ids, language, stmt_format, count=None):
+    # ids are every matching statement's, in order
     stmt_result = {}
-    if stmt_set:
-        stmt_set = Statement.objects.select_related('actor', 'verb', 'context_team', 'context_instructor', 'authority',
-                                                    'object_agent', 'object_activity', 'object_substatement') \
-            .prefetch_related('context_ca_parent', 'context_ca_grouping', 'context_ca_category', 'context_ca_other') \
-            .filter(Q(statement_id__in=stmt_set) & Q(voided=False)).distinct()
-
-        stmt_result['statements'] = [stmt.to_dict(language, stmt_format) for stmt in
-                                     stmt_set.order_by(stored)]
-        stmt_result['more'] = ""
-    else:
-        stmt_result['statements'] = []
-        stmt_result['more'] = ""
+    stmt_result['statements'] = StatementPage(ids, language, stmt_format)
+    stmt_result['more'] = ""
+    if count:
+        stmt_result['total'] = len(ids)
     return stmt_result
 
 
@@ -178,13 +275,11 @@ def create_cache_key():
     return key
 
 
-def create_over_limit_stmt_result(stmt_list, stored, limit, language, stmt_format, attachments):
+def create_over_limit_stmt_result(stmt_list, stored, limit, language, stmt_format, attachments, count=None):
     # First time someone queries POST/GET
     result = {}
     cache_list = []
 
-    stmt_list = Statement.objects.filter(
-        Q(statement_id__in=stmt_list) & Q(voided=False)).distinct()
     cache_list.append([s for s in stmt_list.order_by(
         stored).values_list('id', flat=True)])
     stmt_pager = Paginator(cache_list[0], limit)
@@ -209,16 +304,19 @@ def create_over_limit_stmt_result(stmt_list, stored, limit, language, stmt_forma
     # Save encoded_dict in cache
     cache.set(cache_key, encoded_info)
 
-    result['statements'] = [stmt.to_dict(language, stmt_format) for stmt in
-                            Statement.objects.select_related('actor', 'verb', 'context_team', 'context_instructor', 'authority',
-                                                             'object_agent', 'object_activity', 'object_substatement')
-                            .prefetch_related('context_ca_parent', 'context_ca_grouping', 'context_ca_category', 'context_ca_other')
-                            .filter(id__in=stmt_pager.page(1).object_list).order_by(stored)]
+    # The cached ids are already in order
+    result['statements'] = StatementPage(stmt_pager.page(1).object_list, language, stmt_format)
     result['more'] = "%s/%s" % (reverse('lrs:statements_more_placeholder').lower(), cache_key)
+    # Every match was read for the cache, the total is known
+    if count:
+        result['total'] = stmt_pager.count
     return result
 
 
-def parse_more_request(req_id):
+def parse_more_request(req_id, auth=None):
+    if not CACHE_KEY_RE.match(req_id):
+        return parse_cursor_request(req_id, auth)
+
     # Retrieve encoded info for statements
     encoded_info = cache.get(req_id)
     # Could have expired or never existed
@@ -251,11 +349,8 @@ def build_more_statement_result(more_id, **data):
     result = {}
     current_page = data["start_page"] + 1
     stmt_pager = Paginator(data["stmt_list"], data["limit"])
-    result['statements'] = [stmt.to_dict(data["language"], data["format"]) for stmt in
-                            Statement.objects.select_related('actor', 'verb', 'context_team', 'context_instructor', 'authority',
-                                                             'object_agent', 'object_activity', 'object_substatement')
-                            .prefetch_related('context_ca_parent', 'context_ca_grouping', 'context_ca_category', 'context_ca_other')
-                            .filter(id__in=stmt_pager.page(current_page).object_list).order_by(data["stored"])]
+    result['statements'] = StatementPage(stmt_pager.page(current_page).object_list,
+                                         data["language"], data["format"])
 
     # If that was the last page to display then just return the remaining stmts
     if current_page == data["total_pages"]:
@@ -290,3 +385,112 @@ def build_more_statement_result(more_id, **data):
         encoded_list = json.dumps(more_cache_list)
         cache.set(cache_key, encoded_list)
     return result
+
+
+def cursor_statements(param_dict, position):
+    # Statements matching the filters in param_dict that come after position,
+    # the (stored, id) of the last statement of the previous page, in order.
+    # The stored index seeks straight to the position, nothing about the
+    # query is kept between pages
+    filters = build_filter(param_dict)
+    if filters is None:
+        return Statement.objects.none()
+    filterQ, untilQ, sinceQ, reffilter = filters
+    stmts = Statement.objects.filter(filterQ)
+    if reffilter:
+        stmts = stmt_ref_search(stmts, untilQ, sinceQ)
+
+    stmts = stmts.filter(voided=False)
+    ascending = 'ascending' in param_dict and param_dict['ascending']
+    if position:
+        stored = convert_to_datetime_object(position[0])
+        if ascending:
+            stmts = stmts.filter(Q(stored__gt=stored) | Q(stored=stored, id__gt=position[1]))
+        else:
+            stmts = stmts.filter(Q(stored__lt=stored) | Q(stored=stored, id__lt=position[1]))
+    # id breaks ties between statements stored at the same time
+    if ascending:
+        return stmts.order_by('stored', 'id')
+    return stmts.order_by('-stored', '-id')
+
+
+def create_cursor_stmt_result(param_dict, position, limit, language, stmt_format, attachments):
+    # A page of statements whose more URL carries everything needed for the
+    # next one. The (id, stored) of one more statement than the limit are read
+    # to know if there is a next page
+    limit = set_limit(limit)
+    positions = list(cursor_statements(param_dict, position).values_list('id', 'stored')[:limit + 1])
+    result = {}
+    result['statements'] = StatementPage([pos[0] for pos in positions[:limit]], language, stmt_format)
+    result['more'] = ""
+    if len(positions) > limit:
+        last_id, last_stored = positions[limit - 1]
+        cursor = {'filters': {k: param_dict[k] for k in CURSOR_FILTERS if k in param_dict},
+                  'position': [last_stored.isoformat(), last_id],
+                  'limit': limit,
+                  'attachments': attachments,
+                  'language': language,
+                  'format': stmt_format}
+        result['more'] = "%s/%s" % (reverse('lrs:statements_more_placeholder').lower(),
+                                    encode_cursor(cursor))
+    return result
+
+
+def encode_cursor(cursor):
+    # Plain urlsafe base64 JSON in cursor mode. Otherwise a compressed token
+    # with an HMAC of it, so any node can trust it without anything stored -
+    # also when a signed token is followed after the mode changed
+    if settings.STATEMENT_MORE_MODE == 'cursor':
+        return base64.urlsafe_b64encode(json.dumps(cursor, separators=(',', ':'))).rstrip('=')
+    return signing.dumps(cursor, salt=MORE_TOKEN_SALT, compress=True)
+
+
+def decode_cursor(more_id):
+    # Signed tokens are the only ones with a ':', they're accepted whatever
+    # the mode. Unsigned cursors only in cursor mode, once signing is on they
+    # could be altered
+    if ':' in more_id:
+        try:
+            return signing.loads(more_id, salt=MORE_TOKEN_SALT,
+                                 max_age=settings.STATEMENT_MORE_TOKEN_MAX_AGE)
+        except signing.SignatureExpired:
+            raise NotFound("List does not exist - may have expired after %s seconds" %
+                           settings.STATEMENT_MORE_TOKEN_MAX_AGE)
+        except signing.BadSignature:
+            raise NotFound("List does not exist - the more URL is not valid")
+    if settings.STATEMENT_MORE_MODE != 'cursor':
+        raise NotFound("List does not exist - the more URL is not valid")
+    try:
+        more_id = str(more_id)
+        return json.loads(base64.urlsafe_b64decode(more_id + '=' * (-len(more_id) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        raise NotFound("List does not exist - the more URL is not valid")
+
+
+def parse_cursor_request(more_id, auth):
+    cursor = decode_cursor(more_id)
+    # Unsigned cursors come from the client as they are, everything in them
+    # is checked again like the query they continue
+    try:
+        filters = dict(cursor['filters'])
+        position = cursor['position']
+        stored, last_id = position
+        if not isinstance(stored, basestring) or not isinstance(last_id, (int, long)) \
+                or isinstance(last_id, bool):
+            raise ValueError("invalid position")
+        parse_datetime(stored)
+        param_dict = {k: filters[k] for k in CURSOR_FILTERS if k in filters}
+        validate_statement_filters(param_dict)
+        if cursor.get('format', 'exact') not in ('exact', 'canonical', 'ids') or \
+                not isinstance(cursor.get('limit'), (int, long, type(None))) or \
+                not isinstance(cursor.get('attachments', False), bool) or \
+                not isinstance(cursor.get('language'), (list, type(None))):
+            raise ValueError("invalid cursor")
+    except (KeyError, TypeError, ValueError, AttributeError, ISO8601Error, ParamError):
+        raise NotFound("List does not exist - the more URL is not valid")
+    # Authorization is the one of the request for this page
+    if auth:
+        param_dict['auth'] = auth
+    stmt_result = create_cursor_stmt_result(param_dict, position, cursor.get('limit'), cursor.get('language'),
+                                            cursor.get('format', 'exact'), cursor.get('attachments', False))
+    return stmt_result, cursor.get('attachments', False)
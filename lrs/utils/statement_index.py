@@ -0,0 +1,107 @@
+from ..models import Statement, SubStatement, StatementAgent, StatementActivity
+
+# Roles an agent can have in a statement and the field it comes from
+AGENT_FIELDS = (('actor', 'actor_id'), ('object', 'object_agent_id'),
+                ('authority', 'authority_id'), ('instructor', 'context_instructor_id'),
+                ('team', 'context_team_id'))
+SUBSTATEMENT_AGENT_FIELDS = (('substatement_actor', 'actor_id'), ('substatement_object', 'object_agent_id'),
+                             ('substatement_instructor', 'context_instructor_id'),
+                             ('substatement_team', 'context_team_id'))
+
+# Roles matched by the agent filter, and with related_agents
+AGENT_ROLES = ('actor', 'object')
+RELATED_AGENT_ROLES = tuple(role for role, field in AGENT_FIELDS + SUBSTATEMENT_AGENT_FIELDS)
+
+CONTEXT_ACTIVITY_TYPES = ('parent', 'grouping', 'category', 'other')
+SUBSTATEMENT_PREFIX = 'substatement_'
+
+# Relations matched by the activity filter, and with related_activities
+ACTIVITY_RELATIONS = ('object',)
+RELATED_ACTIVITY_RELATIONS = tuple(prefix + relation for prefix in ('', SUBSTATEMENT_PREFIX)
+                                   for relation in ACTIVITY_RELATIONS + CONTEXT_ACTIVITY_TYPES)
+
+
+def agent_rows(stmt):
+    # StatementAgent rows for a statement, read from the ids on the model so
+    # no agent is loaded
+    rows = []
+    for role, field in AGENT_FIELDS:
+        agent_id = getattr(stmt, field)
+        if agent_id is not None:
+            rows.append(StatementAgent(
+                statement_id=stmt.pk, agent_id=agent_id, role=role))
+    if stmt.object_substatement_id is not None:
+        sub = stmt.object_substatement
+        for role, field in SUBSTATEMENT_AGENT_FIELDS:
+            agent_id = getattr(sub, field)
+            if agent_id is not None:
+                rows.append(StatementAgent(
+                    statement_id=stmt.pk, agent_id=agent_id, role=role))
+    return rows
+
+
+def activity_rows(stmt, relations):
+    # StatementActivity rows for a statement from its (relation, activity id)
+    # pairs. An activity is only listed once per relation, like m2m add()
+    rows = []
+    seen = set()
+    for relation in relations:
+        if relation not in seen:
+            seen.add(relation)
+            rows.append(StatementActivity(
+                statement_id=stmt.pk, activity_id=relation[1], relation=relation[0]))
+    return rows
+
+
+def save_index_rows(agents, activities):
+    StatementAgent.objects.bulk_create(agents)
+    StatementActivity.objects.bulk_create(activities)
+
+
+def stored_activity_relations(stmts):
+    # (relation, activity id) pairs of saved statements by statement id, read
+    # back from their object and context activity tables
+    relations = {stmt.pk: [] for stmt in stmts}
+    subs = {}
+    for stmt in stmts:
+        if stmt.object_activity_id is not None:
+            relations[stmt.pk].append(('object', stmt.object_activity_id))
+        if stmt.object_substatement_id is not None:
+            subs[stmt.object_substatement_id] = stmt.pk
+            if stmt.object_substatement.object_activity_id is not None:
+                relations[stmt.pk].append(
+                    (SUBSTATEMENT_PREFIX + 'object', stmt.object_substatement.object_activity_id))
+    for con_act_type in CONTEXT_ACTIVITY_TYPES:
+        through = getattr(Statement, 'context_ca_%s' % con_act_type).through
+        for stmt_id, activity_id in through.objects.filter(statement_id__in=relations.keys()) \
+                .values_list('statement_id', 'activity_id'):
+            relations[stmt_id].append((con_act_type, activity_id))
+        if subs:
+            through = getattr(SubStatement, 'context_ca_%s' % con_act_type).through
+            for sub_id, activity_id in through.objects.filter(substatement_id__in=subs.keys()) \
+                    .values_list('substatement_id', 'activity_id'):
+                relations[subs[sub_id]].append(
+                    (SUBSTATEMENT_PREFIX + con_act_type, activity_id))
+    return relations
+
+
+def index_stored_statements(stmts):
+    # Writes the index rows of statements that were saved without them.
+    # object_substatement should be selected along with the statements
+    relations = stored_activity_relations(stmts)
+    save_index_rows([row for stmt in stmts for row in agent_rows(stmt)],
+                    [row for stmt in stmts for row in activity_rows(stmt, relations[stmt.pk])])
+
+
+def agent_statements(agent_ids, related):
+    # Ids of the statements that refer to any of the agents
+    roles = RELATED_AGENT_ROLES if related else AGENT_ROLES
+    return StatementAgent.objects.filter(agent_id__in=agent_ids, role__in=roles) \
+        .values('statement_id')
+
+
+def activity_statements(activity_id, related):
+    # Ids of the statements that refer to the activity (its IRI)
+    relations = RELATED_ACTIVITY_RELATIONS if related else ACTIVITY_RELATIONS
+    return StatementActivity.objects.filter(activity__activity_id=activity_id, relation__in=relations) \
+        .values('statement_id')
@@ -0,0 +1,165 @@
+from collections import OrderedDict
+
+from render import RenderMemo, render_agent, render_verb, render_activity, render_attachment, \
+    render_result, render_context, CONTEXT_ACTIVITY_TYPES
+from ..models import Statement, SubStatement, Agent, Verb, Activity, StatementAttachment
+
+# Fields shared by statements and substatements
+COMMON_FIELDS = ('id', 'actor', 'verb', 'object_agent', 'object_activity', 'object_statementref',
+                 'result_success', 'result_completion', 'result_response', 'result_duration',
+                 'result_score_scaled', 'result_score_raw', 'result_score_min', 'result_score_max',
+                 'result_extensions', 'timestamp', 'context_registration', 'context_instructor',
+                 'context_team', 'context_revision', 'context_platform', 'context_language',
+                 'context_statement', 'context_extensions')
+STATEMENT_FIELDS = COMMON_FIELDS + ('statement_id', 'object_substatement', 'stored', 'authority', 'version')
+SUBSTATEMENT_FIELDS = COMMON_FIELDS
+AGENT_FIELDS = ('id', 'objectType', 'name', 'mbox', 'mbox_sha1sum', 'openid',
+                'account_homePage', 'account_name')
+AGENT_REFS = ('actor', 'object_agent', 'context_instructor', 'context_team', 'authority')
+
+
+def context_activity_ids(model, owner_field, owner_ids):
+    # {owner id: {context activity type: [activity ids]}} read from the four
+    # context activity tables of Statement or SubStatement
+    ids = {owner_id: {} for owner_id in owner_ids}
+    if not owner_ids:
+        return ids
+    for con_act_type in CONTEXT_ACTIVITY_TYPES:
+        through = getattr(model, 'context_ca_%s' % con_act_type).through
+        for owner_id, activity_id in through.objects.filter(**{'%s__in' % owner_field: owner_ids}) \
+                .order_by('id').values_list(owner_field, 'activity_id'):
+            ids[owner_id].setdefault(con_act_type, []).append(activity_id)
+    return ids
+
+
+def load_agents(agent_ids):
+    # The rows of the agents and of the members of the groups among them,
+    # with {group id: [member ids]}
+    agents = {row['id']: row for row in Agent.objects.filter(id__in=agent_ids).values(*AGENT_FIELDS)}
+    group_ids = [agent_id for agent_id, row in agents.iteritems() if row['objectType'] == 'Group']
+    members = {}
+    if group_ids:
+        for group_id, member_id in Agent.member.through.objects.filter(from_agent_id__in=group_ids) \
+                .order_by('id').values_list('from_agent_id', 'to_agent_id'):
+            members.setdefault(group_id, []).append(member_id)
+        missing = set(m for member_ids in members.itervalues() for m in member_ids) - set(agents)
+        if missing:
+            agents.update((row['id'], row) for row in
+                          Agent.objects.filter(id__in=missing).values(*AGENT_FIELDS))
+    return agents, members
+
+
+def serialize_statements(ids, lang, stmt_format, memo=None):
+    # The canonical or ids format dicts of the statements with these ids, in
+    # the same order
+    stmts = serialize_statement_map(ids, lang, stmt_format, memo)
+    # Could have been deleted since the page was read
+    return [stmts[stmt_id] for stmt_id in ids if stmt_id in stmts]
+
+
+def serialize_statement_map(ids, lang, stmt_format, memo=None):
+    # The canonical or ids format dicts of the statements with these ids by
+    # id. Everything they refer to is read for all of them at once as plain
+    # rows, so a page takes the same number of queries whatever its size, not
+    # a few per statement like Statement.to_dict. Agents, verbs and
+    # activities are rendered once into memo, the ones already in it from
+    # earlier statements of the request aren't read again
+    ids_only = stmt_format == 'ids'
+    if memo is None:
+        memo = RenderMemo()
+    stmts = {row['id']: row for row in Statement.objects.filter(id__in=ids).values(*STATEMENT_FIELDS)}
+    sub_ids = [row['object_substatement'] for row in stmts.itervalues() if row['object_substatement']]
+    subs = {}
+    if sub_ids:
+        subs = {row['id']: row for row in SubStatement.objects.filter(id__in=sub_ids).values(*SUBSTATEMENT_FIELDS)}
+    rows = stmts.values() + subs.values()
+
+    stmt_context_ids = context_activity_ids(Statement, 'statement_id', stmts.keys())
+    sub_context_ids = context_activity_ids(SubStatement, 'substatement_id', subs.keys())
+
+    def unrendered(kind, pks):
+        return set(pk for pk in pks if pk is not None and not memo.has(kind, pk, lang, ids_only))
+
+    agents, members = {}, {}
+    agent_ids = unrendered('agent', (row.get(ref) for row in rows for ref in AGENT_REFS))
+    if agent_ids:
+        agents, members = load_agents(agent_ids)
+    verbs = {}
+    verb_ids = unrendered('verb', (row['verb'] for row in rows))
+    if verb_ids:
+        verbs = {verb_id: (iri, data) for verb_id, iri, data in
+                 Verb.objects.filter(id__in=verb_ids).values_list('id', 'verb_id', 'canonical_data')}
+    activity_ids = [row['object_activity'] for row in rows]
+    for context_ids in stmt_context_ids.values() + sub_context_ids.values():
+        for act_ids in context_ids.itervalues():
+            activity_ids.extend(act_ids)
+    activity_ids = unrendered('activity', activity_ids)
+    activities = {}
+    if activity_ids:
+        activities = {act_id: (iri, data) for act_id, iri, data in
+                      Activity.objects.filter(id__in=activity_ids).values_list('id', 'activity_id', 'canonical_data')}
+    attachments = {}
+    for stmt_id, data in StatementAttachment.objects.filter(statement_id__in=stmts.keys()) \
+            .order_by('id').values_list('statement_id', 'canonical_data'):
+        attachments.setdefault(stmt_id, []).append(data)
+
+    def agent(agent_id):
+        return memo.get('agent', agent_id, lang, ids_only, lambda: render_agent(
+            agents[agent_id], ids_only, (agent(m) for m in members.get(agent_id, ()))))
+
+    def verb(verb_id):
+        return memo.get('verb', verb_id, lang, ids_only, lambda: render_verb(
+            verbs[verb_id][0], verbs[verb_id][1], lang, ids_only))
+
+    def activity(activity_id):
+        return memo.get('activity', activity_id, lang, ids_only, lambda: render_activity(
+            activities[activity_id][0], activities[activity_id][1], lang, ids_only))
+
+    def body(row, context_ids):
+        # What statements and substatements have in common, up to the context
+        ret = OrderedDict()
+        ret['actor'] = agent(row['actor'])
+        ret['verb'] = verb(row['verb'])
+        if row['object_agent'] is not None:
+            ret['object'] = agent(row['object_agent'])
+        elif row['object_activity'] is not None:
+            ret['object'] = activity(row['object_activity'])
+        elif row.get('object_substatement') is not None:
+            ret['object'] = substatement(subs[row['object_substatement']])
+        else:
+            ret['object'] = {
+                'id': str(row['object_statementref']), 'objectType': 'StatementRef'}
+        result = render_result(row)
+        if result:
+            ret['result'] = result
+        context = render_context(
+            row,
+            agent(row['context_instructor']) if row['context_instructor'] is not None else None,
+            agent(row['context_team']) if row['context_team'] is not None else None,
+            {con_act_type: [activity(act_id) for act_id in act_ids]
+             for con_act_type, act_ids in context_ids.iteritems()})
+        if context:
+            ret['context'] = context
+        return ret
+
+    def substatement(row):
+        ret = body(row, sub_context_ids[row['id']])
+        if row['timestamp']:
+            ret['timestamp'] = row['timestamp'].isoformat()
+        ret['objectType'] = "SubStatement"
+        return ret
+
+    def statement(row):
+        ret = OrderedDict()
+        ret['id'] = str(row['statement_id'])
+        ret.update(body(row, stmt_context_ids[row['id']]))
+        ret['timestamp'] = row['timestamp'].isoformat()
+        ret['stored'] = row['stored'].isoformat()
+        if row['authority'] is not None:
+            ret['authority'] = agent(row['authority'])
+        ret['version'] = row['version']
+        if row['id'] in attachments:
+            ret['attachments'] = [render_attachment(data, lang) for data in attachments[row['id']]]
+        return ret
+
+    return {stmt_id: statement(row) for stmt_id, row in stmts.iteritems()}
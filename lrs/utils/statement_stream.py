@@ -0,0 +1,170 @@
+import json
+import re
+
+from . import convert_to_datatype
+from ..exceptions import BadRequest
+
+READ_SIZE = 65536
+
+WHITESPACE = ' \t\r\n'
+# Characters that matter when finding the end of a value, inside and outside
+# of strings
+STRUCTURE_RE = re.compile(r'[\[\]{},"]')
+STRING_RE = re.compile(r'["\\]')
+
+
+class StatementStream():
+    # Reads the statements of a JSON statement POST from the request one at a
+    # time. Only the statement being read and one read buffer are held in
+    # memory, the body is never loaded as a whole. A body that is a single
+    # statement or isn't a JSON array falls back to being parsed in full like
+    # any other body. Reading more than max_size bytes is a BadRequest.
+
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max_size
+        self.size = 0
+        self.eof = False
+        self.buffer = ''
+        self.pos = 0
+        content_length = getattr(stream, 'META', {}).get('CONTENT_LENGTH', None)
+        if content_length and int(content_length) > max_size:
+            self.too_large()
+
+    def too_large(self):
+        raise BadRequest(
+            "Request body is larger than the maximum of %s bytes" % self.max_size)
+
+    def read(self):
+        # Adds the next block of the request to the buffer, returns False once
+        # there is nothing left
+        if self.eof:
+            return False
+        data = self.stream.read(READ_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.too_large()
+        self.buffer += data
+        return True
+
+    def read_all(self):
+        while self.read():
+            pass
+        return self.buffer
+
+    def next_char(self):
+        # Skips whitespace and returns the next character without consuming
+        # it, empty string at the end of the body
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read():
+                return ''
+
+    def scan_value(self):
+        # Returns the end of the array element starting at self.pos - the
+        # index of the ',' or ']' that follows it. ValueError if the body ends
+        # first
+        depth = 0
+        in_string = False
+        scan = self.pos
+        while True:
+            match = (STRING_RE if in_string else STRUCTURE_RE).search(
+                self.buffer, scan)
+            if match is None:
+                scan = len(self.buffer)
+                if not self.read():
+                    raise ValueError("Body ended inside a statement")
+                continue
+            scan = match.end()
+            char = match.group()
+            if in_string:
+                if char == '"':
+                    in_string = False
+                # Escaped character, make sure it's been read and skip it
+                elif scan >= len(self.buffer) and not self.read():
+                    raise ValueError("Body ended inside a statement")
+                else:
+                    scan += 1
+            elif char == '"':
+                in_string = True
+            elif char in '[{':
+                depth += 1
+            elif char in ']}':
+                if depth == 0:
+                    return match.start()
+                depth -= 1
+            elif depth == 0:
+                return match.start()
+
+    def consume(self):
+        # Drop what has been parsed once it's more than a read's worth, so the
+        # buffer stays around the size of a read plus the current statement
+        if self.pos > READ_SIZE:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+
+    def __iter__(self):
+        first = self.next_char()
+        if not first:
+            raise BadRequest("No body in request")
+        if first != '[':
+            for st in self.parse_whole():
+                yield st
+            return
+
+        self.pos += 1
+        if self.next_char() == ']':
+            self.pos += 1
+        else:
+            count = 0
+            while True:
+                try:
+                    end = self.scan_value()
+                    st = json.loads(self.buffer[self.pos:end])
+                except ValueError:
+                    # Could still be a python literal, which only works for
+                    # the body as a whole
+                    if not count:
+                        for st in self.parse_whole():
+                            yield st
+                        return
+                    raise BadRequest("Could not parse request body")
+                self.pos = end
+                separator = self.next_char()
+                self.pos += 1
+                self.consume()
+                count += 1
+                yield st
+                if separator == ']':
+                    break
+                elif separator != ',':
+                    raise BadRequest("Could not parse request body")
+        if self.next_char():
+            raise BadRequest("Could not parse request body")
+
+    def parse_whole(self):
+        # Nothing has been consumed yet, so the buffer starts at the beginning
+        # of the body
+        try:
+            data = convert_to_datatype(self.read_all())
+        except Exception:
+            raise BadRequest("Could not parse request body")
+        if isinstance(data, list):
+            return data
+        return [data]
+
+    def chunks(self, size):
+        chunk = []
+        for st in self:
+            chunk.append(st)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
@@ -0,0 +1,74 @@
+from django.db import connection
+
+# Creates a row or returns the existing one in a single statement. The lookup,
+# the optional merge into an existing row and the insert are data-modifying
+# CTEs of one query, so an existing row never costs an id from the sequence
+# and a concurrent insert of the same row is resolved by ON CONFLICT.
+UPSERT_SQL = """WITH incoming AS (SELECT %(incoming)s),
+found AS (SELECT %(stored)s FROM %(table)s AS stored, incoming AS excluded WHERE %(key)s),
+%(updated)s
+inserted AS (INSERT INTO %(table)s AS stored (%(columns)s)
+             SELECT %(columns)s FROM incoming WHERE NOT EXISTS (SELECT 1 FROM found)
+             ON CONFLICT (%(conflict)s) DO %(action)s
+             RETURNING %(stored)s, stored.xmax = 0, true)
+SELECT * FROM inserted
+%(union_updated)s
+UNION ALL SELECT *, false, false FROM found %(not_updated)s"""
+
+UPDATED_SQL = """updated AS (UPDATE %(table)s AS stored SET %(assignments)s FROM found, incoming AS excluded
+            WHERE stored.%(pk)s = found.%(pk)s AND (%(changed)s)
+            RETURNING %(stored)s),"""
+
+
+def upsert(obj, unique_fields, merge=None):
+    # obj is an unsaved instance holding the values to insert, unique_fields
+    # the fields of the unique constraint to look it up by. merge maps field
+    # names to SQL expressions for the new value of an existing row, where
+    # stored is the existing row and excluded the incoming one - the row is
+    # only written if one of them changes. Returns (instance, created, updated)
+    qn = connection.ops.quote_name
+    opts = obj._meta
+    pk = opts.pk
+    fields = [f for f in opts.concrete_fields if f is not pk]
+    table = qn(opts.db_table)
+    columns = ', '.join(qn(f.column) for f in fields)
+    stored = ', '.join('stored.%s' % qn(f.column) for f in opts.concrete_fields)
+    sql = {
+        'table': table,
+        'columns': columns,
+        'stored': stored,
+        'incoming': ', '.join('CAST(%%s AS %s) AS %s' % (f.db_type(connection), qn(f.column))
+                              for f in fields),
+        'key': ' AND '.join('stored.%s = excluded.%s' % (qn(opts.get_field(name).column),
+                                                         qn(opts.get_field(name).column))
+                            for name in unique_fields),
+        'conflict': ', '.join(qn(opts.get_field(name).column) for name in unique_fields),
+        'action': 'NOTHING',
+        'updated': '',
+        'union_updated': '',
+        'not_updated': '',
+    }
+    if merge:
+        assignments = ', '.join('%s = (%s)' % (qn(opts.get_field(name).column), expression)
+                                for name, expression in merge.items())
+        changed = ' OR '.join('stored.%s IS DISTINCT FROM (%s)' % (qn(opts.get_field(name).column), expression)
+                              for name, expression in merge.items())
+        sql['action'] = 'UPDATE SET %s WHERE %s' % (assignments, changed)
+        sql['updated'] = UPDATED_SQL % {'table': table, 'assignments': assignments, 'pk': qn(pk.column),
+                                        'changed': changed, 'stored': stored}
+        sql['union_updated'] = 'UNION ALL SELECT *, false, true FROM updated'
+        sql['not_updated'] = 'WHERE NOT EXISTS (SELECT 1 FROM updated)'
+
+    params = [f.get_db_prep_save(f.pre_save(obj, True), connection) for f in fields]
+    with connection.cursor() as cursor:
+        cursor.execute(UPSERT_SQL % sql, params)
+        row = cursor.fetchone()
+    if row is None:
+        # Another transaction inserted the row after this statement started
+        # and there was nothing to merge into it
+        lookup = {name: getattr(obj, name) for name in unique_fields}
+        return opts.model._default_manager.get(**lookup), False, False
+    count = len(opts.concrete_fields)
+    instance = opts.model.from_db(connection.alias,
+                                  [f.attname for f in opts.concrete_fields], row[:count])
+    return instance, row[count], row[count + 1]
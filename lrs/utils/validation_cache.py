@@ -0,0 +1,29 @@
+from django.conf import settings
+
+from lru_cache import LRUCache
+
+# IRIs and language tags already found to be valid, in each process. Parsing
+# an IRI is by far the slowest part of validating a statement and statements
+# keep using the same verbs, activities and extensions. Only valid values are
+# kept, an invalid one is parsed again each time so its error is reported
+# the same way
+iri_cache = LRUCache(settings.IRI_CACHE_SIZE)
+language_cache = LRUCache(settings.LANGUAGE_CACHE_SIZE)
+
+
+def hit_rate(cache):
+    lookups = cache.hits + cache.misses
+    return float(cache.hits) / lookups if lookups else 0.0
+
+
+def stats():
+    iri_stats = iri_cache.stats()
+    iri_stats['hit_rate'] = hit_rate(iri_cache)
+    language_stats = language_cache.stats()
+    language_stats['hit_rate'] = hit_rate(language_cache)
+    return {'iri': iri_stats, 'language': language_stats}
+
+
+def clear():
+    iri_cache.clear()
+    language_cache.clear()
@@ -0,0 +1,98 @@
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+
+from ..models import Verb
+from .render_cache import render_cache
+from .upsert import upsert
+
+# Shared token that changes whenever a process rewrites a verb
+GENERATION_KEY = 'lrs_verb_registry_generation'
+
+# Same merge as merge_canonical_data, done by the upsert
+CANONICAL_DATA_MERGE = """stored.canonical_data || jsonb_build_object('id', excluded.verb_id) ||
+    CASE WHEN excluded.canonical_data ? 'display'
+        THEN jsonb_build_object('display', COALESCE(stored.canonical_data -> 'display', '{}') ||
+                                           (excluded.canonical_data -> 'display'))
+        ELSE '{}' END"""
+
+
+def needs_update(canonical_data, verb_id, displays):
+    if canonical_data.get('id', None) != verb_id:
+        return True
+    if displays and 'display' not in canonical_data:
+        return True
+    existing = canonical_data.get('display', {})
+    for display in displays:
+        for lang, value in display.iteritems():
+            if existing.get(lang, None) != value:
+                return True
+    return False
+
+
+def merge_canonical_data(canonical_data, verb_id, displays):
+    merged = dict(canonical_data)
+    # Later displays overwrite earlier ones, same as saving one by one
+    if displays:
+        display = dict(merged.get('display', {}))
+        for d in displays:
+            display.update(d)
+        merged['display'] = display
+    merged['id'] = verb_id
+    return merged
+
+
+class VerbRegistry():
+    # Process-local map of verb_id to Verb so statements using a known verb
+    # with nothing new in its display skip the database entirely. Entries are
+    # only added once the transaction that read or wrote them commits.
+
+    def __init__(self):
+        self.verbs = {}
+        self.generation = None
+
+    def sync(self):
+        # Called once per request - if another process rewrote a verb since
+        # the last sync, drop everything and reload verbs as they are used
+        generation = cache.get(GENERATION_KEY)
+        if generation is None:
+            cache.add(GENERATION_KEY, uuid.uuid4().hex, None)
+            generation = cache.get(GENERATION_KEY)
+        if generation != self.generation:
+            self.verbs.clear()
+            self.generation = generation
+
+    def cached(self, verb_id, displays):
+        verb_object = self.verbs.get(verb_id, None)
+        if verb_object and not needs_update(verb_object.canonical_data, verb_id, displays):
+            return verb_object
+        return None
+
+    def register(self, verb_object, changed=False):
+        def commit():
+            self.verbs[verb_object.verb_id] = verb_object
+            # A new token makes every process (this one included) drop its
+            # copies on its next sync
+            if changed:
+                cache.set(GENERATION_KEY, uuid.uuid4().hex, None)
+        transaction.on_commit(commit)
+
+    def get(self, verb_data):
+        verb_id = verb_data['id']
+        displays = [verb_data['display']] if 'display' in verb_data else []
+        verb_object = self.cached(verb_id, displays)
+        if verb_object:
+            return verb_object
+
+        # The display is merged in the database so one added by another
+        # process in the meantime is not overwritten
+        verb_object, created, updated = upsert(
+            Verb(verb_id=verb_id, canonical_data=merge_canonical_data({}, verb_id, displays)),
+            ['verb_id'], {'canonical_data': CANONICAL_DATA_MERGE})
+        if updated and not created:
+            render_cache.invalidate_definitions()
+        self.register(verb_object, updated and not created)
+        return verb_object
+
+verb_registry = VerbRegistry()
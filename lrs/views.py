@@ -241,6 +241,9 @@ def handle_request(request, more_id=None):
         status = 500
         log_exception(status, request.path)
         response = HttpResponse(err.message, status=status)   
+    # Streamed statements can fail after earlier ones were saved, nothing
+    # from a failed request is committed
+    transaction.set_rollback(True)
     return response
 
 def log_exception(status, path):